@@ -60,6 +60,6 @@ else:
 print("\n" + "="*60)
 print("NEXT STEPS:")
 print("="*60)
-print("1. Update replicate_helper.py with new character configurations")
-print("2. Update index.html to add character cards")
+print("1. Add the new characters to characters.json")
+print("2. Give them a 'card' entry there to show them on the kiosk grid")
 print("3. Copy images to static/characters/")
@@ -0,0 +1,504 @@
+"""
+Admission Queue Module
+Puts a bounded, fair job queue in front of prediction creation. /swap-face
+enqueues a job once its images are uploaded; a dispatcher starts predictions
+only while fewer than ADMISSION_MAX_ACTIVE are running, so a rush becomes a
+queue with a reported position and ETA instead of provider rate-limit errors.
+
+Fairness: the next job goes to the client (kiosk) with the fewest jobs
+running, oldest job first, so one busy kiosk cannot starve the others.
+
+The queue lives in a SQLite file (WAL mode) shared by all gunicorn workers
+on a box; every worker runs a dispatcher and claims jobs atomically.
+"""
+
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Any, List, Optional
+from dotenv import load_dotenv
+
+import sqlite_db
+
+# Load environment variables
+load_dotenv()
+
+ADMISSION_DB_PATH = os.getenv('ADMISSION_DB_PATH', 'admission.db')
+
+# Predictions allowed to run at once (across all workers sharing the file)
+ADMISSION_MAX_ACTIVE = int(os.getenv('ADMISSION_MAX_ACTIVE', '4'))
+
+# Jobs allowed to wait, in total and per client
+ADMISSION_QUEUE_MAX = int(os.getenv('ADMISSION_QUEUE_MAX', '50'))
+ADMISSION_CLIENT_MAX = int(os.getenv('ADMISSION_CLIENT_MAX', '5'))
+
+# Failed prediction starts (rate limits, provider errors) are retried with
+# backoff this many times before the job fails
+ADMISSION_MAX_ATTEMPTS = int(os.getenv('ADMISSION_MAX_ATTEMPTS', '5'))
+
+# Assumed prediction duration (seconds) until real runs have been measured
+ADMISSION_DEFAULT_DURATION = float(os.getenv('ADMISSION_DEFAULT_DURATION', '30'))
+
+# Seconds the dispatcher waits between passes when nothing wakes it
+ADMISSION_POLL_INTERVAL = float(os.getenv('ADMISSION_POLL_INTERVAL', '0.5'))
+
+# A running job holds its slot until its prediction finishes, at most until
+# the prediction would be reaped
+SLOT_TTL = float(os.getenv('PREDICTION_TTL', '600'))
+
+# Finished job rows are kept this long so late polls still resolve
+JOB_RETENTION = float(os.getenv('IDEMPOTENCY_TTL', '900'))
+
+# Seconds a job being started stays hidden from other dispatchers
+CLAIM_LEASE_SECONDS = 60
+
+JOB_ID_PREFIX = 'job_'
+
+# Slots taken outside the queue (prediction hedges, warm-ups) are recorded
+# under this client and kept out of the duration average
+EXTRA_SLOT_CLIENT = '_extra'
+
+_wake = threading.Event()
+_dispatcher_started = False
+_dispatcher_lock = threading.Lock()
+_schema_ready = False
+
+
+def _connect() -> sqlite3.Connection:
+    """Return this thread's connection to the queue database."""
+    global _schema_ready
+    conn = sqlite_db.connect(ADMISSION_DB_PATH)
+    if not _schema_ready:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS swap_jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " client_id TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " state TEXT NOT NULL,"          # queued | starting | running | done | failed
+            " enqueued_at REAL NOT NULL,"
+            " not_before REAL NOT NULL DEFAULT 0,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " claimed_until REAL NOT NULL DEFAULT 0,"
+            " started_at REAL,"
+            " finished_at REAL,"
+            " prediction_id TEXT,"
+            " error TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_swap_jobs_state ON swap_jobs (state)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_swap_jobs_prediction ON swap_jobs (prediction_id)")
+        # Predictions that finished before their row was marked running
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS early_finishes ("
+            " prediction_id TEXT PRIMARY KEY,"
+            " finished_at REAL NOT NULL)"
+        )
+        _schema_ready = True
+    return conn
+
+
+def is_job_id(job_id: str) -> bool:
+    """True if the ID is an admission job (not a provider prediction ID)."""
+    return job_id.startswith(JOB_ID_PREFIX)
+
+
+def _active_clause(now: float) -> tuple:
+    """SQL condition (and parameters) for jobs currently holding a slot."""
+    return (
+        "((state = 'starting' AND claimed_until > ?) OR (state = 'running' AND started_at > ?))",
+        (now, now - SLOT_TTL)
+    )
+
+
+def _dispatch_order(conn: sqlite3.Connection, now: float) -> List[tuple]:
+    """
+    Order the waiting jobs the way the dispatcher will start them.
+
+    Returns:
+        List of (job_id, not_before) tuples, next job first
+    """
+    active_sql, active_params = _active_clause(now)
+    running = dict(conn.execute(
+        f"SELECT client_id, COUNT(*) FROM swap_jobs WHERE {active_sql} GROUP BY client_id",
+        active_params
+    ).fetchall())
+    waiting = conn.execute(
+        "SELECT job_id, client_id, not_before FROM swap_jobs "
+        "WHERE state = 'queued' OR (state = 'starting' AND claimed_until <= ?) "
+        "ORDER BY enqueued_at",
+        (now,)
+    ).fetchall()
+
+    # Per-client FIFO lanes, served by fewest running first (ties: oldest head)
+    lanes = {}
+    for job_id, client_id, not_before in waiting:
+        lanes.setdefault(client_id, []).append((job_id, not_before))
+
+    order = []
+    served = {client_id: running.get(client_id, 0) for client_id in lanes}
+    heads = {client_id: 0 for client_id in lanes}
+    arrival = {client_id: index for index, client_id in enumerate(lanes)}
+    while lanes:
+        client_id = min(lanes, key=lambda c: (served[c], arrival[c]))
+        order.append(lanes[client_id][heads[client_id]])
+        heads[client_id] += 1
+        served[client_id] += 1
+        if heads[client_id] == len(lanes[client_id]):
+            del lanes[client_id]
+    return order
+
+
+def has_room(client_id: str) -> bool:
+    """Check (before any upload) whether a new job from this client would be accepted."""
+    conn = _connect()
+    total, mine = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(client_id = ?), 0) FROM swap_jobs WHERE state = 'queued'",
+        (client_id,)
+    ).fetchone()
+    return total < ADMISSION_QUEUE_MAX and mine < ADMISSION_CLIENT_MAX
+
+
+def take_slot() -> Optional[str]:
+    """
+    Take a slot for a prediction started outside the queue (a hedge or a
+    warm-up). Only succeeds while a slot is free and no job is waiting, so
+    it never delays a kiosk. The slot is held like a job's until finish()
+    is called for the prediction bound to it.
+
+    Returns:
+        Slot ID for bind_slot() / release_slot(), or None if no slot is spare
+    """
+    conn = _connect()
+    now = time.time()
+    slot_id = f"slot_{uuid.uuid4().hex}"
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        active_sql, active_params = _active_clause(now)
+        active = conn.execute(
+            f"SELECT COUNT(*) FROM swap_jobs WHERE {active_sql}", active_params
+        ).fetchone()[0]
+        waiting = conn.execute(
+            "SELECT COUNT(*) FROM swap_jobs "
+            "WHERE state = 'queued' OR (state = 'starting' AND claimed_until <= ?)",
+            (now,)
+        ).fetchone()[0]
+        if active >= ADMISSION_MAX_ACTIVE or waiting:
+            conn.execute("ROLLBACK")
+            return None
+        conn.execute(
+            "INSERT INTO swap_jobs (job_id, client_id, payload, state, enqueued_at, started_at) "
+            "VALUES (?, ?, '{}', 'running', ?, ?)",
+            (slot_id, EXTRA_SLOT_CLIENT, now, now)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return slot_id
+
+
+def _mark_running(job_id: str, prediction_id: str, started_at: Optional[float]) -> None:
+    """
+    Attach a started prediction to its row. If finish() already came for it
+    (a webhook or poll can beat this update), the row is closed right away.
+    """
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        finished_early = conn.execute(
+            "DELETE FROM early_finishes WHERE prediction_id = ?", (prediction_id,)
+        ).rowcount
+        if finished_early:
+            # No started_at: a near-zero run would skew average_duration()
+            conn.execute(
+                "UPDATE swap_jobs SET state = 'done', prediction_id = ?, started_at = NULL, finished_at = ? "
+                "WHERE job_id = ?",
+                (prediction_id, now, job_id)
+            )
+        elif started_at is None:
+            conn.execute("UPDATE swap_jobs SET prediction_id = ? WHERE job_id = ?", (prediction_id, job_id))
+        else:
+            conn.execute(
+                "UPDATE swap_jobs SET state = 'running', prediction_id = ?, started_at = ? WHERE job_id = ?",
+                (prediction_id, started_at, job_id)
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if finished_early:
+        _wake.set()
+
+
+def bind_slot(slot_id: str, prediction_id: str) -> None:
+    """Attach the prediction started on a slot, so finish(prediction_id) frees it."""
+    _mark_running(slot_id, prediction_id, None)
+
+
+def release_slot(slot_id: str) -> None:
+    """Give back a slot whose prediction was never started."""
+    _connect().execute("DELETE FROM swap_jobs WHERE job_id = ?", (slot_id,))
+    _wake.set()
+
+
+def enqueue(client_id: str, payload: Dict[str, Any]) -> Optional[str]:
+    """
+    Queue a prediction start and wake the dispatcher.
+
+    Args:
+        client_id: Kiosk / client the job belongs to (fairness key)
+        payload: JSON-serializable job data handed to the launch callback
+
+    Returns:
+        Job ID, or None if the queue (or this client's share) is full
+    """
+    conn = _connect()
+    job_id = f"{JOB_ID_PREFIX}{uuid.uuid4().hex}"
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        total, mine = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(client_id = ?), 0) FROM swap_jobs WHERE state = 'queued'",
+            (client_id,)
+        ).fetchone()
+        if total >= ADMISSION_QUEUE_MAX or mine >= ADMISSION_CLIENT_MAX:
+            conn.execute("ROLLBACK")
+            return None
+        conn.execute(
+            "INSERT INTO swap_jobs (job_id, client_id, payload, state, enqueued_at) "
+            "VALUES (?, ?, ?, 'queued', ?)",
+            (job_id, client_id, json.dumps(payload), time.time())
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    _wake.set()
+    return job_id
+
+
+def average_duration() -> float:
+    """Mean run time of recently finished predictions (seconds)."""
+    row = _connect().execute(
+        "SELECT AVG(finished_at - started_at) FROM ("
+        " SELECT started_at, finished_at FROM swap_jobs"
+        " WHERE state = 'done' AND started_at IS NOT NULL AND finished_at IS NOT NULL"
+        " AND client_id != ?"
+        " ORDER BY finished_at DESC LIMIT 20)",
+        (EXTRA_SLOT_CLIENT,)
+    ).fetchone()
+    return row[0] if row and row[0] else ADMISSION_DEFAULT_DURATION
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Look up a job.
+
+    Returns:
+        Dict with 'state', 'prediction_id', 'error', 'payload', plus
+        'queue_position' (1 = next to start) and 'eta_seconds' (estimated
+        seconds until the result) while it is waiting; None if unknown
+    """
+    conn = _connect()
+    row = conn.execute(
+        "SELECT state, prediction_id, error, payload, claimed_until FROM swap_jobs WHERE job_id = ?",
+        (job_id,)
+    ).fetchone()
+    if row is None:
+        return None
+
+    state, prediction_id, error, payload, claimed_until = row
+    job = {
+        'state': state,
+        'prediction_id': prediction_id,
+        'error': error,
+        'payload': json.loads(payload),
+    }
+
+    now = time.time()
+    if state == 'queued' or (state == 'starting' and claimed_until <= now):
+        order = [entry[0] for entry in _dispatch_order(conn, now)]
+        position = order.index(job_id) + 1 if job_id in order else 1
+        job['state'] = 'queued'
+        job['queue_position'] = position
+        job['eta_seconds'] = int(math.ceil(position / float(ADMISSION_MAX_ACTIVE)) * average_duration())
+    return job
+
+
+def _claim_next() -> Optional[tuple]:
+    """Claim the next job if a slot is free (lease hides it from other dispatchers)."""
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        active_sql, active_params = _active_clause(now)
+        active = conn.execute(
+            f"SELECT COUNT(*) FROM swap_jobs WHERE {active_sql}", active_params
+        ).fetchone()[0]
+        claimed = None
+        if active < ADMISSION_MAX_ACTIVE:
+            for job_id, not_before in _dispatch_order(conn, now):
+                if not_before <= now:
+                    claimed = job_id
+                    break
+        if claimed is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE swap_jobs SET state = 'starting', claimed_until = ?, attempts = attempts + 1 "
+            "WHERE job_id = ?",
+            (now + CLAIM_LEASE_SECONDS, claimed)
+        )
+        row = conn.execute(
+            "SELECT payload, attempts FROM swap_jobs WHERE job_id = ?", (claimed,)
+        ).fetchone()
+        conn.execute("COMMIT")
+        return claimed, json.loads(row[0]), row[1]
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def finish(prediction_id: str) -> None:
+    """Free the slot held by a prediction that finished (safe to call more than once)."""
+    if not prediction_id:
+        return
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        updated = conn.execute(
+            "UPDATE swap_jobs SET state = 'done', finished_at = ? "
+            "WHERE prediction_id = ? AND state = 'running'",
+            (now, prediction_id)
+        ).rowcount
+        if not updated:
+            # Its row may still be between launch and _mark_running()
+            launching = conn.execute(
+                "SELECT COUNT(*) FROM swap_jobs "
+                "WHERE (state = 'starting' AND claimed_until > ?) "
+                "OR (state = 'running' AND prediction_id IS NULL AND started_at > ?)",
+                (now, now - SLOT_TTL)
+            ).fetchone()[0]
+            if launching:
+                conn.execute(
+                    "INSERT OR REPLACE INTO early_finishes (prediction_id, finished_at) VALUES (?, ?)",
+                    (prediction_id, now)
+                )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if updated:
+        _wake.set()
+
+
+def _purge_finished() -> None:
+    """Drop finished job rows nobody will poll again."""
+    conn = _connect()
+    cutoff = time.time() - JOB_RETENTION
+    conn.execute(
+        "DELETE FROM swap_jobs WHERE state IN ('done', 'failed') AND COALESCE(finished_at, enqueued_at) < ?",
+        (cutoff,)
+    )
+    conn.execute("DELETE FROM early_finishes WHERE finished_at < ?", (cutoff,))
+
+
+def dispatch_pending(
+    launch: Callable[[str, Dict[str, Any]], Optional[str]],
+    abandon: Callable[[str, Dict[str, Any], str], None]
+) -> int:
+    """
+    Start queued jobs while slots are free.
+
+    Args:
+        launch: Called with (job_id, payload); returns the prediction ID,
+            or None if the start failed and should be retried
+        abandon: Called with (job_id, payload, error) when a job gives up
+
+    Returns:
+        Number of predictions started
+    """
+    started = 0
+    while True:
+        claimed = _claim_next()
+        if claimed is None:
+            return started
+        job_id, payload, attempts = claimed
+
+        try:
+            prediction_id = launch(job_id, payload)
+        except Exception as e:
+            print(f"[Admission] Launch of {job_id} raised: {str(e)}", flush=True)
+            prediction_id = None
+
+        conn = _connect()
+        if prediction_id:
+            _mark_running(job_id, prediction_id, time.time())
+            started += 1
+        elif attempts >= ADMISSION_MAX_ATTEMPTS:
+            error = 'Failed to start AI processing'
+            print(f"[Admission] Giving up on {job_id} after {attempts} attempts", flush=True)
+            conn.execute(
+                "UPDATE swap_jobs SET state = 'failed', error = ?, finished_at = ? WHERE job_id = ?",
+                (error, time.time(), job_id)
+            )
+            abandon(job_id, payload, error)
+        else:
+            # Provider refused (rate limit, outage): this job backs off and
+            # keeps its place in line; the next one still gets its turn
+            delay = min(2 ** attempts, 30)
+            print(f"[Admission] Start of {job_id} failed, retrying in {delay}s", flush=True)
+            conn.execute(
+                "UPDATE swap_jobs SET state = 'queued', claimed_until = 0, not_before = ? "
+                "WHERE job_id = ?",
+                (time.time() + delay, job_id)
+            )
+
+
+def get_queue_stats() -> Dict[str, Any]:
+    """Queue depth and slot usage, reported by /health."""
+    conn = _connect()
+    now = time.time()
+    active_sql, active_params = _active_clause(now)
+    queued = conn.execute("SELECT COUNT(*) FROM swap_jobs WHERE state = 'queued'").fetchone()[0]
+    active = conn.execute(
+        f"SELECT COUNT(*) FROM swap_jobs WHERE {active_sql}", active_params
+    ).fetchone()[0]
+    return {
+        'queued': queued,
+        'active': active,
+        'max_active': ADMISSION_MAX_ACTIVE,
+        'avg_duration': round(average_duration(), 1),
+    }
+
+
+def start_dispatcher(
+    launch: Callable[[str, Dict[str, Any]], Optional[str]],
+    abandon: Callable[[str, Dict[str, Any], str], None]
+) -> None:
+    """Start the background dispatcher (once per process). See dispatch_pending()."""
+    global _dispatcher_started
+    with _dispatcher_lock:
+        if _dispatcher_started:
+            return
+        _dispatcher_started = True
+
+    def _run():
+        last_purge = 0.0
+        while True:
+            try:
+                dispatch_pending(launch, abandon)
+                if time.time() - last_purge > 60:
+                    _purge_finished()
+                    last_purge = time.time()
+            except Exception as e:
+                print(f"[Admission] Dispatcher error: {str(e)}", flush=True)
+            _wake.wait(timeout=ADMISSION_POLL_INTERVAL)
+            _wake.clear()
+
+    threading.Thread(target=_run, name='admission-dispatcher', daemon=True).start()
+    print(f"[Admission] Dispatcher started (max {ADMISSION_MAX_ACTIVE} running predictions)", flush=True)
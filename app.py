@@ -1,13 +1,32 @@
 from flask import Flask, render_template, request, jsonify
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
 import sys
+import time
 import base64
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
 
 # Import our helper modules
 import cloudinary_helper
 import replicate_helper
+import image_normalizer
+import prediction_store as prediction_store_module
+import prediction_reaper
+import cleanup_queue
+import result_cache as result_cache_module
+import job_scheduler
+import face_mask_generator
+import face_quality
+import admission_queue
+import prediction_hedger
+import face_backends
+import resilience
+import character_registry
+import status_poller
 
 # Fix Windows console encoding issues
 if sys.platform == 'win32':
@@ -24,8 +43,102 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app)
 
-# Store active predictions in memory (for polling)
-active_predictions = {}
+# Reject oversized uploads before the body is buffered (Flask answers 413)
+MAX_UPLOAD_MB = int(os.getenv('MAX_UPLOAD_MB', '12'))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+
+# Prediction state shared by all workers (PREDICTION_STORE=memory|sqlite)
+prediction_store = prediction_store_module.create_prediction_store()
+
+# Finished results keyed by photo hash + character + model version
+result_cache = result_cache_module.create_result_cache()
+
+# Abandoned predictions expire this many seconds after they start; the
+# reaper then cancels them and deletes their temp images
+PREDICTION_TTL = float(os.getenv('PREDICTION_TTL', '600'))
+prediction_reaper.start_reaper(prediction_store)
+
+# Background worker that bulk-deletes queued temp images (survives restarts)
+cleanup_queue.start_worker()
+
+# Fallback sweep of old temp images; the scheduler lease makes sure only one
+# worker runs it per interval
+TEMP_IMAGE_MAX_AGE_HOURS = int(os.getenv('TEMP_IMAGE_MAX_AGE_HOURS', '24'))
+TEMP_CLEANUP_INTERVAL = float(os.getenv('TEMP_CLEANUP_INTERVAL', '3600'))
+job_scheduler.schedule(
+    'cleanup_old_temp_images',
+    TEMP_CLEANUP_INTERVAL,
+    lambda: cloudinary_helper.cleanup_old_temp_images(TEMP_IMAGE_MAX_AGE_HOURS)
+)
+
+# Resolve every enabled backend's model version up front and keep them fresh
+# off the request path (the result cache lookup checks each of them)
+if os.getenv('REPLICATE_API_TOKEN'):
+    for backend_name in face_backends.router.names:
+        replicate_helper.start_version_refresher(backend_name)
+    # Optional keep-alive predictions against cold starts (WARMUP_ENABLED=1)
+    replicate_helper.start_warmup_scheduler()
+
+# With webhooks enabled, only poll Replicate if no delivery arrived by then (seconds)
+WEBHOOK_FALLBACK_POLL = float(os.getenv('WEBHOOK_FALLBACK_POLL', '90'))
+
+# Long-poll (/wait-status): longest hold per request and the re-check interval
+# used when no webhook is available to wake the waiter (seconds)
+LONG_POLL_TIMEOUT = float(os.getenv('LONG_POLL_TIMEOUT', '25'))
+LONG_POLL_INTERVAL = float(os.getenv('LONG_POLL_INTERVAL', '2'))
+
+# Requests a worker holds open at once; each occupies a gunicorn thread, so
+# keep this below --threads to leave room for /swap-face and uploads. Past
+# the cap /wait-status answers at once and the kiosk short-polls instead.
+LONG_POLL_MAX_WAITERS = int(os.getenv('LONG_POLL_MAX_WAITERS', '4'))
+long_poll_slots = threading.BoundedSemaphore(LONG_POLL_MAX_WAITERS)
+
+# Notified whenever a prediction's status changes (wakes /wait-status)
+status_changed = threading.Condition()
+
+
+def on_poller_finished(prediction_id, prediction_data, status_info):
+    """Free the admission slot, record the outcome, stop a hedge loser and wake /wait-status once the poller sees a prediction finish."""
+    admission_queue.finish(prediction_id)
+    record_backend_outcome(prediction_data, status_info)
+    prediction_hedger.cancel_loser(prediction_store, prediction_id, status_info)
+    with status_changed:
+        status_changed.notify_all()
+
+
+# One background poller refreshes all active predictions; status checks read the store
+status_poller.start_poller(prediction_store, WEBHOOK_FALLBACK_POLL, on_poller_finished)
+
+# Build the face detector pool now (each gunicorn worker imports the app at
+# start), not on the first request
+face_mask_generator.init_detector_pool()
+
+# Shared worker pool for the independent swap_face stages (uploads, mask)
+STAGE_WORKERS = int(os.getenv('STAGE_WORKERS', '8'))
+stage_pool = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='swap-stage')
+
+# Per-stage timeouts in seconds
+UPLOAD_STAGE_TIMEOUT = float(os.getenv('UPLOAD_STAGE_TIMEOUT', '20'))
+MASK_STAGE_TIMEOUT = float(os.getenv('MASK_STAGE_TIMEOUT', '10'))
+
+# Seconds a kiosk is asked to wait when every face detector stayed busy
+DETECTOR_BUSY_RETRY_AFTER = 2
+
+# Seconds a finished /swap-face response is replayed for the same
+# Idempotency-Key, and a finished prediction's result for late pollers
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '900'))
+
+# Seconds a duplicate request waits for the in-flight original to answer
+SINGLE_FLIGHT_WAIT = float(os.getenv('SINGLE_FLIGHT_WAIT', '45'))
+
+# Seconds a leader's pending claim lasts: longer than its worst case (a
+# detector wait, the upload and mask stages, waiting on another leader),
+# so a duplicate never finds it lapsed and starts a second prediction
+SINGLE_FLIGHT_PENDING_TTL = 2 * MASK_STAGE_TIMEOUT + UPLOAD_STAGE_TIMEOUT + SINGLE_FLIGHT_WAIT + 30
+
+# Longest gap between a waiting duplicate's checks (a leader in another
+# worker cannot wake it)
+SINGLE_FLIGHT_MAX_BACKOFF = 1.0
 
 
 @app.before_request
@@ -40,6 +153,13 @@ def log_request_info():
         print(f"[ERROR] Error in before_request: {e}", flush=True)
 
 
+@app.errorhandler(413)
+def handle_request_too_large(e):
+    """Return a JSON error when an upload exceeds MAX_CONTENT_LENGTH"""
+    print(f"[ERROR] Upload rejected: larger than {MAX_UPLOAD_MB} MB", flush=True)
+    return jsonify({'error': f'Photo is too large (limit is {MAX_UPLOAD_MB} MB)'}), 413
+
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     """Global error handler for all unhandled exceptions"""
@@ -66,112 +186,467 @@ def handle_exception(e):
 @app.route('/')
 def index():
     """Serve the main page"""
-    return render_template('index.html')
+    return render_template('index.html', characters=character_registry.registry.listed())
+
+
+def read_swap_request():
+    """
+    Extract (image_bytes, character) from a /swap-face request.
+
+    Supported forms:
+    - multipart/form-data: 'child_photo' file part + 'character' field
+    - raw image body (image/* or application/octet-stream): character in
+      the ?character= query string or the X-Character header
+    - legacy JSON: {'child_photo': 'data:image/png;base64,...', 'character': ...}
+
+    Returns:
+        Tuple of (image_bytes, character); either may be None if missing
+    """
+    content_type = request.mimetype or ''
+
+    if content_type == 'multipart/form-data':
+        photo = request.files.get('child_photo')
+        image_bytes = photo.read() if photo else None
+        return image_bytes, request.form.get('character')
+
+    if content_type.startswith('image/') or content_type == 'application/octet-stream':
+        character = request.args.get('character') or request.headers.get('X-Character')
+        return request.get_data(cache=False), character
+
+    # Legacy kiosks: base64 data URL inside JSON
+    data = request.get_json(silent=True)
+    if not data or 'child_photo' not in data:
+        return None, (data or {}).get('character')
+
+    child_photo_b64 = data['child_photo']
+    if ',' in child_photo_b64:
+        child_photo_b64 = child_photo_b64.split(',', 1)[1]  # Remove data:image/png;base64,
+    return base64.b64decode(child_photo_b64), data.get('character')
+
+
+def run_mask_stage(image, face=None):
+    """
+    Generate the face mask and upload it to Cloudinary.
+    Runs on the stage pool alongside the child photo upload.
+    `face` is the box from the quality gate, if it already ran detection.
+    
+    Returns:
+        Upload result dict ('url', 'public_id') or None if no mask is available
+    """
+    try:
+        with face_mask_generator.acquire_mask_generator(timeout=MASK_STAGE_TIMEOUT) as mask_generator:
+            mask_bytes = mask_generator.generate_mask_from_image(image, face)
+    except Exception as mask_err:
+        print(f"[WARNING] Mask generation error: {mask_err}. Proceeding without mask...", flush=True)
+        return None
+    
+    if not mask_bytes:
+        print("[WARNING] Face mask generation failed (no face detected). Proceeding without mask...", flush=True)
+        return None
+    
+    print("[STEP 3] Uploading mask to Cloudinary...", flush=True)
+    mask_upload_result = cloudinary_helper.upload_temp_image(mask_bytes)
+    if not mask_upload_result:
+        print("[WARNING] Mask upload failed. Proceeding without mask...", flush=True)
+    return mask_upload_result
+
+
+def discard_late_upload(future):
+    """
+    Delete whatever an abandoned upload stage eventually uploads, so a
+    timed-out stage does not leave a temp image behind.
+    """
+    def _cleanup(done_future):
+        try:
+            result = done_future.result()
+        except Exception:
+            return
+        if result and result.get('public_id'):
+            cleanup_queue.enqueue([result['public_id']])
+    
+    future.add_done_callback(_cleanup)
+
+
+def join_in_flight(alias):
+    """
+    Claim an alias for this request, or wait for the request holding it.
+    
+    The first request to claim the alias is the leader and does the work;
+    duplicates (same Idempotency-Key, or the same capture + character while
+    the original is still running) wait for the leader's response instead of
+    starting a second upload and prediction. If the leader fails, its alias
+    is dropped and one waiting duplicate takes over.
+    
+    Returns:
+        None if this request is the leader, otherwise a (payload, code)
+        tuple to answer with
+    """
+    deadline = time.time() + SINGLE_FLIGHT_WAIT
+    waited = False
+    backoff = 0.1
+    
+    while True:
+        existing = prediction_store.claim_alias(alias, {'pending': True}, time.time() + SINGLE_FLIGHT_PENDING_TTL)
+        if existing is None:
+            return None
+        if not existing.get('pending'):
+            if waited:
+                print(f"[DEDUP] Joined in-flight request {alias[:40]}...", flush=True)
+            else:
+                print(f"[DEDUP] Replaying response for {alias[:40]}...", flush=True)
+            return existing['payload'], existing['code']
+        if time.time() >= deadline:
+            return {'error': 'An identical request is still being processed'}, 409
+        waited = True
+        # Woken by publish_in_flight() in this worker, else checks again with backoff
+        with status_changed:
+            status_changed.wait(timeout=min(backoff, max(deadline - time.time(), 0)))
+        backoff = min(backoff * 2, SINGLE_FLIGHT_MAX_BACKOFF)
+
+
+def publish_in_flight(aliases, payload, code):
+    """
+    Hand the leader's response to its duplicates. Only successful responses
+    are kept; on errors the aliases are dropped so a retry does the work again.
+    
+    Args:
+        aliases: Dict of alias -> expires_at claimed by this request
+        payload: Response body
+        code: HTTP status code
+    """
+    for alias, expires_at in aliases.items():
+        if code < 400:
+            prediction_store.set_alias(alias, {'payload': payload, 'code': code}, expires_at)
+        else:
+            prediction_store.delete_alias(alias)
+    if aliases:
+        # Wake duplicates waiting in join_in_flight()
+        with status_changed:
+            status_changed.notify_all()
+
+
+def get_client_id():
+    """Fairness key for the admission queue: the kiosk's ID, else its address."""
+    kiosk_id = request.headers.get('X-Kiosk-Id', '').strip()
+    if kiosk_id:
+        return kiosk_id[:64]
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    return forwarded.split(',')[0].strip() or request.remote_addr or 'unknown'
+
+
+def queue_full_response(respond):
+    """503 with Retry-After when the admission queue cannot take the job."""
+    retry_after = int(admission_queue.average_duration())
+    print(f"[ADMISSION] Queue full, asking client to retry in {retry_after}s", flush=True)
+    response, code = respond({
+        'error': 'The photo booth is busy right now. Please try again in a moment.',
+        'retry_after': retry_after
+    }, 503)
+    response.headers['Retry-After'] = str(retry_after)
+    return response, code
+
+
+def detectors_busy_response(respond):
+    """503 with Retry-After when no face detector freed up within MASK_STAGE_TIMEOUT."""
+    print(f"[FaceMask] All detectors busy, asking client to retry in {DETECTOR_BUSY_RETRY_AFTER}s", flush=True)
+    response, code = respond({
+        'error': 'The photo booth is busy right now. Please try again in a moment.',
+        'retry_after': DETECTOR_BUSY_RETRY_AFTER
+    }, 503)
+    response.headers['Retry-After'] = str(DETECTOR_BUSY_RETRY_AFTER)
+    return response, code
+
+
+def find_cached_result(capture_key, character_entry):
+    """
+    Stored result for a capture from any enabled backend, at the model
+    version it would run on now. A backend whose version is not cached yet
+    counts as a miss rather than a lookup on the request path.
+    
+    Returns:
+        Result URL, or None on a miss
+    """
+    for name in face_backends.router.names:
+        version_id = face_backends.get_backend(name).current_version(character_entry)
+        if not version_id:
+            continue
+        cached_url = result_cache.get(result_cache_module.make_cache_key(capture_key, name, version_id))
+        if cached_url:
+            return cached_url
+    return None
+
+
+def store_cached_result(prediction_data, status_info, result_url):
+    """Cache a result under the backend and version that produced it (the hedge's, if it won)."""
+    backend, version_id = prediction_data.get('backend'), prediction_data.get('version')
+    if prediction_data.get('hedge_id') and status_info.get('prediction_id') == prediction_data['hedge_id']:
+        backend, version_id = prediction_data.get('hedge_backend'), prediction_data.get('hedge_version')
+    if prediction_data.get('capture_key') and backend and version_id:
+        result_cache.put(
+            result_cache_module.make_cache_key(prediction_data['capture_key'], backend, version_id),
+            result_url
+        )
+
+
+def launch_swap_job(job_id, job):
+    """
+    Start the Replicate prediction for a queued job (admission dispatcher).
+    
+    Returns:
+        Prediction ID, or None to retry later
+    """
+    print(f"[ADMISSION] Starting {job_id}...", flush=True)
+    prediction_info = face_backends.router.start(
+        child_image_url=job['child_image_url'],
+        mask_image_url=job['mask_image_url'],
+        character=job['character']
+    )
+    
+    if not prediction_info:
+        return None
+    
+    prediction_id = prediction_info['prediction_id']
+    
+    # Store prediction info for cleanup later
+    prediction_store.create(prediction_id, {
+        'child_cloudinary_id': job['child_cloudinary_id'],
+        'mask_cloudinary_id': job['mask_cloudinary_id'],
+        'character': job['character'],
+        'status': 'processing',
+        'created_at': prediction_info['created_at'],
+        'expires_at': prediction_info['created_at'] + PREDICTION_TTL,
+        'webhook': prediction_info.get('webhook', False),
+        'capture_key': job.get('capture_key'),
+        'job_id': job_id,
+        'backend': prediction_info['backend'],
+        'version': prediction_info.get('version'),
+        'inputs': {         # Lets prediction_hedger start an identical hedge
+            'child_image_url': job['child_image_url'],
+            'mask_image_url': job['mask_image_url']
+        },
+        'status_info': None     # Filled in by /replicate-webhook
+    })
+    
+    print(f"[SUCCESS] Prediction started: {prediction_id} for {job_id} on {prediction_info['backend']}", flush=True)
+    
+    with status_changed:
+        status_changed.notify_all()
+    return prediction_id
+
+
+def abandon_swap_job(job_id, job, error):
+    """Give up on a job that could not be started: free its images and claims."""
+    cleanup_queue.enqueue([job['child_cloudinary_id'], job['mask_cloudinary_id']])
+    if job.get('capture_key'):
+        prediction_store.delete_alias(f"flight:{job['capture_key']}")
+    
+    with status_changed:
+        status_changed.notify_all()
+
+
+admission_queue.start_dispatcher(launch_swap_job, abandon_swap_job)
 
 
 @app.route('/swap-face', methods=['POST'])
 def swap_face():
     """
     Start face swap process:
+    0. Normalize photo (orientation, downscale, compact JPEG/WebP),
+       reject bad captures (no face, too small, blurry, badly exposed)
+       and crop a padded square around the face as the swap source
     1. Upload child photo to Cloudinary
-    2. Generate face mask (for compatibility, not used by current model)
-    3. Upload mask to Cloudinary
-    4. Start Replicate prediction with lucataco/faceswap
-    5. Return prediction ID for polling
+    2. Generate face mask (only if the model declares a mask input)
+    3. Upload mask to Cloudinary (same condition)
+    4. Queue the Replicate prediction (admission_queue starts it once a
+       slot is free, fairly across kiosks)
+    5. Return the job ID for polling, with queue position and ETA
+    
+    Duplicates share one prediction: a retry with the same Idempotency-Key
+    header, or the same capture + character while the original is still
+    in flight, gets the original's response instead of starting new work.
     """
     print("=" * 60, flush=True)
     print("FACE SWAP REQUEST RECEIVED", flush=True)
     print("=" * 60, flush=True)
     
+    # Aliases this request leads (alias -> expires_at), answered in respond()
+    claimed_aliases = {}
+    
+    def respond(payload, code=200):
+        publish_in_flight(claimed_aliases, payload, code)
+        return jsonify(payload), code
+    
     try:
-        data = request.get_json()
+        idempotency_key = request.headers.get('Idempotency-Key', '').strip()
+        if idempotency_key:
+            alias = f"idem:{idempotency_key}"
+            joined = join_in_flight(alias)
+            if joined:
+                payload, code = joined
+                return jsonify(payload), code
+            claimed_aliases[alias] = time.time() + IDEMPOTENCY_TTL
+        
+        child_image_bytes, character = read_swap_request()
         
-        if not data or 'child_photo' not in data or 'character' not in data:
+        if not child_image_bytes or not character:
             print("[ERROR] Missing required fields", flush=True)
-            return jsonify({'error': 'Missing required fields: child_photo and character'}), 400
+            return respond({'error': 'Missing required fields: child_photo and character'}, 400)
         
-        # Decode child photo from base64
-        child_photo_b64 = data['child_photo'].split(',')[1]  # Remove data:image/png;base64,
-        child_image_bytes = base64.b64decode(child_photo_b64)
-        character = data['character']
+        # Reject unknown characters before any work; aliases map to the canonical ID
+        try:
+            character_entry = character_registry.registry.get(character)
+        except character_registry.UnknownCharacterError:
+            return respond({'error': f'Unknown character: {character}'}, 400)
+        character = character_entry.id
         
         print(f"[INFO] Character: {character}", flush=True)
         print(f"[INFO] Image size: {len(child_image_bytes)} bytes", flush=True)
         
-        # Step 1: Upload child photo to Cloudinary
+        # Step 0: Decode once, fix orientation, downscale and re-encode
+        print("[STEP 0] Normalizing photo...", flush=True)
+        normalized = image_normalizer.normalize_photo(child_image_bytes)
+        
+        if not normalized:
+            return respond({'error': 'Could not read the photo. Please retake it.'}, 400)
+        
+        # Everything downstream uses the normalized photo
+        child_image_bytes = normalized['bytes']
+        
+        # Quality gate: reject bad captures before any upload or paid prediction
+        face_box = None
+        if face_quality.FACE_QUALITY_GATE:
+            with face_mask_generator.acquire_mask_generator(timeout=MASK_STAGE_TIMEOUT) as detector:
+                face_box = detector.detect_face(normalized['array'])
+            
+            quality_failure = face_quality.check_face_quality(normalized['array'], face_box)
+            if quality_failure:
+                return respond(quality_failure, 422)
+        
+        # Send a face-centred crop instead of the whole frame
+        swap_source = normalized
+        if image_normalizer.FACE_CROP:
+            if face_box is None and not face_quality.FACE_QUALITY_GATE:
+                with face_mask_generator.acquire_mask_generator(timeout=MASK_STAGE_TIMEOUT) as detector:
+                    face_box = detector.detect_face(normalized['array'])
+            
+            if face_box is not None:
+                swap_source = image_normalizer.crop_face(normalized['array'], face_box)
+                face_box = swap_source['face']
+                child_image_bytes = swap_source['bytes']
+            else:
+                print("[WARNING] No face to crop around. Sending the full frame...", flush=True)
+        
+        # Resubmitted capture? Return the stored result without a new prediction
+        capture_key = result_cache_module.make_capture_key(
+            child_image_bytes, character, character_hash=character_entry.content_hash
+        )
+        cached_url = find_cached_result(capture_key, character_entry)
+        if cached_url:
+            print(f"[CACHE] Hit for {character}: {cached_url[:50]}...", flush=True)
+            return respond({
+                'status': 'succeeded',
+                'result_url': cached_url,
+                'cached': True
+            })
+        
+        # Same capture + character already running? Attach to it
+        alias = f"flight:{capture_key}"
+        joined = join_in_flight(alias)
+        if joined:
+            # Also answers this request's Idempotency-Key, if any
+            return respond(*joined)
+        claimed_aliases[alias] = time.time() + PREDICTION_TTL
+        
+        # Turn overload into a wait the kiosk can show, before paying for uploads
+        client_id = get_client_id()
+        if not admission_queue.has_room(client_id):
+            return queue_full_response(respond)
+        
+        # Steps 1-3 run concurrently: the child upload is network-bound while
+        # mask generation is CPU-bound, so they overlap on the stage pool
         print("[STEP 1] Uploading child photo to Cloudinary...", flush=True)
-        upload_result = cloudinary_helper.upload_temp_image(child_image_bytes)
+        upload_future = stage_pool.submit(cloudinary_helper.upload_temp_image, child_image_bytes)
+        
+        # Only backends that declare a mask input pay for detection + mask upload
+        mask_future = None
+        if face_backends.router.needs_mask():
+            print("[STEP 2] Generating face mask...", flush=True)
+            mask_future = stage_pool.submit(run_mask_stage, swap_source['array'], face_box)
+        else:
+            print("[STEP 2] Skipping face mask (not used by this model)", flush=True)
+        
+        try:
+            upload_result = upload_future.result(timeout=UPLOAD_STAGE_TIMEOUT)
+        except FutureTimeoutError:
+            print(f"[ERROR] Child upload timed out after {UPLOAD_STAGE_TIMEOUT}s", flush=True)
+            discard_late_upload(upload_future)
+            if mask_future:
+                discard_late_upload(mask_future)
+            return respond({'error': 'Timed out uploading image to cloud storage'}, 504)
         
         if not upload_result:
-            return jsonify({'error': 'Failed to upload image to cloud storage'}), 500
+            if mask_future:
+                discard_late_upload(mask_future)
+            return respond({'error': 'Failed to upload image to cloud storage'}, 500)
         
         child_image_url = upload_result['url']
         child_public_id = upload_result['public_id']
         
         print(f"[SUCCESS] Child image uploaded: {child_image_url[:50]}...", flush=True)
         
-        # Step 2: Generate face mask
-        print("[STEP 2] Generating face mask...", flush=True)
-        from face_mask_generator import get_mask_generator
-        mask_bytes = None
-        try:
-            mask_generator = get_mask_generator()
-            mask_bytes = mask_generator.generate_mask(child_image_bytes)
-            if not mask_bytes:
-                print("[WARNING] Face mask generation failed (no face detected). Proceeding without mask...", flush=True)
-        except Exception as mask_err:
-            print(f"[WARNING] Mask generation error: {mask_err}. Proceeding without mask...", flush=True)
-        
-        # Step 3: Upload mask to Cloudinary (if generated)
+        # Join the mask stage (optional: proceed without it on failure/timeout)
         mask_image_url = ""
         mask_public_id = ""
         
-        if mask_bytes:
-            print("[STEP 3] Uploading mask to Cloudinary...", flush=True)
-            mask_upload_result = cloudinary_helper.upload_temp_image(mask_bytes)
-            
-            if mask_upload_result:
-                mask_image_url = mask_upload_result['url']
-                mask_public_id = mask_upload_result['public_id']
-                print(f"[SUCCESS] Mask uploaded: {mask_image_url[:50]}...", flush=True)
-            else:
-                print("[WARNING] Mask upload failed. Proceeding without mask...", flush=True)
-        else:
-            print("[INFO] Skipping mask upload (no mask available)", flush=True)
-        
-        # Step 4: Start Replicate prediction with SDXL IP-Adapter FaceID
-        print("[STEP 4] Starting AI face blending...", flush=True)
-        prediction_info = replicate_helper.start_face_generation(
-            child_image_url=child_image_url,
-            mask_image_url=mask_image_url,
-            character=character
-        )
-        
-        if not prediction_info:
-            # Cleanup uploaded images
-            cloudinary_helper.delete_temp_image(child_public_id)
-            cloudinary_helper.delete_temp_image(mask_public_id)
-            return jsonify({'error': 'Failed to start AI processing'}), 500
+        mask_upload_result = None
+        if mask_future:
+            try:
+                mask_upload_result = mask_future.result(timeout=MASK_STAGE_TIMEOUT)
+            except FutureTimeoutError:
+                print(f"[WARNING] Mask stage timed out after {MASK_STAGE_TIMEOUT}s. Proceeding without mask...", flush=True)
+                discard_late_upload(mask_future)
         
-        prediction_id = prediction_info['prediction_id']
+        if mask_upload_result:
+            mask_image_url = mask_upload_result['url']
+            mask_public_id = mask_upload_result['public_id']
+            print(f"[SUCCESS] Mask uploaded: {mask_image_url[:50]}...", flush=True)
         
-        # Store prediction info for cleanup later
-        active_predictions[prediction_id] = {
+        # Step 4: Queue the prediction start (the dispatcher starts it when
+        # a slot is free, fairly across kiosks)
+        print("[STEP 4] Queueing AI face blending...", flush=True)
+        job_id = admission_queue.enqueue(client_id, {
+            'child_image_url': child_image_url,
+            'mask_image_url': mask_image_url,
             'child_cloudinary_id': child_public_id,
             'mask_cloudinary_id': mask_public_id,
             'character': character,
-            'status': 'processing'
-        }
+            'capture_key': capture_key
+        })
+        
+        if not job_id:
+            # Filled up while we were uploading: clean up in the background
+            cleanup_queue.enqueue([child_public_id, mask_public_id])
+            return queue_full_response(respond)
         
-        print(f"[SUCCESS] Prediction started: {prediction_id}", flush=True)
+        job = admission_queue.get_job(job_id) or {}
+        print(f"[SUCCESS] Job queued: {job_id} (position {job.get('queue_position')})", flush=True)
         print("=" * 60, flush=True)
         
-        return jsonify({
-            'prediction_id': prediction_id,
-            'status': 'processing',
-            'message': 'Face blending started. Poll /check-status to get updates.'
+        return respond({
+            'prediction_id': job_id,
+            'status': 'queued' if job.get('state') == 'queued' else 'processing',
+            'queue_position': job.get('queue_position'),
+            'eta_seconds': job.get('eta_seconds'),
+            'message': 'Face blending queued. Poll /check-status to get updates.'
         })
         
+    except RequestEntityTooLarge:
+        # Let the 413 handler answer instead of reporting a server error
+        publish_in_flight(claimed_aliases, None, 413)
+        raise
+    except queue.Empty:
+        # Quality gate / face crop could not borrow a detector in time
+        return detectors_busy_response(respond)
     except Exception as e:
         print(f"[ERROR] Exception in swap_face: {str(e)}", flush=True)
         import traceback
@@ -186,32 +661,203 @@ def swap_face():
             f.write(f"Error: {str(e)}\n")
             f.write(f"Traceback:\n{tb_str}\n")
         
-        return jsonify({'error': f'Server error: {str(e)}'}), 500
+        return respond({'error': f'Server error: {str(e)}'}, 500)
 
 
-@app.route('/check-status/<prediction_id>', methods=['GET'])
-def check_status(prediction_id):
+def get_local_status(prediction_data):
     """
-    Check the status of a face generation prediction.
-    In sync mode, results are returned immediately.
+    Answer a status check from local state when the prediction reports via webhook.
+    
+    Returns:
+        Status dict (same shape as check_prediction_status), or None when the
+        caller should poll Replicate instead (no webhook configured, or no
+        delivery within WEBHOOK_FALLBACK_POLL seconds)
+    """
+    if prediction_data.get('status_info'):
+        return prediction_data['status_info']
+    
+    if not prediction_data.get('webhook'):
+        return None
+    
+    # Safety net for lost deliveries: fall back to polling after a while
+    age = time.time() - prediction_data.get('created_at', time.time())
+    if age > WEBHOOK_FALLBACK_POLL:
+        return None
+    
+    return {'status': prediction_data.get('status', 'processing')}
+
+
+def fetch_prediction_status(prediction_id, prediction_data):
+    """
+    Status of one prediction: from local state when a webhook or the
+    background poller keeps it current, otherwise by asking the backend
+    that runs it.
+    
+    Returns:
+        Status dict (always carrying 'prediction_id'), or None on failure
+    """
+    status_info = get_local_status(prediction_data)
+    
+    if status_info is None and status_poller.is_fresh(prediction_data):
+        # The background poller keeps the stored status current
+        status_info = {'status': prediction_data.get('status', 'processing')}
+    
+    if status_info is None:
+        # Nothing local to rely on: ask the provider directly
+        backend = face_backends.get_backend(prediction_data.get('backend'))
+        status_info = backend.status(prediction_id)
+        if status_info and status_info['status'] in ('succeeded', 'failed', 'canceled'):
+            record_backend_outcome(prediction_data, status_info)
+    
+    if not status_info:
+        return None
+    return dict(status_info, prediction_id=prediction_id)
+
+
+@app.route('/replicate-webhook', methods=['POST'])
+def replicate_webhook():
+    """
+    Receive prediction completion events from Replicate.
+    Verifies the webhook signature and stores the final status locally so
+    /check-status can answer without calling Replicate.
+    """
+    body = request.get_data()
+    
+    if not replicate_helper.verify_webhook_signature(request.headers, body):
+        print("[WEBHOOK] Invalid signature", flush=True)
+        return jsonify({'error': 'Invalid signature'}), 401
+    
+    payload = request.get_json(force=True, silent=True) or {}
+    prediction_id = payload.get('id')
+    status = payload.get('status')
+    print(f"[WEBHOOK] {prediction_id}: {status}", flush=True)
+    
+    fields = {'status': status}
+    if status in ('succeeded', 'failed', 'canceled'):
+        # Free the admission slot now, not when the kiosk next polls
+        admission_queue.finish(prediction_id)
+        prediction_data = prediction_store.get(prediction_id) or {}
+        backend = face_backends.get_backend(prediction_data.get('backend'))
+        fields['status_info'] = replicate_helper.build_status_info(
+            prediction_id,
+            status,
+            output=payload.get('output'),
+            error=payload.get('error'),
+            timings=payload,
+            parse_output=backend.parse_output
+        )
+    
+    if prediction_store.update(prediction_id, **fields) is None:
+        # Unknown or already finished: acknowledge so Replicate stops retrying
+        return jsonify({'received': True, 'known': False})
+    
+    if 'status_info' in fields and not prediction_data.get('status_info'):
+        # First report of the final status (the poller may have seen it already)
+        record_backend_outcome(prediction_data, fields['status_info'])
+        prediction_hedger.cancel_loser(prediction_store, prediction_id, fields['status_info'])
+    
+    # Wake any /wait-status long-polls
+    with status_changed:
+        status_changed.notify_all()
+    
+    return jsonify({'received': True, 'known': True})
+
+
+def cleanup_prediction_images(prediction_data):
+    """
+    Queue a finished prediction's temp images for deletion.
+    The cleanup queue worker deletes them in bulk, so the kiosk does not
+    wait on Cloudinary before getting its result.
+    """
+    queued = cleanup_queue.enqueue([
+        prediction_data.get('child_cloudinary_id'),
+        prediction_data.get('mask_cloudinary_id')
+    ])
+    if queued:
+        print(f"[CLEANUP] Queued {queued} temp images for deletion", flush=True)
+
+
+def record_backend_outcome(prediction_data, status_info):
+    """
+    Feed a finished prediction's outcome to the backend router, with the
+    run time the provider reported (started_at to completed_at). Called
+    where the final status is first seen: the poller, the webhook, or a
+    direct status check.
+    """
+    if status_info['status'] == 'canceled':
+        # Canceled by us (hedge loser, reaper): says nothing about the backend
+        return
+    face_backends.router.record(
+        prediction_data.get('backend'),
+        ok=status_info['status'] == 'succeeded' and bool(status_info.get('result_url')),
+        seconds=status_info.get('run_seconds')
+    )
+
+
+def resolve_status(prediction_id):
+    """
+    Resolve the status of a face generation prediction and clean up its
+    temp images once it is finished.
+    Answers from local state kept current by webhooks or the background
+    poller; only polls the provider when neither has fresh state.
+    
+    Returns:
+        Tuple of (response dict, HTTP status code)
     """
     try:
         print(f"[POLL] Checking status for: {prediction_id}", flush=True)
         
-        if prediction_id not in active_predictions:
-            return jsonify({'error': 'Prediction not found'}), 404
+        if admission_queue.is_job_id(prediction_id):
+            job = admission_queue.get_job(prediction_id)
+            if job is None:
+                return {'error': 'Prediction not found'}, 404
+            if job['state'] == 'queued':
+                return {
+                    'status': 'queued',
+                    'queue_position': job['queue_position'],
+                    'eta_seconds': job['eta_seconds']
+                }, 200
+            if job['state'] == 'failed':
+                return {'status': 'failed', 'error': job['error']}, 200
+            if not job['prediction_id']:
+                # Being started right now
+                return {'status': 'starting'}, 200
+            prediction_id = job['prediction_id']
+        
+        prediction_data = prediction_store.get(prediction_id)
+        if prediction_data is None:
+            # Already finished and claimed by another poller?
+            finished = prediction_store.get_alias(f"result:{prediction_id}")
+            if finished:
+                return finished['payload'], finished['code']
+            return {'error': 'Prediction not found'}, 404
         
-        # Check Replicate status
-        status_info = replicate_helper.check_prediction_status(prediction_id)
+        status_info = fetch_prediction_status(prediction_id, prediction_data)
         
         if not status_info:
-            return jsonify({'error': 'Failed to check prediction status'}), 500
+            return {'error': 'Failed to check prediction status'}, 500
+        
+        # Hedged by the poller? The first success of the two answers
+        hedge_id = prediction_data.get('hedge_id')
+        if hedge_id:
+            hedge_data = prediction_store.get(hedge_id)
+            hedge_info = fetch_prediction_status(hedge_id, hedge_data) if hedge_data else None
+            status_info = prediction_hedger.combine(status_info, hedge_info)
         
         status = status_info['status']
-        prediction_data = active_predictions[prediction_id]
         
-        # Update stored status
-        prediction_data['status'] = status
+        claimed = None
+        if status not in ('succeeded', 'failed', 'canceled'):
+            # Update stored status
+            prediction_store.update(prediction_id, status=status)
+        else:
+            # Claim the finished prediction: only the request that removes it
+            # from the store cleans up its temp images (child and mask)
+            claimed = prediction_store.pop(prediction_id)
+            if claimed is not None:
+                cleanup_prediction_images(claimed)
+                admission_queue.finish(prediction_id)
+                prediction_hedger.settle(prediction_store, claimed, status_info)
         
         if status == 'succeeded':
             print(f"[SUCCESS] Prediction completed: {prediction_id}", flush=True)
@@ -220,66 +866,101 @@ def check_status(prediction_id):
             # Validate that we have a result URL
             if not result_url:
                 print(f"[ERROR] No result URL in status_info: {status_info}", flush=True)
-                return jsonify({
+                payload, code = {
                     'error': 'Failed to generate result - no output URL received from AI model'
-                }), 500
-            
-            print(f"[SUCCESS] Result URL: {result_url}", flush=True)
-            
-            # Cleanup Cloudinary images (both child and mask)
-            child_id = prediction_data.get('child_cloudinary_id')
-            mask_id = prediction_data.get('mask_cloudinary_id')
-            
-            if child_id:
-                print(f"[CLEANUP] Deleting child image...", flush=True)
-                cloudinary_helper.delete_temp_image(child_id)
-            
-            if mask_id:
-                print(f"[CLEANUP] Deleting mask image...", flush=True)
-                cloudinary_helper.delete_temp_image(mask_id)
-            
-            # Remove from active predictions
-            del active_predictions[prediction_id]
-            
-            return jsonify({
-                'status': 'succeeded',
-                'result_url': result_url
-            })
+                }, 500
+            else:
+                print(f"[SUCCESS] Result URL: {result_url}", flush=True)
+                
+                store_cached_result(prediction_data, status_info, result_url)
+                
+                payload, code = {
+                    'status': 'succeeded',
+                    'result_url': result_url
+                }, 200
         
-        elif status == 'failed':
-            print(f"[FAILED] Prediction failed: {prediction_id}", flush=True)
+        elif status in ('failed', 'canceled'):
+            print(f"[FAILED] Prediction {status}: {prediction_id}", flush=True)
             error_msg = status_info.get('error', 'Unknown error')
             
-            # Cleanup
-            child_id = prediction_data.get('child_cloudinary_id')
-            mask_id = prediction_data.get('mask_cloudinary_id')
-            
-            if child_id:
-                cloudinary_helper.delete_temp_image(child_id)
-            
-            if mask_id:
-                cloudinary_helper.delete_temp_image(mask_id)
-            
-            del active_predictions[prediction_id]
-            
-            return jsonify({
+            payload, code = {
                 'status': 'failed',
                 'error': error_msg
-            })
+            }, 200
         
         else:
             # Shouldn't happen in sync mode, but handle it
-            return jsonify({
+            return {
                 'status': status
-            })
+            }, 200
+        
+        if claimed is not None:
+            # Other pollers sharing this prediction (deduplicated requests)
+            # still get the result after the entry is gone
+            prediction_store.set_alias(
+                f"result:{prediction_id}", {'payload': payload, 'code': code},
+                time.time() + IDEMPOTENCY_TTL
+            )
+            # The capture is no longer in flight: the result cache (or a
+            # fresh attempt after a failure) takes over
+            if claimed.get('capture_key'):
+                prediction_store.delete_alias(f"flight:{claimed['capture_key']}")
+        
+        return payload, code
         
     except Exception as e:
-        print(f"[ERROR] Exception in check_status: {str(e)}", flush=True)
+        print(f"[ERROR] Exception in resolve_status: {str(e)}", flush=True)
         import traceback
         traceback.print_exc()
-        return jsonify({'error': f'Server error: {str(e)}'}), 500
+        return {'error': f'Server error: {str(e)}'}, 500
+
+
+@app.route('/check-status/<prediction_id>', methods=['GET'])
+def check_status(prediction_id):
+    """
+    Check the status of a face generation prediction (one-shot poll).
+    """
+    payload, code = resolve_status(prediction_id)
+    return jsonify(payload), code
 
 
+@app.route('/wait-status/<prediction_id>', methods=['GET'])
+def wait_status(prediction_id):
+    """
+    Long-poll the status of a face generation prediction.
+    Holds the request until the prediction finishes or ?timeout= seconds
+    pass (capped at LONG_POLL_TIMEOUT), then answers like /check-status.
+    Webhook deliveries wake waiting requests in the same worker immediately;
+    waiters in other workers see the stored result on their next re-check.
+    When LONG_POLL_MAX_WAITERS requests are already held, answers at once
+    with poll_after (seconds) so the kiosk falls back to short polling.
+    """
+    try:
+        timeout = float(request.args.get('timeout', LONG_POLL_TIMEOUT))
+    except ValueError:
+        timeout = LONG_POLL_TIMEOUT
+    deadline = time.time() + max(0.0, min(timeout, LONG_POLL_TIMEOUT))
+    
+    if not long_poll_slots.acquire(blocking=False):
+        # All long-poll slots taken: answer now and have the kiosk come back
+        payload, code = resolve_status(prediction_id)
+        if code == 200 and payload.get('status') not in ('succeeded', 'failed'):
+            payload['poll_after'] = LONG_POLL_INTERVAL
+        return jsonify(payload), code
+    
+    try:
+        while True:
+            payload, code = resolve_status(prediction_id)
+            remaining = deadline - time.time()
+            
+            if code != 200 or payload.get('status') in ('succeeded', 'failed') or remaining <= 0:
+                return jsonify(payload), code
+            
+            # Sleep until a status change is announced or the next re-check is due
+            with status_changed:
+                status_changed.wait(timeout=min(remaining, LONG_POLL_INTERVAL))
+    finally:
+        long_poll_slots.release()
 
 
 @app.route('/generate-qr', methods=['POST'])
@@ -338,7 +1019,18 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'cloudinary': 'configured' if os.getenv('CLOUDINARY_API_KEY') else 'not configured',
-        'replicate': 'configured' if os.getenv('REPLICATE_API_TOKEN') else 'not configured'
+        'replicate': 'configured' if os.getenv('REPLICATE_API_TOKEN') else 'not configured',
+        'active_predictions': len(prediction_store),
+        'reaper': prediction_reaper.get_reaper_stats(),
+        'pending_deletes': cleanup_queue.pending_count(),
+        'admission': admission_queue.get_queue_stats(),
+        'model_latency': replicate_helper.get_latency_stats(),
+        'hedging': prediction_hedger.get_hedge_stats(),
+        'backends': face_backends.router.get_stats(),
+        'circuits': resilience.get_breaker_states(),
+        'characters': character_registry.registry.get_stats(),
+        'poller': status_poller.get_poller_stats(),
+        'jobs': job_scheduler.get_job_stats()
     })
 
 
@@ -0,0 +1,70 @@
+"""
+Benchmark FaceMaskGenerator detection scales at 720p, 1080p and 4K.
+
+Places a bundled character portrait into a frame of each size and times
+generate_mask_from_image at several detection scales (1.0 = full-resolution
+detection, the previous behaviour).
+
+Usage:
+    python benchmark_face_mask.py [runs]
+"""
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from face_mask_generator import FaceMaskGenerator
+
+PORTRAIT = 'static/characters/saudi_central_male_v6.png'
+RESOLUTIONS = [('720p', 1280, 720), ('1080p', 1920, 1080), ('4K', 3840, 2160)]
+SCALES = [1.0, 0.5, 0.25]
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+portrait = cv2.imread(PORTRAIT, cv2.IMREAD_COLOR)
+if portrait is None:
+    print(f"Could not read {PORTRAIT}")
+    sys.exit(1)
+
+
+def make_frame(width, height):
+    """Kiosk-like frame: portrait filling ~80% of the height on a grey background."""
+    frame = np.full((height, width, 3), 90, dtype=np.uint8)
+    target_h = int(height * 0.8)
+    target_w = int(portrait.shape[1] * target_h / portrait.shape[0])
+    resized = cv2.resize(portrait, (target_w, target_h), interpolation=cv2.INTER_AREA)
+    y0 = (height - target_h) // 2
+    x0 = (width - target_w) // 2
+    frame[y0:y0 + target_h, x0:x0 + target_w] = resized
+    return frame
+
+
+generators = {scale: FaceMaskGenerator(scale=scale) for scale in SCALES}
+
+print(f"\n{'='*60}")
+print(f"FACE MASK BENCHMARK ({runs} runs, median ms)")
+print(f"{'='*60}")
+print(f"{'Frame':<8}" + "".join(f"{'scale ' + str(s):>14}" for s in SCALES) + f"{'speedup':>10}")
+
+for label, width, height in RESOLUTIONS:
+    frame = make_frame(width, height)
+    medians = {}
+    found = {}
+    for scale, generator in generators.items():
+        generator.generate_mask_from_image(frame)  # warm-up
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            mask = generator.generate_mask_from_image(frame)
+            timings.append((time.perf_counter() - start) * 1000)
+        medians[scale] = sorted(timings)[len(timings) // 2]
+        found[scale] = mask is not None
+
+    row = f"{label:<8}"
+    for scale in SCALES:
+        row += f"{medians[scale]:>11.1f}{'' if found[scale] else ' !':<3}"
+    row += f"{medians[SCALES[0]] / medians[SCALES[-1]]:>9.1f}x"
+    print(row)
+
+print("\n(! = no face detected at that scale)")
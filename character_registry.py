@@ -0,0 +1,272 @@
+"""
+Character Registry Module
+Loads the characters a kiosk can pick from the manifest (characters.json)
+into an immutable registry, so adding or changing a character for an event
+is a manifest edit instead of a code change.
+
+Manifest layout:
+    {
+      "prompt_sets": {"<name>": {"prompt": ..., "negative_prompt": ...}},
+      "characters": [
+        {
+          "id": "superman",                   # canonical ID sent by the kiosk
+          "aliases": ["man_of_steel"],        # other accepted IDs (optional)
+          "prompt_set": "superhero",          # shared prompts (optional)
+          "prompt": "...",                    # overrides the prompt set
+          "negative_prompt": "...",
+          "template_image": "https://res.cloudinary.com/...",
+          "versions": {"<model>": "<version>"},  # per-model version pin (optional)
+          "card": {"label": "...", "alt": "...", "image": "/static/..."}  # shown on the kiosk grid (optional)
+        }
+      ]
+    }
+
+Prompts may be a string or a list of lines. IDs and aliases are matched
+case-insensitively; unknown IDs raise UnknownCharacterError instead of
+falling back to a default character.
+
+The manifest is re-read when its modification time changes (checked at most
+every CHARACTER_RELOAD_INTERVAL seconds), so edits apply to every worker
+without a restart. A manifest that fails to load leaves the previous
+registry in place.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+CHARACTER_MANIFEST_PATH = os.getenv(
+    'CHARACTER_MANIFEST_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'characters.json')
+)
+
+# Seconds between manifest modification checks
+CHARACTER_RELOAD_INTERVAL = float(os.getenv('CHARACTER_RELOAD_INTERVAL', '5'))
+
+# Cloudinary delivery URL: .../upload/[v<version>/]<public_id>.<ext>
+_CLOUDINARY_URL = re.compile(r'/upload/(?:v(\d+)/)?(.+?)(?:\.\w+)?$')
+
+
+class UnknownCharacterError(KeyError):
+    """Raised for a character ID that is neither registered nor an alias."""
+
+
+@dataclass(frozen=True, slots=True)
+class CharacterCard:
+    """How a character appears on the kiosk's selection grid."""
+
+    label: str
+    alt: str
+    image: str
+
+
+@dataclass(frozen=True, slots=True)
+class Character:
+    """One registered character, with everything derived at load time."""
+
+    id: str
+    prompt: str
+    negative_prompt: str
+    template_url: str
+    content_hash: str                         # Changes whenever the prompts or template change
+    template_public_id: Optional[str]         # Cloudinary public_id of the template
+    template_version: Optional[str]           # Cloudinary upload version of the template
+    versions: Tuple[Tuple[str, str], ...]     # (model_name, pinned version) pairs
+    aliases: Tuple[str, ...]
+    card: Optional[CharacterCard]             # Kiosk grid entry; None keeps it off the grid
+
+    def pinned_version(self, model_name: str) -> Optional[str]:
+        """Version pinned for this character on a model, if any."""
+        for name, version in self.versions:
+            if name == model_name:
+                return version
+        return None
+
+    def style_config(self) -> Dict[str, str]:
+        """Prompt/template dict in the shape replicate_helper.build_model_input takes."""
+        return {
+            'prompt': self.prompt,
+            'negative_prompt': self.negative_prompt,
+            'template_image': self.template_url,
+        }
+
+
+def _text(value: Any) -> str:
+    """Prompt text from a string or a list of lines, interned (shared prompts are stored once)."""
+    if isinstance(value, list):
+        value = '\n'.join(value)
+    return sys.intern(str(value or ''))
+
+
+def _build_character(entry: Dict[str, Any], prompt_sets: Dict[str, Any]) -> Character:
+    """Validate one manifest entry and precompute its derived fields."""
+    character_id = str(entry.get('id', '')).strip().lower()
+    if not character_id:
+        raise ValueError(f"Character without an id: {entry}")
+
+    template_url = entry.get('template_image')
+    if not template_url:
+        raise ValueError(f"Character {character_id} has no template_image")
+
+    prompts = {}
+    if entry.get('prompt_set'):
+        if entry['prompt_set'] not in prompt_sets:
+            raise ValueError(f"Character {character_id} uses unknown prompt_set: {entry['prompt_set']}")
+        prompts.update(prompt_sets[entry['prompt_set']])
+    for field in ('prompt', 'negative_prompt'):
+        if field in entry:
+            prompts[field] = entry[field]
+
+    prompt = _text(prompts.get('prompt'))
+    negative_prompt = _text(prompts.get('negative_prompt'))
+
+    content_hash = hashlib.sha256(
+        '\0'.join((prompt, negative_prompt, template_url)).encode('utf-8')
+    ).hexdigest()[:16]
+
+    match = _CLOUDINARY_URL.search(template_url)
+    card = entry.get('card')
+
+    return Character(
+        id=sys.intern(character_id),
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        template_url=template_url,
+        content_hash=content_hash,
+        template_public_id=match.group(2) if match else None,
+        template_version=match.group(1) if match else None,
+        versions=tuple(sorted((entry.get('versions') or {}).items())),
+        aliases=tuple(str(alias).strip().lower() for alias in entry.get('aliases', [])),
+        card=CharacterCard(card['label'], card.get('alt', card['label']), card['image']) if card else None
+    )
+
+
+def parse_manifest(manifest: Dict[str, Any]) -> Tuple[Dict[str, Character], Dict[str, str]]:
+    """
+    Build the registry tables from a parsed manifest.
+
+    Returns:
+        Tuple of (characters by ID, alias -> ID)
+
+    Raises:
+        ValueError: On a malformed entry, a duplicate ID or a clashing alias
+    """
+    prompt_sets = manifest.get('prompt_sets', {})
+    characters = {}
+    aliases = {}
+
+    for entry in manifest.get('characters', []):
+        character = _build_character(entry, prompt_sets)
+        if character.id in characters:
+            raise ValueError(f"Duplicate character id: {character.id}")
+        characters[character.id] = character
+
+    for character in characters.values():
+        for alias in character.aliases:
+            if alias in characters or aliases.get(alias, character.id) != character.id:
+                raise ValueError(f"Alias {alias} of {character.id} is already taken")
+            aliases[alias] = character.id
+
+    if not characters:
+        raise ValueError("Manifest defines no characters")
+    return characters, aliases
+
+
+class CharacterRegistry:
+    """Characters from the manifest, swapped as a whole on reload."""
+
+    def __init__(self, manifest_path: str, reload_interval: float):
+        self.manifest_path = manifest_path
+        self.reload_interval = reload_interval
+        self._tables = ({}, {})  # (characters by ID, alias -> ID), replaced as one
+        self._mtime = None
+        self._checked_at = 0.0
+        self._loaded_at = None
+        self._reloads = 0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> bool:
+        """
+        Re-read the manifest now.
+
+        Returns:
+            True if the new manifest was loaded, False if it was invalid
+            (the previous registry stays in use)
+        """
+        with self._lock:
+            self._checked_at = time.time()
+            try:
+                self._mtime = os.path.getmtime(self.manifest_path)
+                with open(self.manifest_path, encoding='utf-8') as manifest_file:
+                    characters, aliases = parse_manifest(json.load(manifest_file))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                if not self._tables[0]:
+                    raise
+                # Not retried until the file changes again
+                print(f"[Characters] Keeping previous registry, manifest failed to load: {str(e)}", flush=True)
+                return False
+
+            # Readers take the tables without the lock; replacing the tuple is atomic
+            self._tables = (characters, aliases)
+            self._loaded_at = time.time()
+            self._reloads += 1
+            print(f"[Characters] Loaded {len(characters)} characters ({len(aliases)} aliases) "
+                  f"from {self.manifest_path}", flush=True)
+            return True
+
+    def _reload_if_changed(self) -> None:
+        """Reload when the manifest's modification time moved (rate-limited)."""
+        if time.time() - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = time.time()
+        try:
+            mtime = os.path.getmtime(self.manifest_path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def get(self, character_id: str) -> Character:
+        """
+        Look up a character by ID or alias (case-insensitive).
+
+        Raises:
+            UnknownCharacterError: If no character or alias matches
+        """
+        self._reload_if_changed()
+        key = (character_id or '').strip().lower()
+        characters, aliases = self._tables
+        character = characters.get(key) or characters.get(aliases.get(key, ''))
+        if character is None:
+            raise UnknownCharacterError(f"Unknown character: {character_id}")
+        return character
+
+    def listed(self) -> List[Character]:
+        """Characters shown on the kiosk grid, in manifest order."""
+        self._reload_if_changed()
+        return [character for character in self._tables[0].values() if character.card]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Registry size and reload info, reported by /health."""
+        characters, aliases = self._tables
+        return {
+            'characters': len(characters),
+            'aliases': len(aliases),
+            'listed': sum(1 for character in characters.values() if character.card),
+            'reloads': self._reloads,
+            'loaded_at': self._loaded_at,
+        }
+
+
+registry = CharacterRegistry(CHARACTER_MANIFEST_PATH, CHARACTER_RELOAD_INTERVAL)
@@ -0,0 +1,183 @@
+"""
+Cloudinary Cleanup Queue Module
+Moves temp image deletion off the request path. Request handlers enqueue
+public IDs and return immediately; a background worker deletes them in bulk
+(delete_resources, up to 100 IDs per call) and retries failures with backoff.
+
+The queue lives in a SQLite file (WAL mode), so pending deletions survive a
+restart and can be shared by all gunicorn workers on a box.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+from dotenv import load_dotenv
+
+import cloudinary_helper
+import sqlite_db
+
+# Load environment variables
+load_dotenv()
+
+CLEANUP_QUEUE_PATH = os.getenv('CLEANUP_QUEUE_PATH', 'cleanup_queue.db')
+
+# Seconds the worker waits between passes when nothing wakes it
+CLEANUP_FLUSH_INTERVAL = float(os.getenv('CLEANUP_FLUSH_INTERVAL', '2'))
+
+# Give up on an image after this many failed attempts (the scheduled
+# cleanup of old temp images catches anything left behind)
+CLEANUP_MAX_ATTEMPTS = int(os.getenv('CLEANUP_MAX_ATTEMPTS', '8'))
+
+# Seconds a claimed batch stays hidden from other workers
+CLAIM_LEASE_SECONDS = 60
+
+_wake = threading.Event()
+_worker_started = False
+_worker_lock = threading.Lock()
+_schema_ready = False
+
+
+def _connect() -> sqlite3.Connection:
+    """Return this thread's connection to the queue database."""
+    global _schema_ready
+    conn = sqlite_db.connect(CLEANUP_QUEUE_PATH)
+    if not _schema_ready:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending_deletes ("
+            " public_id TEXT PRIMARY KEY,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL)"
+        )
+        _schema_ready = True
+    return conn
+
+
+def enqueue(public_ids: List[Optional[str]]) -> int:
+    """
+    Queue temp images for deletion and wake the worker.
+
+    Args:
+        public_ids: Cloudinary public IDs (empty values are ignored)
+
+    Returns:
+        Number of IDs queued
+    """
+    rows = [(public_id, time.time()) for public_id in public_ids if public_id]
+    if not rows:
+        return 0
+
+    _connect().executemany(
+        "INSERT OR IGNORE INTO pending_deletes (public_id, next_attempt_at) VALUES (?, ?)",
+        rows
+    )
+    _wake.set()
+    return len(rows)
+
+
+def pending_count() -> int:
+    """Number of images still waiting to be deleted."""
+    return _connect().execute("SELECT COUNT(*) FROM pending_deletes").fetchone()[0]
+
+
+def _claim_batch() -> List[str]:
+    """Claim up to one bulk-delete worth of due IDs (lease hides them from other workers)."""
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT public_id FROM pending_deletes WHERE next_attempt_at <= ? "
+            "ORDER BY next_attempt_at LIMIT ?",
+            (now, cloudinary_helper.DELETE_BATCH_SIZE)
+        ).fetchall()
+        public_ids = [row[0] for row in rows]
+        conn.executemany(
+            "UPDATE pending_deletes SET next_attempt_at = ? WHERE public_id = ?",
+            [(now + CLAIM_LEASE_SECONDS, public_id) for public_id in public_ids]
+        )
+        conn.execute("COMMIT")
+        return public_ids
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _record_results(public_ids: List[str], deleted: Optional[dict]) -> None:
+    """Drop finished IDs; reschedule failed ones with exponential backoff."""
+    conn = _connect()
+    deleted = deleted or {}
+    done = [public_id for public_id in public_ids
+            if deleted.get(public_id) in ('deleted', 'not_found')]
+    failed = [public_id for public_id in public_ids if public_id not in done]
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("DELETE FROM pending_deletes WHERE public_id = ?",
+                         [(public_id,) for public_id in done])
+        for public_id in failed:
+            row = conn.execute("SELECT attempts FROM pending_deletes WHERE public_id = ?",
+                               (public_id,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            if attempts >= CLEANUP_MAX_ATTEMPTS:
+                print(f"[CleanupQueue] Giving up on {public_id} after {attempts} attempts", flush=True)
+                conn.execute("DELETE FROM pending_deletes WHERE public_id = ?", (public_id,))
+            else:
+                conn.execute(
+                    "UPDATE pending_deletes SET attempts = ?, next_attempt_at = ? WHERE public_id = ?",
+                    (attempts, time.time() + min(2 ** attempts, 300), public_id)
+                )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    if failed:
+        print(f"[CleanupQueue] {len(failed)} deletions failed, will retry", flush=True)
+
+
+def process_pending() -> int:
+    """
+    Delete every due image in bulk batches.
+
+    Returns:
+        Number of images removed from the queue as deleted
+    """
+    removed = 0
+    while True:
+        public_ids = _claim_batch()
+        if not public_ids:
+            return removed
+        deleted = cloudinary_helper.delete_temp_images_batch(public_ids)
+        _record_results(public_ids, deleted)
+        if deleted:
+            removed += sum(1 for public_id in public_ids
+                           if deleted.get(public_id) in ('deleted', 'not_found'))
+        if deleted is None:
+            # Cloudinary is failing; back off instead of hammering it
+            return removed
+
+
+def start_worker() -> None:
+    """Start the background deletion worker (once per process)."""
+    global _worker_started
+    with _worker_lock:
+        if _worker_started:
+            return
+        _worker_started = True
+
+    def _run():
+        while True:
+            try:
+                removed = process_pending()
+                if removed:
+                    print(f"[CleanupQueue] Deleted {removed} temp images", flush=True)
+            except Exception as e:
+                print(f"[CleanupQueue] Worker error: {str(e)}", flush=True)
+            # Short pause lets images from concurrent requests share one bulk call
+            _wake.wait(timeout=CLEANUP_FLUSH_INTERVAL)
+            _wake.clear()
+            time.sleep(0.2)
+
+    threading.Thread(target=_run, name='cleanup-queue', daemon=True).start()
@@ -10,7 +10,12 @@ from dotenv import load_dotenv
 import os
 import uuid
 import time
-from typing import Optional, Dict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, List
+
+import http_pool
+import resilience
 
 # Load environment variables
 load_dotenv()
@@ -23,6 +28,21 @@ cloudinary.config(
     secure=True
 )
 
+# Uploads and Admin API calls share one pooled keep-alive connection pool
+http_pool.install_cloudinary_pool()
+
+# Admin API limit for public IDs per delete_resources call
+DELETE_BATCH_SIZE = 100
+
+# Bulk delete calls in flight at once during cleanup_old_temp_images
+CLEANUP_CONCURRENCY = int(os.getenv('CLEANUP_CONCURRENCY', '4'))
+
+# Seconds one Cloudinary call may spend on retries in total
+CLOUDINARY_CALL_DEADLINE = float(os.getenv('CLOUDINARY_CALL_DEADLINE', '15'))
+
+# Listed in /health from the start, not only after the first call
+resilience.get_breaker('cloudinary')
+
 
 def upload_temp_image(image_bytes: bytes) -> Optional[Dict[str, str]]:
     """
@@ -42,14 +62,16 @@ def upload_temp_image(image_bytes: bytes) -> Optional[Dict[str, str]]:
         
         print(f"[Cloudinary] Uploading image with ID: {public_id}", flush=True)
         
-        # Upload to Cloudinary
-        result = cloudinary.uploader.upload(
+        # Upload to Cloudinary (safe to retry: fixed public_id, overwrite=True)
+        result = resilience.call(
+            'cloudinary', cloudinary.uploader.upload,
             image_bytes,
             public_id=public_id,
             folder="temp_faces",  # Organize in folder
             tags=["temp", "face_swap"],  # Tag for cleanup
             resource_type="image",
-            overwrite=True
+            overwrite=True,
+            deadline=CLOUDINARY_CALL_DEADLINE
         )
         
         secure_url = result.get('secure_url')
@@ -77,7 +99,8 @@ def delete_temp_image(public_id: str) -> bool:
     """
     try:
         print(f"[Cloudinary] Deleting image: {public_id}", flush=True)
-        result = cloudinary.uploader.destroy(public_id)
+        result = resilience.call('cloudinary', cloudinary.uploader.destroy, public_id,
+                                 deadline=CLOUDINARY_CALL_DEADLINE)
         
         if result.get('result') == 'ok':
             print(f"[Cloudinary] Deletion successful", flush=True)
@@ -91,11 +114,58 @@ def delete_temp_image(public_id: str) -> bool:
         return False
 
 
+def delete_temp_images_batch(public_ids: List[str]) -> Optional[Dict[str, str]]:
+    """
+    Delete up to DELETE_BATCH_SIZE temporary images with one Admin API call.
+    
+    Args:
+        public_ids: public_ids returned from upload_temp_image
+        
+    Returns:
+        Dict mapping public_id to Cloudinary's result ('deleted', 'not_found', ...),
+        or None if the call failed
+    """
+    try:
+        print(f"[Cloudinary] Bulk deleting {len(public_ids)} images", flush=True)
+        result = resilience.call('cloudinary', cloudinary.api.delete_resources, list(public_ids),
+                                 deadline=CLOUDINARY_CALL_DEADLINE)
+        return result.get('deleted', {})
+    except Exception as e:
+        print(f"[Cloudinary] Bulk deletion error: {str(e)}", flush=True)
+        return None
+
+
+def delete_temp_images(public_ids: List[str]) -> int:
+    """
+    Delete several temporary images with bulk Admin API calls
+    (delete_resources accepts up to 100 public IDs per call).
+    
+    Args:
+        public_ids: public_ids returned from upload_temp_image
+        
+    Returns:
+        Number of images deleted
+    """
+    deleted_count = 0
+    public_ids = [public_id for public_id in public_ids if public_id]
+    
+    for start in range(0, len(public_ids), DELETE_BATCH_SIZE):
+        deleted = delete_temp_images_batch(public_ids[start:start + DELETE_BATCH_SIZE])
+        if deleted:
+            deleted_count += sum(1 for status in deleted.values() if status == 'deleted')
+    
+    return deleted_count
+
+
 def cleanup_old_temp_images(hours_old: int = 24) -> int:
     """
     Cleanup temporary images older than specified hours.
     This is a fallback cleanup in case immediate deletion fails.
     
+    Pages through temp_faces/ with next_cursor (500 per page), selects images
+    by their upload time (created_at) and deletes them with bulk
+    delete_resources calls, CLEANUP_CONCURRENCY at a time.
+    
     Args:
         hours_old: Delete images older than this many hours (default: 24)
         
@@ -105,34 +175,50 @@ def cleanup_old_temp_images(hours_old: int = 24) -> int:
     try:
         print(f"[Cloudinary] Running cleanup for images older than {hours_old} hours", flush=True)
         
-        # Calculate timestamp for cutoff
-        cutoff_timestamp = int(time.time()) - (hours_old * 3600)
-        
-        # Search for old temp images
-        # Note: This requires Admin API access
-        result = cloudinary.api.resources(
-            type="upload",
-            prefix="temp_faces/",
-            tags=True,
-            max_results=500
-        )
+        # Calculate cutoff (Cloudinary reports created_at in UTC)
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=hours_old)
         
         deleted_count = 0
-        for resource in result.get('resources', []):
-            # Extract timestamp from public_id (format: temp_faces/temp_face_{timestamp}_{uuid})
-            public_id = resource.get('public_id', '')
-            try:
-                # Parse timestamp from public_id
-                parts = public_id.split('_')
-                if len(parts) >= 3:
-                    timestamp = int(parts[2])
-                    if timestamp < cutoff_timestamp:
-                        if delete_temp_image(public_id):
-                            deleted_count += 1
-            except (ValueError, IndexError):
-                continue
-        
-        print(f"[Cloudinary] Cleanup complete: {deleted_count} images deleted", flush=True)
+        pages = 0
+        next_cursor = None
+        
+        with ThreadPoolExecutor(max_workers=CLEANUP_CONCURRENCY) as pool:
+            futures = []
+            
+            while True:
+                # Note: This requires Admin API access
+                params = {'type': 'upload', 'prefix': 'temp_faces/', 'max_results': 500}
+                if next_cursor:
+                    params['next_cursor'] = next_cursor
+                result = resilience.call('cloudinary', cloudinary.api.resources,
+                                         deadline=CLOUDINARY_CALL_DEADLINE, **params)
+                pages += 1
+                
+                old_ids = []
+                for resource in result.get('resources', []):
+                    try:
+                        created_at = datetime.strptime(resource['created_at'], '%Y-%m-%dT%H:%M:%SZ')
+                    except (KeyError, ValueError):
+                        continue
+                    if created_at.replace(tzinfo=timezone.utc) < cutoff:
+                        old_ids.append(resource['public_id'])
+                
+                # Delete this page's old images while the next page is fetched
+                for start in range(0, len(old_ids), DELETE_BATCH_SIZE):
+                    futures.append(pool.submit(delete_temp_images_batch,
+                                               old_ids[start:start + DELETE_BATCH_SIZE]))
+                
+                next_cursor = result.get('next_cursor')
+                if not next_cursor:
+                    break
+            
+            for future in futures:
+                deleted = future.result()
+                if deleted:
+                    deleted_count += sum(1 for status in deleted.values() if status == 'deleted')
+        
+        print(f"[Cloudinary] Cleanup complete: {deleted_count} images deleted "
+              f"({pages} pages, {len(futures)} delete calls)", flush=True)
         return deleted_count
         
     except Exception as e:
@@ -0,0 +1,328 @@
+"""
+Face-Swap Backends Module
+One class per face-swap provider behind a common interface (start, status,
+cancel, parse_output), plus a router that picks the backend for each
+prediction from its rolling latency and error rate.
+
+Enable backends with FACE_SWAP_BACKENDS (comma-separated, in order of
+preference). The first listed backend gets the traffic while it is healthy;
+when its error rate passes ROUTER_MAX_ERROR_RATE or it gets ROUTER_SLOW_FACTOR
+times slower than the fastest healthy backend, new predictions move to the
+next one. A small ROUTER_EXPLORE share goes to the other backends, degraded
+ones included, as probes: their fresh outcomes are what lets traffic move
+back once the preferred backend recovers.
+
+Outcomes use the same backend choice as the prediction store
+(PREDICTION_STORE=memory|sqlite) so every worker routes on the same numbers.
+"""
+
+import os
+import random
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Optional, Dict, Any, List
+from dotenv import load_dotenv
+
+import character_registry
+import replicate_helper
+import sqlite_db
+
+# Load environment variables
+load_dotenv()
+
+# Enabled backends, most preferred first (names of BACKENDS)
+FACE_SWAP_BACKENDS = [
+    name.strip()
+    for name in os.getenv('FACE_SWAP_BACKENDS', replicate_helper.FACE_SWAP_MODEL).split(',')
+    if name.strip()
+]
+
+# Seconds of history the router looks at
+ROUTER_WINDOW = float(os.getenv('ROUTER_WINDOW', '600'))
+
+# Outcomes needed before a backend's stats are trusted
+ROUTER_MIN_SAMPLES = int(os.getenv('ROUTER_MIN_SAMPLES', '5'))
+
+# A backend failing more often than this is degraded
+ROUTER_MAX_ERROR_RATE = float(os.getenv('ROUTER_MAX_ERROR_RATE', '0.3'))
+
+# A backend slower than this multiple of the fastest healthy one is degraded
+ROUTER_SLOW_FACTOR = float(os.getenv('ROUTER_SLOW_FACTOR', '1.5'))
+
+# Share of predictions sent to a random other backend (degraded ones
+# included) to keep stats fresh
+ROUTER_EXPLORE = float(os.getenv('ROUTER_EXPLORE', '0.05'))
+
+# Most outcomes per backend the router looks at within ROUTER_WINDOW
+ROUTER_MAX_SAMPLES = 500
+
+ROUTER_DB_PATH = os.getenv('ROUTER_DB_PATH', 'router.db')
+
+
+class FaceSwapBackend(ABC):
+    """Interface every face-swap provider implements."""
+
+    name = ''
+    uses_mask = False
+
+    @abstractmethod
+    def start(self, child_image_url: str, mask_image_url: str, character: str) -> Optional[Dict[str, Any]]:
+        """
+        Start a face swap.
+
+        Returns:
+            Dict with 'prediction_id', 'status', 'version', 'created_at',
+            'webhook', or None if failed
+        """
+
+    @abstractmethod
+    def current_version(self, character: character_registry.Character) -> Optional[str]:
+        """
+        Model version a new prediction for this character would run on (part
+        of the result cache key). Never waits on the network: None if the
+        version is not known yet.
+        """
+
+    @abstractmethod
+    def status(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        """Status dict (see replicate_helper.build_status_info), or None if the check failed."""
+
+    @abstractmethod
+    def cancel(self, prediction_id: str) -> bool:
+        """Cancel a running prediction; True if the request was accepted."""
+
+    @abstractmethod
+    def parse_output(self, output: Any) -> Optional[str]:
+        """Extract the result image URL from the provider's raw output."""
+
+
+class ReplicateFaceSwapBackend(FaceSwapBackend):
+    """A face-swap model hosted on Replicate (inputs from MODEL_CAPABILITIES)."""
+
+    model_name = ''
+
+    def __init__(self):
+        self.name = self.model_name
+        self.uses_mask = replicate_helper.model_uses_mask(self.model_name)
+
+    def start(self, child_image_url: str, mask_image_url: str, character: str) -> Optional[Dict[str, Any]]:
+        return replicate_helper.start_face_generation(
+            child_image_url=child_image_url,
+            mask_image_url=mask_image_url,
+            character=character,
+            model_name=self.model_name
+        )
+
+    def current_version(self, character: character_registry.Character) -> Optional[str]:
+        return replicate_helper.resolve_model_version(self.model_name, character=character, fetch=False)
+
+    def status(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        return replicate_helper.check_prediction_status(prediction_id, parse_output=self.parse_output)
+
+    def cancel(self, prediction_id: str) -> bool:
+        return replicate_helper.cancel_prediction(prediction_id)
+
+    def parse_output(self, output: Any) -> Optional[str]:
+        return replicate_helper.extract_result_url(output)
+
+
+class YanOpsFaceSwapBackend(ReplicateFaceSwapBackend):
+    """yan-ops/face_swap: output is {'cache_url': ..., 'msg': 'succeed'}."""
+
+    model_name = 'yan-ops/face_swap'
+
+    def parse_output(self, output: Any) -> Optional[str]:
+        if isinstance(output, dict) and output.get('msg') not in (None, 'succeed'):
+            # The model reports "succeeded" even when it found no face to swap
+            print(f"[Backends] {self.model_name} returned: {output.get('msg')}", flush=True)
+            return None
+        return super().parse_output(output)
+
+
+class CodeplugFaceSwapBackend(ReplicateFaceSwapBackend):
+    """codeplugtech/face-swap: output is a single image URI."""
+
+    model_name = 'codeplugtech/face-swap'
+
+
+class IPAdapterInpaintBackend(ReplicateFaceSwapBackend):
+    """lucataco/ip_adapter-face-inpaint: prompt-guided inpaint, needs a face mask."""
+
+    model_name = 'lucataco/ip_adapter-face-inpaint'
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (YanOpsFaceSwapBackend(), CodeplugFaceSwapBackend(), IPAdapterInpaintBackend())
+}
+
+
+def get_backend(name: Optional[str] = None) -> FaceSwapBackend:
+    """
+    Look up a backend by name (defaults to FACE_SWAP_MODEL).
+
+    Raises:
+        KeyError: If the backend is not registered
+    """
+    name = name or replicate_helper.FACE_SWAP_MODEL
+    if name not in BACKENDS:
+        raise KeyError(f"Face-swap backend not registered in BACKENDS: {name}")
+    return BACKENDS[name]
+
+
+class InMemoryOutcomeLog:
+    """Recent backend outcomes held in this process."""
+
+    def __init__(self):
+        self._outcomes = {}  # name -> deque of (at, ok, seconds)
+        self._lock = threading.Lock()
+
+    def add(self, name: str, ok: bool, seconds: Optional[float]) -> None:
+        """Append one outcome."""
+        with self._lock:
+            self._outcomes.setdefault(name, deque(maxlen=ROUTER_MAX_SAMPLES)).append((time.time(), ok, seconds))
+
+    def recent(self, name: str, since: float) -> List[tuple]:
+        """(at, ok, seconds) outcomes of a backend newer than since."""
+        with self._lock:
+            return [outcome for outcome in self._outcomes.get(name, ()) if outcome[0] >= since]
+
+
+class SQLiteOutcomeLog:
+    """Recent backend outcomes in a SQLite file shared by all workers (WAL mode)."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS outcomes ("
+            " backend TEXT NOT NULL,"
+            " at REAL NOT NULL,"
+            " ok INTEGER NOT NULL,"
+            " seconds REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS outcomes_backend_at ON outcomes (backend, at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection to the router database."""
+        return sqlite_db.connect(self.db_path)
+
+    def add(self, name: str, ok: bool, seconds: Optional[float]) -> None:
+        """Append one outcome, dropping those older than ROUTER_WINDOW."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT INTO outcomes (backend, at, ok, seconds) VALUES (?, ?, ?, ?)",
+            (name, now, int(ok), seconds)
+        )
+        conn.execute("DELETE FROM outcomes WHERE backend = ? AND at < ?", (name, now - ROUTER_WINDOW))
+
+    def recent(self, name: str, since: float) -> List[tuple]:
+        """(at, ok, seconds) outcomes of a backend newer than since."""
+        rows = self._connect().execute(
+            "SELECT at, ok, seconds FROM outcomes WHERE backend = ? AND at >= ? ORDER BY at DESC LIMIT ?",
+            (name, since, ROUTER_MAX_SAMPLES)
+        ).fetchall()
+        return [(at, bool(ok), seconds) for at, ok, seconds in rows]
+
+
+def create_outcome_log(backend: Optional[str] = None):
+    """
+    Create the router's outcome log for the configured backend.
+
+    Args:
+        backend: 'memory' or 'sqlite' (defaults to PREDICTION_STORE)
+    """
+    backend = (backend or os.getenv('PREDICTION_STORE', 'memory')).lower()
+    if backend == 'sqlite':
+        return SQLiteOutcomeLog(ROUTER_DB_PATH)
+    return InMemoryOutcomeLog()
+
+
+class BackendRouter:
+    """Picks a backend per prediction from rolling latency and error rate."""
+
+    def __init__(self, names: List[str], outcomes=None):
+        unknown = [name for name in names if name not in BACKENDS]
+        if unknown:
+            raise KeyError(f"Unknown face-swap backends in FACE_SWAP_BACKENDS: {unknown}")
+        self.names = names
+        self._outcomes = outcomes if outcomes is not None else InMemoryOutcomeLog()
+
+    def needs_mask(self) -> bool:
+        """True if any enabled backend takes a face mask (swap_face then builds one)."""
+        return any(BACKENDS[name].uses_mask for name in self.names)
+
+    def record(self, name: Optional[str], ok: bool, seconds: Optional[float] = None) -> None:
+        """Record one outcome: a finished prediction (with its latency) or a failed start."""
+        if name not in self.names:
+            return
+        try:
+            self._outcomes.add(name, ok, seconds)
+        except sqlite3.Error as e:
+            # Routing stats are best effort; never fail a prediction over them
+            print(f"[Backends] Could not record outcome for {name}: {e}", flush=True)
+
+    def health(self, name: str) -> Dict[str, Any]:
+        """Samples, error rate and mean latency of a backend over ROUTER_WINDOW."""
+        recent = self._outcomes.recent(name, time.time() - ROUTER_WINDOW)
+        latencies = [seconds for _, ok, seconds in recent if ok and seconds is not None]
+        return {
+            'samples': len(recent),
+            'error_rate': round(sum(1 for _, ok, _ in recent if not ok) / len(recent), 3) if recent else 0.0,
+            'mean_seconds': round(sum(latencies) / len(latencies), 1) if latencies else None,
+        }
+
+    def pick(self, has_mask: bool = False) -> FaceSwapBackend:
+        """Choose the backend for the next prediction."""
+        candidates = [name for name in self.names if has_mask or not BACKENDS[name].uses_mask]
+        if not candidates:
+            candidates = list(self.names)
+        if len(candidates) > 1 and random.random() < ROUTER_EXPLORE:
+            # Probe: degraded backends only get measured again through these
+            return BACKENDS[random.choice(candidates)]
+
+        health = {name: self.health(name) for name in candidates}
+        healthy = [
+            name for name in candidates
+            if health[name]['samples'] < ROUTER_MIN_SAMPLES
+            or health[name]['error_rate'] <= ROUTER_MAX_ERROR_RATE
+        ]
+        if not healthy:
+            # Everything is degraded: use whichever fails least
+            return BACKENDS[min(candidates, key=lambda name: health[name]['error_rate'])]
+
+        measured = [health[name]['mean_seconds'] for name in healthy
+                    if health[name]['mean_seconds'] is not None
+                    and health[name]['samples'] >= ROUTER_MIN_SAMPLES]
+        fastest = min(measured) if measured else None
+        for name in healthy:
+            mean = health[name]['mean_seconds']
+            if fastest is None or mean is None or health[name]['samples'] < ROUTER_MIN_SAMPLES \
+                    or mean <= fastest * ROUTER_SLOW_FACTOR:
+                return BACKENDS[name]
+        return BACKENDS[healthy[0]]
+
+    def start(self, child_image_url: str, mask_image_url: str, character: str) -> Optional[Dict[str, Any]]:
+        """
+        Start a face swap on the routed backend.
+
+        Returns:
+            start() dict plus 'backend' (its name), or None if the start failed
+        """
+        backend = self.pick(has_mask=bool(mask_image_url))
+        prediction_info = backend.start(child_image_url, mask_image_url, character)
+        if not prediction_info:
+            self.record(backend.name, ok=False)
+            return None
+        return dict(prediction_info, backend=backend.name)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Per-backend health, reported by /health."""
+        return {name: self.health(name) for name in self.names}
+
+
+router = BackendRouter(FACE_SWAP_BACKENDS, create_outcome_log())
@@ -10,17 +10,36 @@ Creates masks that:
 import cv2
 import numpy as np
 import base64
+import os
+import queue
+import threading
+from contextlib import contextmanager
 from io import BytesIO
 from PIL import Image
 
 print("[FaceMask] Loading Robust Face Mask Generator v2.0", flush=True)
 
+# Face detection runs on the frame downscaled by this factor (1.0 = full resolution)
+FACE_DETECTION_SCALE = float(os.getenv('FACE_DETECTION_SCALE', '0.5'))
+
+# Detection window of haarcascade_frontalface_default (faces smaller are never found)
+HAAR_WINDOW = 24
+
+# Gaussian kernel used to feather the mask edge
+BLUR_KERNEL = 51
+
 class FaceMaskGenerator:
-    def __init__(self):
-        """Initialize face detector"""
+    def __init__(self, scale=None):
+        """
+        Initialize face detector
+        
+        Args:
+            scale: Detection downscale factor in (0, 1] (defaults to FACE_DETECTION_SCALE)
+        """
         # Use OpenCV's Haar Cascade for face detection
         cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
         self.face_cascade = cv2.CascadeClassifier(cascade_path)
+        self.scale = min(1.0, max(0.1, scale if scale is not None else FACE_DETECTION_SCALE))
     
     def generate_mask(self, image_bytes):
         """
@@ -48,23 +67,68 @@ class FaceMaskGenerator:
                 print("[FaceMask] Failed to decode image (result is None)", flush=True)
                 return None
             
+            return self.generate_mask_from_image(image)
+            
+        except Exception as e:
+            print(f"[FaceMask] Unexpected error: {str(e)}", flush=True)
+            import traceback
+            traceback.print_exc()
+            return None
+
+    def detect_face(self, image):
+        """
+        Detect the first face in a decoded BGR image.
+        
+        Detection runs on a copy downscaled by self.scale (a pyramid level);
+        the box is mapped back to full-resolution coordinates.
+        
+        Returns:
+            (x, y, w, h) in full-resolution pixels, or None if no face found
+        """
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        
+        scale = self.scale
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        
+        # Keep the full-resolution 30px minimum, but never below the cascade's 24px window
+        min_side = max(HAAR_WINDOW, int(round(30 * scale)))
+        
+        faces = self.face_cascade.detectMultiScale(
+            gray,
+            scaleFactor=1.1,
+            minNeighbors=5,
+            minSize=(min_side, min_side)
+        )
+        
+        if len(faces) == 0:
+            return None
+        
+        x, y, w, h = faces[0]
+        return (int(x / scale), int(y / scale), int(w / scale), int(h / scale))
+    
+    def generate_mask_from_image(self, image, face=None):
+        """
+        Generate face mask from an already decoded BGR image (numpy array).
+        Lets callers that decoded the photo once skip a second decode, and
+        callers that already ran detect_face pass its box to skip detection.
+        """
+        try:
+            if image is None:
+                print("[FaceMask] Error: No image provided", flush=True)
+                return None
+            
             # 5. FACE DETECTION
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
             height, width = image.shape[:2]
+            if face is None:
+                face = self.detect_face(image)
             
-            faces = self.face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=5,
-                minSize=(30, 30)
-            )
-            
-            if len(faces) == 0:
+            if face is None:
                 print("[FaceMask] No face detected", flush=True)
                 return None
             
             # 6. GENERATE MASK
-            x, y, w, h = faces[0]
+            x, y, w, h = face
             mask = np.zeros((height, width), dtype=np.uint8)
             
             center_x = x + w // 2
@@ -72,14 +136,24 @@ class FaceMaskGenerator:
             oval_width = int(w * 0.6)
             oval_height = int(h * 0.7)
             
+            # Draw and blur only a padded region around the oval. The padding
+            # covers the blur spread plus the kernel's border reflection, so
+            # the result matches blurring the whole frame.
+            pad = BLUR_KERNEL
+            x0 = max(0, center_x - oval_width // 2 - pad)
+            y0 = max(0, center_y - oval_height // 2 - pad)
+            x1 = min(width, center_x + oval_width // 2 + pad + 1)
+            y1 = min(height, center_y + oval_height // 2 + pad + 1)
+            region = mask[y0:y1, x0:x1]
+            
             cv2.ellipse(
-                mask,
-                (center_x, center_y),
+                region,
+                (center_x - x0, center_y - y0),
                 (oval_width // 2, oval_height // 2),
                 0, 0, 360, 255, -1
             )
             
-            mask = cv2.GaussianBlur(mask, (51, 51), 0)
+            mask[y0:y1, x0:x1] = cv2.GaussianBlur(region, (BLUR_KERNEL, BLUR_KERNEL), 0)
             mask_pil = Image.fromarray(mask)
             
             buffer = BytesIO()
@@ -102,11 +176,76 @@ class FaceMaskGenerator:
             print(f"[FaceMask] Base64 error: {e}", flush=True)
             return None
 
-# Singleton instance
+# Detector pool: cv2.CascadeClassifier is not safe to share between threads,
+# so each concurrent request borrows its own generator from a bounded pool.
+# One per gunicorn thread (Procfile --threads 8), so requests do not wait
+# on each other for a detector.
+DETECTOR_POOL_SIZE = int(os.getenv('DETECTOR_POOL_SIZE', '8'))
+
+_detector_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure_cv2_threads(pool_size=None):
+    """
+    Pick cv2.setNumThreads so detectors across all workers do not oversubscribe
+    the CPU: cores / (gunicorn workers x detectors per worker), at least 1.
+    OPENCV_THREADS overrides the computed value.
+    """
+    override = os.getenv('OPENCV_THREADS')
+    if override:
+        threads = int(override)
+    else:
+        workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+        pool_size = pool_size or DETECTOR_POOL_SIZE
+        threads = max(1, (os.cpu_count() or 1) // max(1, workers * pool_size))
+    cv2.setNumThreads(threads)
+    print(f"[FaceMask] OpenCV threads per call: {threads}", flush=True)
+    return threads
+
+
+def init_detector_pool(size=None):
+    """
+    Build the detector pool up front (call at worker start so the first
+    request does not pay for loading the cascades). Safe to call again.
+    """
+    global _detector_pool
+    with _pool_lock:
+        if _detector_pool is not None:
+            return _detector_pool
+        size = size or DETECTOR_POOL_SIZE
+        configure_cv2_threads(size)
+        pool = queue.Queue(maxsize=size)
+        for _ in range(size):
+            pool.put(FaceMaskGenerator())
+        _detector_pool = pool
+        print(f"[FaceMask] Detector pool ready ({size} detectors)", flush=True)
+        return pool
+
+
+@contextmanager
+def acquire_mask_generator(timeout=None):
+    """
+    Borrow a FaceMaskGenerator from the pool for the duration of a with-block.
+    
+    Raises:
+        queue.Empty: If no detector frees up within timeout seconds
+    """
+    pool = init_detector_pool()
+    generator = pool.get(timeout=timeout)
+    try:
+        yield generator
+    finally:
+        pool.put(generator)
+
+
+# Singleton instance (single-threaded callers and scripts)
 _mask_generator = None
 
 def get_mask_generator():
     global _mask_generator
     if _mask_generator is None:
-        _mask_generator = FaceMaskGenerator()
+        with _pool_lock:
+            if _mask_generator is None:
+                _mask_generator = FaceMaskGenerator()
     return _mask_generator
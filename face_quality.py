@@ -0,0 +1,94 @@
+"""
+Face Quality Gate Module
+Fast local checks on the captured photo, run before any upload or paid
+prediction: is there a face, is it big enough, is it sharp, is it exposed
+well? Bad captures are rejected with a retake message in milliseconds.
+"""
+
+import os
+from typing import Optional, Dict, Any, Tuple
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Set FACE_QUALITY_GATE=0 to disable the gate
+FACE_QUALITY_GATE = os.getenv('FACE_QUALITY_GATE', '1') == '1'
+
+# Minimum face width as a fraction of the frame's shorter side
+FACE_MIN_RATIO = float(os.getenv('FACE_MIN_RATIO', '0.10'))
+
+# Minimum variance of the Laplacian over the face (lower = blurrier)
+FACE_MIN_SHARPNESS = float(os.getenv('FACE_MIN_SHARPNESS', '40'))
+
+# Acceptable mean brightness of the face (0-255)
+FACE_MIN_BRIGHTNESS = float(os.getenv('FACE_MIN_BRIGHTNESS', '50'))
+FACE_MAX_BRIGHTNESS = float(os.getenv('FACE_MAX_BRIGHTNESS', '215'))
+
+# Messages shown on the kiosk for each failure code
+RETAKE_MESSAGES = {
+    'no_face': 'We could not find a face. Please look at the camera and retake the photo.',
+    'face_too_small': 'Please step closer to the camera and retake the photo.',
+    'too_blurry': 'The photo is blurry. Please hold still and retake it.',
+    'too_dark': 'The photo is too dark. Please move into the light and retake it.',
+    'too_bright': 'The photo is too bright. Please move out of direct light and retake it.',
+}
+
+
+def check_face_quality(
+    image: np.ndarray,
+    face: Optional[Tuple[int, int, int, int]]
+) -> Optional[Dict[str, Any]]:
+    """
+    Check a decoded photo and its detected face box.
+
+    Args:
+        image: BGR image (numpy array)
+        face: (x, y, w, h) from FaceMaskGenerator.detect_face, or None
+
+    Returns:
+        None if the photo passes, otherwise a dict with:
+        - 'code': failure code (key of RETAKE_MESSAGES)
+        - 'error': message to show the user
+        - 'metrics': measured values
+    """
+    if face is None:
+        return _failure('no_face', {})
+
+    height, width = image.shape[:2]
+    x, y, w, h = face
+    face_ratio = w / float(min(width, height))
+
+    gray = cv2.cvtColor(image[y:y + h, x:x + w], cv2.COLOR_BGR2GRAY)
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    brightness = float(gray.mean())
+
+    metrics = {
+        'face_ratio': round(face_ratio, 3),
+        'sharpness': round(sharpness, 1),
+        'brightness': round(brightness, 1),
+    }
+
+    if face_ratio < FACE_MIN_RATIO:
+        return _failure('face_too_small', metrics)
+    if sharpness < FACE_MIN_SHARPNESS:
+        return _failure('too_blurry', metrics)
+    if brightness < FACE_MIN_BRIGHTNESS:
+        return _failure('too_dark', metrics)
+    if brightness > FACE_MAX_BRIGHTNESS:
+        return _failure('too_bright', metrics)
+
+    print(f"[FaceQuality] Passed: {metrics}", flush=True)
+    return None
+
+
+def _failure(code: str, metrics: Dict[str, Any]) -> Dict[str, Any]:
+    print(f"[FaceQuality] Rejected ({code}): {metrics}", flush=True)
+    return {
+        'code': code,
+        'error': RETAKE_MESSAGES[code],
+        'metrics': metrics,
+    }
@@ -5,7 +5,7 @@ Based on user-provided reference images
 import os
 from dotenv import load_dotenv
 from openai import OpenAI
-import requests
+import http_pool
 import time
 
 # Load environment variables
@@ -32,13 +32,13 @@ def generate_character_image(prompt, filename):
         
         # Download the image
         print(f"📥 Downloading image...")
-        img_response = requests.get(image_url)
+        image_bytes = http_pool.download(image_url)
         
-        if img_response.status_code == 200:
+        if image_bytes:
             output_path = f"static/characters/{filename}.jpg"
             
             with open(output_path, 'wb') as f:
-                f.write(img_response.content)
+                f.write(image_bytes)
             
             print(f"✅ Saved to: {output_path}")
             return True
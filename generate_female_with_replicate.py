@@ -2,8 +2,7 @@
 Generate Female Saudi Character Images using Replicate SDXL
 """
 import os
-import replicate
-import requests
+import http_pool
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -21,7 +20,7 @@ def generate_character(prompt, filename):
     
     try:
         # Use SDXL model for high-quality generation
-        output = replicate.run(
+        output = http_pool.get_replicate_client().run(
             "stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b",
             input={
                 "prompt": prompt,
@@ -42,13 +41,13 @@ def generate_character(prompt, filename):
             
             # Download the image
             print(f"📥 Downloading image...")
-            img_response = requests.get(image_url)
+            image_bytes = http_pool.download(image_url)
             
-            if img_response.status_code == 200:
+            if image_bytes:
                 output_path = f"static/characters/{filename}.jpg"
                 
                 with open(output_path, 'wb') as f:
-                    f.write(img_response.content)
+                    f.write(image_bytes)
                 
                 print(f"✅ Saved to: {output_path}")
                 return True
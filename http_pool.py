@@ -0,0 +1,187 @@
+"""
+HTTP Pool Module
+One set of persistent, pooled connections per process for every outbound
+call: the Replicate API, the Cloudinary upload/admin APIs and plain
+downloads. Connections are kept alive between requests so a photo booth
+request (upload, prediction start, status checks, cleanup) reuses warm TLS
+connections instead of handshaking for each call.
+
+- get_replicate_client(): replicate.Client on a shared httpx transport
+- install_cloudinary_pool(): points the Cloudinary SDK at one urllib3 pool
+- get_session() / download(): requests.Session for result and template
+  downloads
+
+The Cloudinary and download pools (urllib3 / requests) keep up to
+HTTP_POOL_MAXSIZE connections per host for HTTP_POOL_HOSTS hosts. httpx
+limits are totals across hosts, so the Replicate client, which only talks
+to api.replicate.com, is capped at HTTP_POOL_MAXSIZE connections in total.
+Idle connections live for HTTP_KEEPALIVE_SECONDS, and every call gets
+HTTP_CONNECT_TIMEOUT / HTTP_READ_TIMEOUT unless it passes its own. Inside
+resilience.call() the Replicate and Cloudinary requests get at most the
+time left before the call's deadline, so one slow attempt cannot outlast
+the whole call.
+"""
+
+import os
+import threading
+from typing import Optional
+from dotenv import load_dotenv
+
+import httpx
+import replicate
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+import resilience
+
+# Load environment variables
+load_dotenv()
+
+# Connections kept per host (gunicorn runs 8 threads per worker); for the
+# single-host Replicate client this is its total
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))
+
+# Distinct hosts the urllib3 / requests pools keep connections for
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', '10'))
+
+# Seconds an idle connection stays open for reuse (httpx defaults to 5)
+HTTP_KEEPALIVE_SECONDS = float(os.getenv('HTTP_KEEPALIVE_SECONDS', '60'))
+
+# Default timeouts (seconds)
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+
+_lock = threading.Lock()
+_replicate_client = None
+_session = None
+
+
+class _DeadlineTransport(httpx.BaseTransport):
+    """httpx transport that caps each request's timeouts at resilience.attempt_timeout()."""
+
+    def __init__(self, transport: httpx.BaseTransport):
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        limit = resilience.attempt_timeout(HTTP_READ_TIMEOUT)
+        timeouts = request.extensions.get('timeout') or {}
+        request.extensions['timeout'] = {
+            phase: limit if seconds is None else min(seconds, limit)
+            for phase, seconds in timeouts.items()
+        }
+        return self._transport.handle_request(request)
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class _DeadlinePool:
+    """urllib3 pool wrapper that caps each request's timeout at resilience.attempt_timeout()."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def request(self, *args, **kwargs):
+        limit = resilience.attempt_timeout(HTTP_READ_TIMEOUT)
+        if isinstance(kwargs.get('timeout'), (int, float)):
+            limit = min(limit, kwargs['timeout'])
+        kwargs['timeout'] = urllib3.Timeout(connect=min(HTTP_CONNECT_TIMEOUT, limit), read=limit)
+        # Retries belong to resilience.call; urllib3's own would repeat the
+        # full timeout past the call's deadline
+        kwargs['retries'] = False
+        return self._pool.request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+def get_replicate_client() -> replicate.Client:
+    """Replicate client shared by the process, on a pooled keep-alive transport."""
+    global _replicate_client
+    with _lock:
+        if _replicate_client is None:
+            # httpx limits are totals across hosts; this client only talks to one
+            transport = _DeadlineTransport(httpx.HTTPTransport(limits=httpx.Limits(
+                max_connections=HTTP_POOL_MAXSIZE,
+                max_keepalive_connections=HTTP_POOL_MAXSIZE,
+                keepalive_expiry=HTTP_KEEPALIVE_SECONDS
+            )))
+            # The API token is read from REPLICATE_API_TOKEN on first use
+            _replicate_client = replicate.Client(
+                timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                transport=transport
+            )
+        return _replicate_client
+
+
+def install_cloudinary_pool() -> None:
+    """
+    Route the Cloudinary uploader and Admin API through one shared pool.
+
+    The SDK builds a PoolManager per module at import time with a single
+    connection per host, so concurrent uploads open (and drop) extra
+    connections. Call after cloudinary.config(); proxy and TCP keep-alive
+    settings from the config are kept. Relies on SDK internals (the modules'
+    _http attribute), so an SDK without them keeps its own pools and a
+    warning is logged.
+    """
+    import cloudinary
+    import cloudinary.uploader
+    try:
+        import cloudinary.api_client.call_api as call_api
+        from cloudinary.utils import get_http_connector
+    except ImportError as e:
+        print(f"[HTTP] Cloudinary SDK {cloudinary.VERSION} not pooled: {str(e)}", flush=True)
+        return
+
+    pool = _DeadlinePool(get_http_connector(cloudinary.config(), dict(
+        cloudinary.CERT_KWARGS,
+        num_pools=HTTP_POOL_HOSTS,
+        maxsize=HTTP_POOL_MAXSIZE,
+        timeout=urllib3.Timeout(connect=HTTP_CONNECT_TIMEOUT, read=HTTP_READ_TIMEOUT)
+    )))
+    for module in (cloudinary.uploader, call_api):
+        if hasattr(module, '_http'):
+            module._http = pool
+        else:
+            print(f"[HTTP] Cloudinary SDK {cloudinary.VERSION}: {module.__name__} has no _http pool, "
+                  f"it keeps its own connections", flush=True)
+
+
+class _TimeoutAdapter(HTTPAdapter):
+    """HTTPAdapter that applies the default timeouts when a call sets none."""
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        return super().send(request, **kwargs)
+
+
+def get_session() -> requests.Session:
+    """requests.Session shared by the process, with pooled keep-alive connections."""
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = _TimeoutAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def download(url: str, timeout: Optional[float] = None) -> Optional[bytes]:
+    """
+    Download a URL over the shared session.
+
+    Returns:
+        Response body, or None if the request failed
+    """
+    try:
+        response = get_session().get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+    except requests.RequestException as e:
+        print(f"[HTTP] Download failed for {url[:60]}: {str(e)}", flush=True)
+        return None
@@ -0,0 +1,162 @@
+"""
+Photo Normalizer Module
+Decodes the captured photo once, fixes EXIF orientation, downscales it to the
+face-swap working resolution and re-encodes it as a compact JPEG/WebP.
+crop_face() then cuts the face-centred square used as the swap source.
+
+The normalized bytes are what gets uploaded to Cloudinary and fetched by
+Replicate, so a 3-6 MB 1080p PNG becomes a few hundred KB.
+"""
+
+import os
+import time
+from io import BytesIO
+from typing import Optional, Dict, Any, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Longest side (pixels) sent to the face-swap provider
+PHOTO_MAX_SIDE = int(os.getenv('PHOTO_MAX_SIDE', '1024'))
+
+# Output encoding: JPEG or WEBP
+PHOTO_FORMAT = os.getenv('PHOTO_FORMAT', 'JPEG').upper()
+
+# Encoder quality (1-100)
+PHOTO_QUALITY = int(os.getenv('PHOTO_QUALITY', '85'))
+
+# Face-centred crop sent as the swap source (set FACE_CROP=0 to send the full frame)
+FACE_CROP = os.getenv('FACE_CROP', '1') == '1'
+
+# Side length (pixels) of the square crop
+FACE_CROP_SIZE = int(os.getenv('FACE_CROP_SIZE', '512'))
+
+# Margin around the face on each side, as a fraction of the face size
+FACE_CROP_PADDING = float(os.getenv('FACE_CROP_PADDING', '0.6'))
+
+_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+}
+
+
+def normalize_photo(image_bytes: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Normalize a captured photo for upload and face processing.
+
+    Args:
+        image_bytes: Raw image data as uploaded by the kiosk
+
+    Returns:
+        Dict with:
+        - 'bytes': re-encoded image data
+        - 'mime_type': MIME type of 'bytes'
+        - 'array': decoded BGR numpy array (for OpenCV stages, no re-decode)
+        - 'width' / 'height': normalized dimensions
+        or None if the image could not be decoded
+    """
+    try:
+        start = time.time()
+
+        if not image_bytes:
+            print("[Normalize] Error: Empty image bytes", flush=True)
+            return None
+
+        image = Image.open(BytesIO(image_bytes))
+        original_size = image.size
+
+        # Apply camera orientation before anything looks at the pixels
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        # Downscale in place (keeps aspect ratio, never upscales)
+        image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), Image.LANCZOS)
+
+        normalized_bytes, mime_type = _encode(image)
+
+        # OpenCV stages expect BGR
+        array = np.asarray(image)[:, :, ::-1].copy()
+
+        elapsed_ms = (time.time() - start) * 1000
+        print(f"[Normalize] {original_size[0]}x{original_size[1]} ({len(image_bytes)} bytes) -> "
+              f"{image.width}x{image.height} {mime_type} ({len(normalized_bytes)} bytes) "
+              f"in {elapsed_ms:.0f} ms", flush=True)
+
+        return {
+            'bytes': normalized_bytes,
+            'mime_type': mime_type,
+            'array': array,
+            'width': image.width,
+            'height': image.height,
+        }
+
+    except Exception as e:
+        print(f"[Normalize] Failed to normalize photo: {str(e)}", flush=True)
+        return None
+
+
+def _encode(image: Image.Image) -> Tuple[bytes, str]:
+    """Encode a PIL image with the configured format and quality."""
+    output_format = PHOTO_FORMAT if PHOTO_FORMAT in _MIME_TYPES else 'JPEG'
+    buffer = BytesIO()
+    image.save(buffer, format=output_format, quality=PHOTO_QUALITY)
+    return buffer.getvalue(), _MIME_TYPES[output_format]
+
+
+def crop_face(
+    array: np.ndarray,
+    face: Tuple[int, int, int, int]
+) -> Dict[str, Any]:
+    """
+    Cut a padded square around the face and resize it to FACE_CROP_SIZE.
+
+    Args:
+        array: Normalized BGR image (from normalize_photo)
+        face: (x, y, w, h) face box in that image
+
+    Returns:
+        Dict with 'bytes', 'mime_type', 'array', 'width', 'height' (same shape
+        as normalize_photo) plus 'face': the face box in crop coordinates
+    """
+    height, width = array.shape[:2]
+    x, y, w, h = face
+
+    # Square around the face centre, shrunk and shifted to stay in the frame
+    side = int(max(w, h) * (1 + 2 * FACE_CROP_PADDING))
+    side = min(side, width, height)
+    center_x = x + w // 2
+    center_y = y + h // 2
+    x0 = min(max(0, center_x - side // 2), width - side)
+    y0 = min(max(0, center_y - side // 2), height - side)
+
+    crop = array[y0:y0 + side, x0:x0 + side]
+    interpolation = cv2.INTER_AREA if side > FACE_CROP_SIZE else cv2.INTER_LINEAR
+    crop = cv2.resize(crop, (FACE_CROP_SIZE, FACE_CROP_SIZE), interpolation=interpolation)
+
+    factor = FACE_CROP_SIZE / float(side)
+    crop_face_box = (
+        int((x - x0) * factor),
+        int((y - y0) * factor),
+        int(w * factor),
+        int(h * factor),
+    )
+
+    crop_bytes, mime_type = _encode(Image.fromarray(crop[:, :, ::-1]))
+    print(f"[Normalize] Face crop {side}x{side} at ({x0},{y0}) -> "
+          f"{FACE_CROP_SIZE}x{FACE_CROP_SIZE} ({len(crop_bytes)} bytes)", flush=True)
+
+    return {
+        'bytes': crop_bytes,
+        'mime_type': mime_type,
+        'array': crop,
+        'width': FACE_CROP_SIZE,
+        'height': FACE_CROP_SIZE,
+        'face': crop_face_box,
+    }
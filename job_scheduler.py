@@ -0,0 +1,147 @@
+"""
+Job Scheduler Module
+Runs periodic background jobs inside the app. Every gunicorn worker starts
+the same schedule, but a lease row in a shared SQLite file (WAL mode) makes
+sure each run happens in only one worker.
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Any
+from dotenv import load_dotenv
+
+import sqlite_db
+
+# Load environment variables
+load_dotenv()
+
+SCHEDULER_DB_PATH = os.getenv('SCHEDULER_DB_PATH', 'scheduler.db')
+
+# Identifies this process in the lease table (for logs / debugging)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_started_jobs = set()
+_jobs_lock = threading.Lock()
+_schema_ready = False
+
+# Last result per job in this process, reported by /health
+job_stats = {}
+
+
+def _connect() -> sqlite3.Connection:
+    """Return this thread's connection to the scheduler database."""
+    global _schema_ready
+    conn = sqlite_db.connect(SCHEDULER_DB_PATH)
+    if not _schema_ready:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_leases ("
+            " name TEXT PRIMARY KEY,"
+            " holder TEXT,"
+            " locked_until REAL NOT NULL DEFAULT 0,"
+            " next_run_at REAL NOT NULL DEFAULT 0)"
+        )
+        _schema_ready = True
+    return conn
+
+
+def try_acquire(name: str, lease_seconds: float) -> bool:
+    """
+    Take the lease for a job if it is due and nobody else holds it.
+
+    Args:
+        name: Job name
+        lease_seconds: How long the lease is held if the holder dies mid-run
+
+    Returns:
+        True if this worker should run the job now
+    """
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("INSERT OR IGNORE INTO job_leases (name) VALUES (?)", (name,))
+        row = conn.execute(
+            "SELECT locked_until, next_run_at FROM job_leases WHERE name = ?", (name,)
+        ).fetchone()
+        acquired = now >= row[0] and now >= row[1]
+        if acquired:
+            conn.execute(
+                "UPDATE job_leases SET holder = ?, locked_until = ? WHERE name = ?",
+                (WORKER_ID, now + lease_seconds, name)
+            )
+        conn.execute("COMMIT")
+        return acquired
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def renew(name: str, lease_seconds: float) -> bool:
+    """
+    Extend a lease this worker holds (for long-running jobs).
+
+    Returns:
+        False if the lease was lost (expired and taken by another worker)
+    """
+    cursor = _connect().execute(
+        "UPDATE job_leases SET locked_until = ? WHERE name = ? AND holder = ?",
+        (time.time() + lease_seconds, name, WORKER_ID)
+    )
+    return cursor.rowcount == 1
+
+
+def release(name: str, interval: float) -> None:
+    """Release a job's lease and schedule its next run."""
+    now = time.time()
+    _connect().execute(
+        "UPDATE job_leases SET holder = NULL, locked_until = 0, next_run_at = ? WHERE name = ?",
+        (now + interval, name)
+    )
+
+
+def schedule(name: str, interval: float, job: Callable[[], Any], lease_seconds: float = 600) -> None:
+    """
+    Run `job` every `interval` seconds on a daemon thread, in one worker at a time.
+    Calling it again for the same name in the same process is a no-op.
+
+    Args:
+        name: Job name (shared across workers)
+        interval: Seconds between runs
+        job: Callable to run; its return value is recorded in job_stats
+        lease_seconds: Lease length, should exceed the job's worst-case runtime
+    """
+    with _jobs_lock:
+        if name in _started_jobs:
+            return
+        _started_jobs.add(name)
+
+    def _run():
+        # Check a few times per interval so a dead holder's lease is picked up
+        poll = max(5.0, min(interval / 4, 60.0))
+        while True:
+            try:
+                if try_acquire(name, lease_seconds):
+                    started = time.time()
+                    try:
+                        result = job()
+                        job_stats[name] = {
+                            'last_run': started,
+                            'duration': round(time.time() - started, 2),
+                            'result': result,
+                        }
+                    finally:
+                        release(name, interval)
+            except Exception as e:
+                print(f"[Scheduler] Job '{name}' failed: {str(e)}", flush=True)
+            time.sleep(poll)
+
+    threading.Thread(target=_run, name=f'job-{name}', daemon=True).start()
+    print(f"[Scheduler] Scheduled '{name}' every {interval:.0f}s", flush=True)
+
+
+def get_job_stats() -> Dict[str, Any]:
+    """Return a copy of the per-job results recorded in this process."""
+    return dict(job_stats)
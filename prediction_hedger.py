@@ -0,0 +1,259 @@
+"""
+Prediction Hedger Module
+Trims Replicate's latency tail: when a prediction is still unfinished after
+the observed p95 (HEDGE_PERCENTILE) of recent prediction durations, a second
+identical prediction is started and whichever finishes first wins. The
+loser is canceled and its entry dropped.
+
+The background poller (status_poller.py) starts hedges on their own
+schedule, webhook or not, so kiosk status checks never wait on one; the
+poller and the webhook cancel the loser as soon as either side succeeds. Hedges are capped per day (HEDGE_DAILY_BUDGET,
+shared by all workers via the prediction store) and each takes an admission
+slot like a queued job; one is only started while a slot is free and no
+kiosk is waiting, so hedges only spend spare capacity.
+"""
+
+import os
+import threading
+import time
+from datetime import date
+from typing import Optional, Dict, Any
+from dotenv import load_dotenv
+
+import admission_queue
+import face_backends
+import replicate_helper
+
+# Load environment variables
+load_dotenv()
+
+# Set HEDGE_ENABLED=1 to hedge slow predictions
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', '0') == '1'
+
+# Hedge once a prediction is older than this percentile of recent durations
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+
+# Delay used until enough durations were observed, and the lower bound (seconds)
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '45'))
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '15'))
+
+# Most hedges started per calendar day (local time)
+HEDGE_DAILY_BUDGET = int(os.getenv('HEDGE_DAILY_BUDGET', '50'))
+
+# Durations needed before the percentile replaces HEDGE_DEFAULT_DELAY
+HEDGE_MIN_SAMPLES = 20
+
+TERMINAL_STATUSES = ('succeeded', 'failed', 'canceled')
+
+# Running totals, reported by /health
+hedge_stats = {
+    'started': 0,
+    'hedge_won': 0,
+    'primary_won': 0,
+    'budget_exhausted': 0,
+    'no_slot': 0,
+}
+_stats_lock = threading.Lock()
+
+# Day whose exhausted budget was already logged (the poller retries every tick)
+_budget_logged_day = None
+
+
+def _count(key: str) -> None:
+    """Increment one hedge_stats counter (pollers run on several threads)."""
+    with _stats_lock:
+        hedge_stats[key] += 1
+
+
+def hedge_delay() -> float:
+    """Seconds after which an unfinished prediction gets a hedge."""
+    observed = replicate_helper.latency_percentile(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    if observed is None:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, observed)
+
+
+def can_hedge(data: Dict[str, Any]) -> bool:
+    """True if this entry could still get a hedge (a primary without one)."""
+    return (HEDGE_ENABLED and not data.get('hedge_of') and not data.get('hedge_id')
+            and bool(data.get('inputs')) and not data.get('status_info'))
+
+
+def maybe_start_hedge(store, prediction_id: str, data: Dict[str, Any]) -> Optional[str]:
+    """
+    Start a hedge for a slow prediction if it is due and allowed.
+
+    Args:
+        store: Prediction store (see prediction_store.py)
+        prediction_id: The primary prediction
+        data: Its store entry (needs 'inputs' and 'created_at')
+
+    Returns:
+        The hedge's prediction ID, or None if no hedge was started
+    """
+    if not can_hedge(data):
+        return None
+    if time.time() - data['created_at'] < hedge_delay():
+        return None
+
+    # One hedge per prediction, decided by whichever poller gets here first
+    if store.claim_alias(f"hedge:{prediction_id}", {'pending': True}, data['expires_at']) is not None:
+        return None
+
+    # Every path that does not start a hedge gives the claim back, so a
+    # later poll can try again
+    slot_id = admission_queue.take_slot()
+    if slot_id is None:
+        # No spare capacity now; a later poll may find some
+        _count('no_slot')
+        store.delete_alias(f"hedge:{prediction_id}")
+        return None
+
+    global _budget_logged_day
+    budget_key = f"hedge-budget:{date.today().isoformat()}"
+    if not store.take_quota(budget_key, HEDGE_DAILY_BUDGET, time.time() + 86400 * 2):
+        _count('budget_exhausted')
+        admission_queue.release_slot(slot_id)
+        store.delete_alias(f"hedge:{prediction_id}")
+        if _budget_logged_day != budget_key:
+            _budget_logged_day = budget_key
+            print(f"[Hedge] Daily budget of {HEDGE_DAILY_BUDGET} spent, not hedging until tomorrow", flush=True)
+        return None
+
+    print(f"[Hedge] {prediction_id} unfinished after {time.time() - data['created_at']:.0f}s, "
+          f"starting a hedge...", flush=True)
+    # Identical prediction: same inputs on the same backend
+    inputs = data['inputs']
+    backend = face_backends.get_backend(data.get('backend'))
+    prediction_info = backend.start(inputs['child_image_url'], inputs['mask_image_url'], data['character'])
+    if not prediction_info:
+        # Nothing was started: refund the budget along with the slot
+        admission_queue.release_slot(slot_id)
+        store.release_quota(budget_key)
+        store.delete_alias(f"hedge:{prediction_id}")
+        return None
+
+    hedge_id = prediction_info['prediction_id']
+    admission_queue.bind_slot(slot_id, hedge_id)
+    store.create(hedge_id, {
+        'hedge_of': prediction_id,
+        'backend': backend.name,
+        'version': prediction_info.get('version'),
+        'character': data['character'],
+        'status': 'processing',
+        'created_at': prediction_info['created_at'],
+        'expires_at': data['expires_at'],
+        'webhook': prediction_info.get('webhook', False),
+        'status_info': None
+    })
+    store.update(prediction_id, hedge_id=hedge_id, hedge_backend=backend.name,
+                 hedge_version=prediction_info.get('version'))
+    _count('started')
+    return hedge_id
+
+
+def combine(primary_info: Dict[str, Any], hedge_info: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge the primary's and the hedge's status into the one the kiosk sees.
+
+    A success from either wins. A failure only counts once both have failed,
+    so the other can still rescue the swap. The returned dict's
+    'prediction_id' is the winner's; 'hedge_loser' names the other
+    prediction if it is still running and must be canceled.
+    """
+    if not hedge_info:
+        return primary_info
+
+    primary_status = primary_info['status']
+    hedge_status = hedge_info['status']
+
+    if primary_status == 'succeeded':
+        winner, loser, loser_status = primary_info, hedge_info, hedge_status
+    elif hedge_status == 'succeeded':
+        winner, loser, loser_status = hedge_info, primary_info, primary_status
+    elif primary_status in TERMINAL_STATUSES and hedge_status in TERMINAL_STATUSES:
+        return primary_info
+    elif primary_status in TERMINAL_STATUSES:
+        return dict(hedge_info, status='processing')
+    else:
+        return primary_info
+
+    result = dict(winner)
+    if loser_status not in TERMINAL_STATUSES:
+        result['hedge_loser'] = loser['prediction_id']
+    return result
+
+
+def cancel_loser(store, prediction_id: str, status_info: Dict[str, Any]) -> Optional[str]:
+    """
+    Cancel the other half of a hedged pair once one side has succeeded, so
+    the loser stops running (and billing) before any kiosk claims the result.
+
+    Args:
+        store: Prediction store
+        prediction_id: The prediction that just finished
+        status_info: Its final status
+
+    Returns:
+        The canceled prediction's ID, or None if there was nothing to cancel
+    """
+    if status_info.get('status') != 'succeeded':
+        return None
+    data = store.get(prediction_id)
+    if not data:
+        return None
+
+    if data.get('hedge_of'):
+        primary_id, loser_id = data['hedge_of'], data['hedge_of']
+        loser = store.get(loser_id)
+        loser_backend = loser.get('backend') if loser else None
+    elif data.get('hedge_id'):
+        primary_id, loser_id = prediction_id, data['hedge_id']
+        loser = store.get(loser_id)
+        loser_backend = data.get('hedge_backend')
+    else:
+        return None
+
+    if not loser or loser.get('status') in TERMINAL_STATUSES:
+        return None
+    print(f"[Hedge] {prediction_id} succeeded, canceling {loser_id}", flush=True)
+    face_backends.get_backend(loser_backend).cancel(loser_id)
+    # settle() then knows the loser is already stopped
+    store.update(primary_id, loser_canceled=loser_id)
+    return loser_id
+
+
+def settle(store, primary_data: Dict[str, Any], status_info: Dict[str, Any]) -> None:
+    """
+    Finish a hedged prediction once the outcome is final: cancel the loser
+    if it is still running and drop the hedge's store entry.
+
+    Args:
+        store: Prediction store
+        primary_data: The primary's entry (already popped by the caller)
+        status_info: Final status from combine()
+    """
+    hedge_id = primary_data.get('hedge_id')
+    if not hedge_id:
+        return
+
+    loser = status_info.get('hedge_loser')
+    if loser and primary_data.get('loser_canceled') != loser:
+        loser_backend = primary_data.get('hedge_backend') if loser == hedge_id else primary_data.get('backend')
+        face_backends.get_backend(loser_backend).cancel(loser)
+
+    if status_info['status'] == 'succeeded':
+        hedge_won = status_info.get('prediction_id') == hedge_id
+        _count('hedge_won' if hedge_won else 'primary_won')
+        print(f"[Hedge] {'Hedge' if hedge_won else 'Primary'} finished first "
+              f"({status_info.get('prediction_id')})", flush=True)
+
+    store.pop(hedge_id)
+    admission_queue.finish(hedge_id)
+
+
+def get_hedge_stats() -> Dict[str, Any]:
+    """Return hedge counters and the current hedge delay."""
+    with _stats_lock:
+        stats = dict(hedge_stats)
+    return dict(stats, enabled=HEDGE_ENABLED, delay_seconds=round(hedge_delay(), 1))
@@ -0,0 +1,105 @@
+"""
+Prediction Reaper Module
+Evicts predictions nobody polled to completion (kiosk user walked away,
+browser reloaded) once their 'expires_at' passes: cancels the Replicate
+prediction, frees its admission slot and queues the temp images it left in
+Cloudinary for deletion.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Any
+from dotenv import load_dotenv
+
+import admission_queue
+import cleanup_queue
+import face_backends
+
+# Load environment variables
+load_dotenv()
+
+# Seconds between reaper passes
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', '60'))
+
+# Entries claimed per batch (matches Cloudinary's bulk delete limit)
+REAPER_BATCH_SIZE = 100
+
+# Running totals, reported by /health
+reaper_stats = {
+    'runs': 0,
+    'reclaimed_total': 0,
+    'last_run': None,
+    'last_reclaimed': 0,
+}
+
+_reaper_started = False
+_reaper_lock = threading.Lock()
+
+
+def reap_expired_predictions(store) -> int:
+    """
+    Evict every expired prediction from the store, in batches.
+
+    Args:
+        store: Prediction store (see prediction_store.py)
+
+    Returns:
+        Number of predictions reclaimed
+    """
+    reclaimed = 0
+
+    while True:
+        expired = store.pop_expired(time.time(), limit=REAPER_BATCH_SIZE)
+        if not expired:
+            break
+
+        temp_image_ids = []
+        for prediction_id, data in expired:
+            # Only unfinished predictions are still burning provider time
+            if data.get('status') not in ('succeeded', 'failed', 'canceled'):
+                face_backends.get_backend(data.get('backend')).cancel(prediction_id)
+            admission_queue.finish(prediction_id)
+            temp_image_ids.append(data.get('child_cloudinary_id'))
+            temp_image_ids.append(data.get('mask_cloudinary_id'))
+
+        cleanup_queue.enqueue(temp_image_ids)
+        reclaimed += len(expired)
+
+    store.purge_expired_aliases(time.time())
+
+    reaper_stats['runs'] += 1
+    reaper_stats['reclaimed_total'] += reclaimed
+    reaper_stats['last_run'] = time.time()
+    reaper_stats['last_reclaimed'] = reclaimed
+
+    if reclaimed:
+        print(f"[Reaper] Reclaimed {reclaimed} abandoned predictions", flush=True)
+    return reclaimed
+
+
+def start_reaper(store) -> None:
+    """
+    Start the background reaper thread (once per process). With the SQLite
+    store every worker may run one; pop_expired hands each entry to only one.
+    """
+    global _reaper_started
+    with _reaper_lock:
+        if _reaper_started:
+            return
+        _reaper_started = True
+
+    def _run():
+        while True:
+            time.sleep(REAPER_INTERVAL)
+            try:
+                reap_expired_predictions(store)
+            except Exception as e:
+                print(f"[Reaper] Error during reaping: {str(e)}", flush=True)
+
+    threading.Thread(target=_run, name='prediction-reaper', daemon=True).start()
+
+
+def get_reaper_stats() -> Dict[str, Any]:
+    """Return a copy of the reaper counters."""
+    return dict(reaper_stats)
@@ -0,0 +1,408 @@
+"""
+Prediction State Store Module
+Keeps per-prediction state (temp image IDs, status, webhook results) so any
+gunicorn worker can answer /check-status for a prediction started elsewhere.
+
+Backends:
+- memory: in-process dict (single worker, default)
+- sqlite: shared SQLite database in WAL mode (multiple workers on one box)
+
+Entries carry an 'expires_at' timestamp; pop_expired() lets the reaper
+claim abandoned predictions, items() lets the status poller walk the
+active ones.
+
+Aliases map a request-level key (idempotency key, in-flight content hash)
+to the response a duplicate request should get; claim_alias() is an atomic
+set-if-absent so exactly one request becomes the leader. take_quota()
+counts uses of a shared budget in the same table.
+
+Select with PREDICTION_STORE=memory|sqlite (and PREDICTION_DB_PATH).
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+import sqlite_db
+
+# Load environment variables
+load_dotenv()
+
+PREDICTION_STORE = os.getenv('PREDICTION_STORE', 'memory').lower()
+PREDICTION_DB_PATH = os.getenv('PREDICTION_DB_PATH', 'predictions.db')
+
+
+class InMemoryPredictionStore:
+    """Prediction state held in a dict, guarded by a lock."""
+
+    def __init__(self):
+        self._predictions = {}
+        self._aliases = {}  # alias -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def create(self, prediction_id: str, data: Dict[str, Any]) -> None:
+        """Store state for a newly started prediction."""
+        with self._lock:
+            self._predictions[prediction_id] = dict(data)
+
+    def get(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        """Return a copy of the prediction's state, or None if unknown."""
+        with self._lock:
+            data = self._predictions.get(prediction_id)
+            return dict(data) if data is not None else None
+
+    def update(self, prediction_id: str, **fields) -> Optional[Dict[str, Any]]:
+        """
+        Atomically merge fields into the prediction's state.
+
+        Returns:
+            The updated state, or None if the prediction is unknown
+        """
+        with self._lock:
+            data = self._predictions.get(prediction_id)
+            if data is None:
+                return None
+            data.update(fields)
+            return dict(data)
+
+    def pop(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Atomically remove and return the prediction's state.
+        Only one caller gets the state back, so cleanup runs exactly once.
+        """
+        with self._lock:
+            return self._predictions.pop(prediction_id, None)
+
+    def pop_expired(self, now: float, limit: int = 100) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Atomically remove and return up to `limit` entries whose
+        'expires_at' is earlier than `now`.
+        """
+        with self._lock:
+            expired = [
+                prediction_id for prediction_id, data in self._predictions.items()
+                if data.get('expires_at') is not None and data['expires_at'] < now
+            ][:limit]
+            return [(prediction_id, self._predictions.pop(prediction_id)) for prediction_id in expired]
+
+    def items(self, limit: int = 500) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return (prediction_id, state) copies of up to `limit` active entries."""
+        with self._lock:
+            return [(prediction_id, dict(data)) for prediction_id, data in self._predictions.items()][:limit]
+
+    def claim_alias(self, alias: str, value: Dict[str, Any], expires_at: float) -> Optional[Dict[str, Any]]:
+        """
+        Atomically set an alias if it is absent (or expired).
+
+        Returns:
+            None if this caller claimed the alias, otherwise its current value
+        """
+        with self._lock:
+            entry = self._aliases.get(alias)
+            if entry is not None and entry[1] > time.time():
+                return dict(entry[0])
+            self._aliases[alias] = (dict(value), expires_at)
+            return None
+
+    def get_alias(self, alias: str) -> Optional[Dict[str, Any]]:
+        """Return an alias's value, or None if absent or expired."""
+        with self._lock:
+            entry = self._aliases.get(alias)
+            if entry is None or entry[1] <= time.time():
+                return None
+            return dict(entry[0])
+
+    def set_alias(self, alias: str, value: Dict[str, Any], expires_at: float) -> None:
+        """Create or overwrite an alias."""
+        with self._lock:
+            self._aliases[alias] = (dict(value), expires_at)
+
+    def delete_alias(self, alias: str) -> None:
+        """Remove an alias (no-op if absent)."""
+        with self._lock:
+            self._aliases.pop(alias, None)
+
+    def take_quota(self, key: str, limit: int, expires_at: float) -> bool:
+        """
+        Atomically count one use of a quota (e.g. a daily budget).
+
+        Returns:
+            True if the use fit under the limit, False if it is exhausted
+        """
+        with self._lock:
+            entry = self._aliases.get(key)
+            used = entry[0].get('count', 0) if entry is not None and entry[1] > time.time() else 0
+            if used >= limit:
+                return False
+            self._aliases[key] = ({'count': used + 1}, expires_at)
+            return True
+
+    def release_quota(self, key: str) -> None:
+        """Give back one use taken with take_quota (e.g. the work then failed to start)."""
+        with self._lock:
+            entry = self._aliases.get(key)
+            if entry is not None and entry[1] > time.time() and entry[0].get('count', 0) > 0:
+                self._aliases[key] = ({'count': entry[0]['count'] - 1}, entry[1])
+
+    def purge_expired_aliases(self, now: float) -> int:
+        """Drop expired aliases; returns how many were removed."""
+        with self._lock:
+            expired = [alias for alias, entry in self._aliases.items() if entry[1] <= now]
+            for alias in expired:
+                del self._aliases[alias]
+            return len(expired)
+
+    def __contains__(self, prediction_id: str) -> bool:
+        with self._lock:
+            return prediction_id in self._predictions
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._predictions)
+
+
+class SQLitePredictionStore:
+    """
+    Prediction state in a SQLite database shared by all workers on a box.
+    Uses WAL mode so readers never block the writer, and BEGIN IMMEDIATE
+    transactions so read-modify-write updates are atomic across processes.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            " prediction_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " expires_at REAL)"
+        )
+        # Databases created before expiry support lack the column
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(predictions)")]
+        if 'expires_at' not in columns:
+            conn.execute("ALTER TABLE predictions ADD COLUMN expires_at REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_predictions_expires ON predictions (expires_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS aliases ("
+            " alias TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection (sqlite3 connections are per-thread)."""
+        return sqlite_db.connect(self.db_path)
+
+    def create(self, prediction_id: str, data: Dict[str, Any]) -> None:
+        """Store state for a newly started prediction."""
+        self._connect().execute(
+            "INSERT OR REPLACE INTO predictions (prediction_id, data, updated_at, expires_at) "
+            "VALUES (?, ?, ?, ?)",
+            (prediction_id, json.dumps(data), time.time(), data.get('expires_at'))
+        )
+
+    def get(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        """Return the prediction's state, or None if unknown."""
+        row = self._connect().execute(
+            "SELECT data FROM predictions WHERE prediction_id = ?", (prediction_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, prediction_id: str, **fields) -> Optional[Dict[str, Any]]:
+        """
+        Atomically merge fields into the prediction's state.
+
+        Returns:
+            The updated state, or None if the prediction is unknown
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM predictions WHERE prediction_id = ?", (prediction_id,)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            data = json.loads(row[0])
+            data.update(fields)
+            conn.execute(
+                "UPDATE predictions SET data = ?, updated_at = ?, expires_at = ? WHERE prediction_id = ?",
+                (json.dumps(data), time.time(), data.get('expires_at'), prediction_id)
+            )
+            conn.execute("COMMIT")
+            return data
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def pop(self, prediction_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Atomically remove and return the prediction's state.
+        Only one caller (in any worker) gets the state back.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM predictions WHERE prediction_id = ?", (prediction_id,)
+            ).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM predictions WHERE prediction_id = ?", (prediction_id,))
+            conn.execute("COMMIT")
+            return json.loads(row[0]) if row else None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def pop_expired(self, now: float, limit: int = 100) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Atomically remove and return up to `limit` entries whose
+        'expires_at' is earlier than `now`. Safe to run from every worker:
+        each expired entry is claimed by exactly one of them.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT prediction_id, data FROM predictions "
+                "WHERE expires_at IS NOT NULL AND expires_at < ? LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            conn.executemany(
+                "DELETE FROM predictions WHERE prediction_id = ?",
+                [(row[0],) for row in rows]
+            )
+            conn.execute("COMMIT")
+            return [(row[0], json.loads(row[1])) for row in rows]
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def items(self, limit: int = 500) -> List[Tuple[str, Dict[str, Any]]]:
+        """Return (prediction_id, state) of up to `limit` active entries."""
+        rows = self._connect().execute(
+            "SELECT prediction_id, data FROM predictions LIMIT ?", (limit,)
+        ).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def claim_alias(self, alias: str, value: Dict[str, Any], expires_at: float) -> Optional[Dict[str, Any]]:
+        """
+        Atomically set an alias if it is absent (or expired), across workers.
+
+        Returns:
+            None if this caller claimed the alias, otherwise its current value
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM aliases WHERE alias = ? AND expires_at > ?", (alias, time.time())
+            ).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO aliases (alias, data, expires_at) VALUES (?, ?, ?)",
+                    (alias, json.dumps(value), expires_at)
+                )
+            conn.execute("COMMIT")
+            return json.loads(row[0]) if row else None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_alias(self, alias: str) -> Optional[Dict[str, Any]]:
+        """Return an alias's value, or None if absent or expired."""
+        row = self._connect().execute(
+            "SELECT data FROM aliases WHERE alias = ? AND expires_at > ?", (alias, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_alias(self, alias: str, value: Dict[str, Any], expires_at: float) -> None:
+        """Create or overwrite an alias."""
+        self._connect().execute(
+            "INSERT OR REPLACE INTO aliases (alias, data, expires_at) VALUES (?, ?, ?)",
+            (alias, json.dumps(value), expires_at)
+        )
+
+    def delete_alias(self, alias: str) -> None:
+        """Remove an alias (no-op if absent)."""
+        self._connect().execute("DELETE FROM aliases WHERE alias = ?", (alias,))
+
+    def take_quota(self, key: str, limit: int, expires_at: float) -> bool:
+        """
+        Atomically count one use of a quota (e.g. a daily budget), across workers.
+
+        Returns:
+            True if the use fit under the limit, False if it is exhausted
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM aliases WHERE alias = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+            used = json.loads(row[0]).get('count', 0) if row else 0
+            if used >= limit:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO aliases (alias, data, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps({'count': used + 1}), expires_at)
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release_quota(self, key: str) -> None:
+        """Give back one use taken with take_quota (e.g. the work then failed to start)."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM aliases WHERE alias = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+            used = json.loads(row[0]).get('count', 0) if row else 0
+            if used > 0:
+                conn.execute(
+                    "UPDATE aliases SET data = ? WHERE alias = ?", (json.dumps({'count': used - 1}), key)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def purge_expired_aliases(self, now: float) -> int:
+        """Drop expired aliases; returns how many were removed."""
+        return self._connect().execute("DELETE FROM aliases WHERE expires_at <= ?", (now,)).rowcount
+
+    def __contains__(self, prediction_id: str) -> bool:
+        row = self._connect().execute(
+            "SELECT 1 FROM predictions WHERE prediction_id = ?", (prediction_id,)
+        ).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+
+def create_prediction_store(backend: Optional[str] = None):
+    """
+    Create the prediction store selected by PREDICTION_STORE.
+
+    Args:
+        backend: 'memory' or 'sqlite' (defaults to PREDICTION_STORE)
+    """
+    backend = (backend or PREDICTION_STORE).lower()
+    if backend == 'sqlite':
+        print(f"[PredictionStore] Using SQLite store: {PREDICTION_DB_PATH}", flush=True)
+        return SQLitePredictionStore(PREDICTION_DB_PATH)
+    if backend != 'memory':
+        print(f"[PredictionStore] Unknown backend '{backend}', using memory", flush=True)
+    return InMemoryPredictionStore()
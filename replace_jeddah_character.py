@@ -17,5 +17,4 @@ print("\nPlease save the new character image as:")
 print(f"static/characters/{new_filename}")
 print("\nThen we'll:")
 print("1. Upload to Cloudinary")
-print("2. Update replicate_helper.py")
-print("3. Update index.html")
+print("2. Update its template and card in characters.json")
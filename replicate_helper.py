@@ -3,12 +3,24 @@ Replicate API Helper Module - IP-Adapter Face Inpaint
 Handles face blending using lucataco/ip_adapter-face-inpaint model.
 """
 
-import replicate
 import os
 import time
-from typing import Optional, Dict, Any
+import threading
+import base64
+import binascii
+import hashlib
+import hmac
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, Mapping, Callable
 from dotenv import load_dotenv
 
+import admission_queue
+import character_registry
+import http_pool
+import job_scheduler
+import resilience
+
 # Load environment variables
 load_dotenv()
 
@@ -17,223 +29,303 @@ REPLICATE_API_TOKEN = os.getenv('REPLICATE_API_TOKEN')
 if REPLICATE_API_TOKEN:
     os.environ['REPLICATE_API_TOKEN'] = REPLICATE_API_TOKEN
 
+# Shared client on the process's pooled keep-alive connections
+replicate_client = http_pool.get_replicate_client()
 
-# Character style mapping for SDXL IP-Adapter FaceID
-CHARACTER_STYLES = {
-    'superman': {
-        'prompt': '''Preserve the superhero's original head shape, jawline, skull structure,
-hair, hairstyle, costume, pose, and lighting exactly as in the base image.
 
-Subtly blend the child's facial characteristics into the face,
-including eyes, eyebrows, nose, mouth, and expression.
+# Webhook delivery: when REPLICATE_WEBHOOK_URL is set, predictions report
+# completion to it instead of being polled. The secret comes from
+# https://api.replicate.com/v1/webhooks/default/secret
+REPLICATE_WEBHOOK_URL = os.getenv('REPLICATE_WEBHOOK_URL', '')
+REPLICATE_WEBHOOK_SECRET = os.getenv('REPLICATE_WEBHOOK_SECRET', '')
+WEBHOOK_TOLERANCE_SECONDS = 300
 
-Child face, young facial proportions, soft facial features.
+# Seconds one Replicate API call may spend on retries in total
+REPLICATE_CALL_DEADLINE = float(os.getenv('REPLICATE_CALL_DEADLINE', '20'))
 
-No face swap. No replacement of head shape. Maintain superhero identity.
+# The SDK's transport already retries GET requests on these statuses with
+# backoff; resilience.call only counts them toward the breaker
+SDK_RETRIED_STATUSES = (429, 503, 504)
 
-Photorealistic. Cinematic lighting. Clean studio background. High detail.''',
-        
-        'negative_prompt': '''face swap, different jawline, different hair, adult face, aging,
-distorted face, cartoon, anime, exaggerated features, deformed,
-brown costume, gray costume, desaturated colors, muted colors''',
-        
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1768395277/templates/superman_template_vibrant_v4.png'
-    },
-    'batman': {
-        'prompt': '''Preserve the superhero's original head shape, jawline, skull structure,
-hair, hairstyle, costume, pose, and lighting exactly as in the base image.
+# Listed in /health from the start, not only after the first call
+resilience.get_breaker('replicate')
 
-Subtly blend the child's facial characteristics into the face,
-including eyes, eyebrows, nose, mouth, and expression.
 
-Child face, young facial proportions, soft facial features.
+# Characters (prompts, templates, per-character pins) live in characters.json,
+# see character_registry.py
 
-No face swap. No replacement of head shape. Maintain superhero identity.
 
-Photorealistic. Cinematic lighting. Clean studio background. High detail.''',
-        
-        'negative_prompt': '''face swap, different jawline, different hair, adult face, aging,
-distorted face, cartoon, anime, exaggerated features, deformed''',
-        
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1768659434/templates/batman_template_backend.jpg'
+# Model capability registry: which inputs each model consumes.
+# A field set to None means the model does not take that input, so
+# swap_face can skip the stage that would produce it (e.g. the mask).
+MODEL_CAPABILITIES = {
+    'yan-ops/face_swap': {
+        'source_field': 'source_image',     # Face to swap FROM
+        'target_field': 'target_image',     # Image to swap TO
+        'mask_field': None,
+        'prompt_field': None,
+        'negative_prompt_field': None,
+        'weight': 1.0,                      # 1.0 = complete swap, 0.5 = blend
+    },
+    'codeplugtech/face-swap': {
+        'source_field': 'swap_image',
+        'target_field': 'input_image',
+        'mask_field': None,
+        'prompt_field': None,
+        'negative_prompt_field': None,
+        'weight': None,
     },
-    'spiderman': {
-        'prompt': '''Preserve the superhero's original head shape, jawline, skull structure,
-hair, hairstyle, costume, pose, and lighting exactly as in the base image.
+    'lucataco/ip_adapter-face-inpaint': {
+        'source_field': 'face_image',
+        'target_field': 'source_image',
+        'mask_field': 'mask_image',
+        'prompt_field': 'prompt',
+        'negative_prompt_field': 'negative_prompt',
+        'weight': None,
+    },
+}
 
-Subtly blend the child's facial characteristics into the face,
-including eyes, eyebrows, nose, mouth, and expression.
+# Model used for face swapping (must be a key of MODEL_CAPABILITIES)
+FACE_SWAP_MODEL = os.getenv('FACE_SWAP_MODEL', 'yan-ops/face_swap')
 
-Child face, young facial proportions, soft facial features.
 
-No face swap. No replacement of head shape. Maintain superhero identity.
+# Model version resolution: pinned versions win, otherwise latest_version is
+# cached for MODEL_VERSION_TTL seconds and refreshed in the background.
+MODEL_VERSION_TTL = float(os.getenv('MODEL_VERSION_TTL', '3600'))
 
-Photorealistic. Cinematic lighting. Clean studio background. High detail.''',
-        
-        'negative_prompt': '''face swap, different jawline, different hair, adult face, aging,
-distorted face, cartoon, anime, exaggerated features, deformed''',
-        
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1768659435/templates/spiderman_template_backend.jpg'
-    },
-    'wonderwoman': {
-        'prompt': '''Preserve the superhero's original head shape, jawline, skull structure,
-hair, hairstyle, costume, pose, and lighting exactly as in the base image.
+# Optional pin for FACE_SWAP_MODEL (a Replicate version ID)
+PINNED_MODEL_VERSIONS = {}
+if os.getenv('REPLICATE_MODEL_VERSION'):
+    PINNED_MODEL_VERSIONS[FACE_SWAP_MODEL] = os.getenv('REPLICATE_MODEL_VERSION')
+
+_version_cache = {}          # model_name -> {'version_id': str, 'fetched_at': float}
+_version_lock = threading.Lock()
+_version_refreshing = set()  # model names with a background refresh in flight
+_version_refreshers = set()  # model names with a periodic refresher thread
 
-Subtly blend the child's facial characteristics into the face,
-including eyes, eyebrows, nose, mouth, and expression.
 
-Child face, young facial proportions, soft facial features.
+def _fetch_model_version(model_name: str) -> Optional[str]:
+    """
+    Fetch latest_version from the Replicate API and store it in the cache.
+    
+    Returns:
+        Version ID, or None if the lookup failed
+    """
+    try:
+        model = resilience.call('replicate', replicate_client.models.get, model_name,
+                                deadline=REPLICATE_CALL_DEADLINE, retried_statuses=SDK_RETRIED_STATUSES)
+        version_id = model.latest_version.id
+    except Exception as e:
+        print(f"[Replicate] Failed to resolve version for {model_name}: {str(e)}", flush=True)
+        return None
+    
+    with _version_lock:
+        previous = _version_cache.get(model_name)
+        _version_cache[model_name] = {'version_id': version_id, 'fetched_at': time.time()}
+    
+    if previous is None:
+        print(f"[Replicate] Resolved {model_name} version: {version_id[:12]}...", flush=True)
+    elif previous['version_id'] != version_id:
+        print(f"[Replicate] Model version changed for {model_name}: "
+              f"{previous['version_id'][:12]}... -> {version_id[:12]}...", flush=True)
+    return version_id
+
+
+def _refresh_in_background(model_name: str) -> None:
+    """Refresh a cached version on a daemon thread (one refresh per model at a time)."""
+    with _version_lock:
+        if model_name in _version_refreshing:
+            return
+        _version_refreshing.add(model_name)
+    
+    def _run():
+        try:
+            _fetch_model_version(model_name)
+        finally:
+            with _version_lock:
+                _version_refreshing.discard(model_name)
+    
+    threading.Thread(target=_run, name=f'version-refresh-{model_name}', daemon=True).start()
 
-No face swap. No replacement of head shape. Maintain superhero identity.
 
-Photorealistic. Cinematic lighting. Clean studio background. High detail.''',
-        
-        'negative_prompt': '''face swap, different jawline, different hair, adult face, aging,
-distorted face, cartoon, anime, exaggerated features, deformed''',
+def resolve_model_version(
+    model_name: Optional[str] = None,
+    character: Optional[character_registry.Character] = None,
+    fetch: bool = True
+) -> Optional[str]:
+    """
+    Resolve the Replicate version ID to use for a model.
+    
+    Pinned versions (the character's own pin first) are returned as-is. A
+    cached version is always returned immediately; if it is older than
+    MODEL_VERSION_TTL a background refresh is started. Only the very first
+    lookup for a model waits on the network, and only with fetch=True.
+    
+    Args:
+        model_name: Replicate model name (defaults to FACE_SWAP_MODEL)
+        character: Registry entry whose per-model pin takes precedence
+        fetch: False to never wait on the network: an uncached version
+            returns None and is fetched in the background
         
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1768659435/templates/wonderwoman_template_backend.jpg'
-    },
-    'ironman': {
-        'prompt': '''Preserve the superhero's original head shape, jawline, skull structure,
-hair, hairstyle, costume, pose, and lighting exactly as in the base image.
+    Returns:
+        Version ID, or None if it could not be resolved
+    """
+    model_name = model_name or FACE_SWAP_MODEL
+    
+    pinned = (character and character.pinned_version(model_name)) or PINNED_MODEL_VERSIONS.get(model_name)
+    if pinned:
+        return pinned
+    
+    with _version_lock:
+        entry = _version_cache.get(model_name)
+    
+    if entry is None:
+        if not fetch:
+            _refresh_in_background(model_name)
+            return None
+        return _fetch_model_version(model_name)
+    
+    if time.time() - entry['fetched_at'] > MODEL_VERSION_TTL:
+        _refresh_in_background(model_name)
+    return entry['version_id']
 
-Subtly blend the child's facial characteristics into the face,
-including eyes, eyebrows, nose, mouth, and expression.
 
-Child face, young facial proportions, soft facial features.
+def start_version_refresher(model_name: Optional[str] = None) -> None:
+    """
+    Start a daemon thread that resolves the model version now and keeps it
+    fresh every MODEL_VERSION_TTL / 2 seconds, so request threads never pay
+    for the lookup. Call once per model in use; safe to call more than once.
+    """
+    model_name = model_name or FACE_SWAP_MODEL
+    
+    with _version_lock:
+        if model_name in _version_refreshers or model_name in PINNED_MODEL_VERSIONS:
+            return
+        _version_refreshers.add(model_name)
+    
+    def _run():
+        while True:
+            _fetch_model_version(model_name)
+            time.sleep(max(MODEL_VERSION_TTL / 2, 60))
+    
+    threading.Thread(target=_run, name=f'version-refresher-{model_name}', daemon=True).start()
 
-No face swap. No replacement of head shape. Maintain superhero identity.
 
-Photorealistic. Cinematic lighting. Clean studio background. High detail.''',
+def get_model_capabilities(model_name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Look up the capability entry for a model.
+    
+    Args:
+        model_name: Replicate model name (defaults to FACE_SWAP_MODEL)
         
-        'negative_prompt': '''face swap, different jawline, different hair, adult face, aging,
-distorted face, cartoon, anime, exaggerated features, deformed''',
+    Returns:
+        Capability dict from MODEL_CAPABILITIES
         
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1768659436/templates/ironman_template_backend.jpg'
-    },
-    'captainamerica': {
-        'prompt': '''Preserve the superhero's original head shape, jawline, skull structure,
-hair, hairstyle, costume, pose, and lighting exactly as in the base image.
+    Raises:
+        KeyError: If the model is not registered
+    """
+    model_name = model_name or FACE_SWAP_MODEL
+    if model_name not in MODEL_CAPABILITIES:
+        raise KeyError(f"Model not registered in MODEL_CAPABILITIES: {model_name}")
+    return MODEL_CAPABILITIES[model_name]
 
-Subtly blend the child's facial characteristics into the face,
-including eyes, eyebrows, nose, mouth, and expression.
 
-Child face, young facial proportions, soft facial features.
+def model_uses_mask(model_name: Optional[str] = None) -> bool:
+    """Return True if the model takes a face mask input."""
+    return get_model_capabilities(model_name)['mask_field'] is not None
 
-No face swap. No replacement of head shape. Maintain superhero identity.
 
-Photorealistic. Cinematic lighting. Clean studio background. High detail.''',
-        
-        'negative_prompt': '''face swap, different jawline, different hair, adult face, aging,
-distorted face, cartoon, anime, exaggerated features, deformed''',
-        
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1768659437/templates/captainamerica_template_backend.jpg'
-    },
-    'saudi_central_male': {
-        'prompt': 'Saudi man wearing traditional bisht and thobe, photorealistic, cinematic lighting',
-        'negative_prompt': 'cartoon, drawing, anime, low quality',
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/templates/saudi_central_male_v7.png'
-    },
-    'saudi_traditional_daglah': {
-        'prompt': 'Saudi man wearing traditional daglah with golden embroidered patterns and black bandolier, white shemagh with black agal, photorealistic, cinematic lighting, traditional Saudi heritage setting',
-        'negative_prompt': 'cartoon, drawing, anime, low quality, modern clothing, western clothing',
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1770104351/templates/saudi_traditional_daglah.jpg'
-    },
-    'jeddah_character_updated_1770487272655': {
-        'prompt': 'Young Saudi man wearing white bisht over black thobe, white shemagh with gold-striped agal, clean-shaven face with very light mustache, Jeddah cityscape background, photorealistic, professional photography, natural lighting',
-        'negative_prompt': 'cartoon, drawing, anime, low quality, modern clothing, western clothing, old man, elderly, goatee, beard, heavy mustache',
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1770487272/templates/jeddah_character_updated.jpg'
-    },
-    'daglah_child_character_1770488439465': {
-        'prompt': 'Saudi Arabian boy child aged 8-12 years old wearing traditional daglah with golden embroidery and black bandolier, white shemagh with black agal, child face, young boy, photorealistic, professional photography, natural lighting',
-        'negative_prompt': 'cartoon, drawing, anime, low quality, modern clothing, western clothing, adult, teenager, facial hair, beard, mustache',
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1770488439/templates/daglah_child_character.jpg'
-    },
-    'sharqawi_dress_character_1770578762613': {
-        'prompt': 'Saudi Arabian woman wearing traditional Eastern Province (Sharqiyah) black dress with intricate gold embroidery, black hijab with gold trim, elegant appearance, photorealistic, professional photography, natural lighting, traditional Saudi heritage setting',
-        'negative_prompt': 'cartoon, drawing, anime, low quality, modern clothing, western clothing, niqab',
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1770578762/templates/sharqawi_dress_character.jpg'
-    },
-    'jeddah_character_updated_1770660835227': {
-        'prompt': 'Fit athletic Saudi Arabian man wearing traditional white bisht over black thobe, white shemagh with gold-striped agal, well-groomed full light beard with mustache, natural neutral expression, historical Saudi heritage architecture background (old Jeddah Al-Balad style), photorealistic, professional photography, natural lighting',
-        'negative_prompt': 'cartoon, drawing, anime, low quality, modern clothing, western clothing, smile, goatee only, clean shaven',
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/templates/jeddah_updated_v2.jpg'
-    },
-    'northern_woman_v1_1770658383334': {
-        'prompt': 'Saudi Arabian woman wearing traditional Northern Saudi dress with burgundy/maroon embroidered vest featuring vertical striped patterns and gold coin necklace decorations, black hijab with burgundy and gold coin headband, black waist sash, elegant appearance, photorealistic, professional photography, natural lighting, traditional Saudi heritage setting',
-        'negative_prompt': 'cartoon, drawing, anime, low quality, modern clothing, western clothing, niqab',
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/templates/northern_woman_v1.jpg'
-    },
-    'sharqawi_girl_child': {
-        'prompt': 'Beautiful 8-12 year old Saudi Arabian girl wearing a traditional black Sharqawi dress with intricate gold embroidery and a matching sheer veil, gentle closed-mouth smile, photorealistic, cinematic lighting, traditional Saudi heritage architecture background',
-        'negative_prompt': 'cartoon, drawing, anime, low quality, modern clothing, western clothing, teeth, open mouth',
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1771073577/templates/sharqawi_girl_child.jpg'
-    },
-    'southern_asiri_adult': {
-        'prompt': 'Beautiful 25-32 year old Saudi Arabian woman with elegant features and fit body shape, wearing traditional Southern Saudi (Asiri) black dress with vibrant colorful geometric embroidery on the chest and sleeves, yellow headscarf, large ornate golden coin bib necklace, gentle closed-mouth smile, photorealistic, cinematic lighting, historical Saudi courtyard background',
-        'negative_prompt': 'cartoon, drawing, anime, low quality, modern clothing, western clothing, teeth, open mouth, overweight, bulky',
-        'template_image': 'https://res.cloudinary.com/dfcqp8igu/image/upload/v1771073578/templates/southern_asiri_adult.jpg'
-    },
-}
+def build_model_input(
+    capabilities: Dict[str, Any],
+    child_image_url: str,
+    template_url: str,
+    style_config: Dict[str, Any],
+    mask_image_url: str = ''
+) -> Dict[str, Any]:
+    """
+    Build the prediction input dict containing only the inputs the model declares.
+    """
+    input_params = {
+        capabilities['source_field']: child_image_url,
+        capabilities['target_field']: template_url,
+    }
+    
+    if capabilities['mask_field'] and mask_image_url:
+        input_params[capabilities['mask_field']] = mask_image_url
+    if capabilities['prompt_field'] and style_config.get('prompt'):
+        input_params[capabilities['prompt_field']] = style_config['prompt']
+    if capabilities['negative_prompt_field'] and style_config.get('negative_prompt'):
+        input_params[capabilities['negative_prompt_field']] = style_config['negative_prompt']
+    if capabilities['weight'] is not None:
+        input_params['weight'] = capabilities['weight']
+    
+    return input_params
 
 
 def start_face_generation(
     child_image_url: str,
-    mask_image_url: str,
-    character: str = 'superman'
+    mask_image_url: str = '',
+    character: str = 'superman',
+    model_name: Optional[str] = None
 ) -> Optional[Dict[str, Any]]:
     """
-    Start face swap using yan-ops/face_swap model.
+    Start face swap using the configured model (FACE_SWAP_MODEL).
     
     Args:
         child_image_url: URL of child's photo (source face)
-        mask_image_url: URL of face mask image (not used by this model)
-        character: Character name
+        mask_image_url: URL of face mask image (only sent if the model takes one)
+        character: Character ID or alias (see characters.json)
+        model_name: Override FACE_SWAP_MODEL for this request
         
     Returns:
-        Dict with prediction_id and status, or None if failed
+        Dict with prediction_id, status and the model version it runs on, or None if failed
     """
     try:
         print(f"[Replicate] Starting Face Swap for character: {character}", flush=True)
         print(f"[Replicate] Child/Source image: {child_image_url[:50]}...", flush=True)
         
-        # Get character-specific settings
-        style_config = CHARACTER_STYLES.get(character.lower(), CHARACTER_STYLES['superman'])
-        
-        # Get template image URL (target face)
-        template_url = style_config.get('template_image')
-        if not template_url:
-            print(f"[Replicate] ERROR: No template image for character: {character}", flush=True)
-            return None
+        # Get character-specific settings (unknown IDs raise, no silent fallback)
+        entry = character_registry.registry.get(character)
+        style_config = entry.style_config()
+        template_url = entry.template_url
         
         print(f"[Replicate] Template/Target: {template_url[:50]}...", flush=True)
         
-        # Use yan-ops/face_swap - true face swapping with weight control
-        # Model expects: source_image (face to swap FROM) and target_image (image to swap TO)
-        input_params = {
-            "source_image": child_image_url,    # The user's face to swap FROM
-            "target_image": template_url,       # The character template to swap TO
-            "weight": 1.0                       # Complete swap (1.0 = 100%, 0.5 = blend)
-        }
-        
-        print(f"[Replicate] Using yan-ops/face_swap model", flush=True)
-        print(f"  Source (child): {child_image_url[:50]}...", flush=True)
-        print(f"  Target (template): {template_url[:50]}...", flush=True)
-        print(f"  Weight: 1.0 (complete swap, no blending)", flush=True)
+        # Only send the inputs this model declares
+        model_name = model_name or FACE_SWAP_MODEL
+        capabilities = get_model_capabilities(model_name)
+        input_params = build_model_input(
+            capabilities,
+            child_image_url=child_image_url,
+            template_url=template_url,
+            style_config=style_config,
+            mask_image_url=mask_image_url
+        )
         
-        # Use yan-ops/face_swap model (true face swapping)
-        model_name = "yan-ops/face_swap"
+        print(f"[Replicate] Using {model_name} model", flush=True)
+        print(f"  Inputs: {', '.join(input_params.keys())}", flush=True)
         
-        print(f"[Replicate] Getting model version...", flush=True)
-        model = replicate.models.get(model_name)
-        version = model.latest_version
+        version_id = resolve_model_version(model_name, character=entry)
+        if not version_id:
+            print(f"[Replicate] ERROR: Could not resolve a version for {model_name}", flush=True)
+            return None
         
-        print(f"[Replicate] Sending request to {model_name} (version: {version.id[:12]}...)", flush=True)
+        print(f"[Replicate] Sending request to {model_name} (version: {version_id[:12]}...)", flush=True)
         
         # Create prediction using VERSION (not model name)
-        prediction = replicate.predictions.create(
-            version=version.id,
-            input=input_params
+        create_kwargs = {}
+        if REPLICATE_WEBHOOK_URL:
+            create_kwargs['webhook'] = REPLICATE_WEBHOOK_URL
+            create_kwargs['webhook_events_filter'] = ['completed']
+        
+        # Not idempotent: only retried when Replicate certainly did not create it
+        prediction = resilience.call(
+            'replicate', replicate_client.predictions.create,
+            version=version_id,
+            input=input_params,
+            deadline=REPLICATE_CALL_DEADLINE,
+            idempotent=False,
+            **create_kwargs
         )
         
         prediction_id = prediction.id
@@ -242,7 +334,9 @@ def start_face_generation(
         return {
             'prediction_id': prediction_id,
             'status': prediction.status,
-            'created_at': time.time()
+            'version': version_id,
+            'created_at': time.time(),
+            'webhook': bool(REPLICATE_WEBHOOK_URL)
         }
         
     except Exception as e:
@@ -252,75 +346,453 @@ def start_face_generation(
         return None
 
 
-def check_prediction_status(prediction_id: str) -> Optional[Dict[str, Any]]:
+def extract_result_url(output: Any) -> Optional[str]:
+    """
+    Extract the result image URL from a prediction's output.
+    
+    Args:
+        output: prediction.output (dict, list or string depending on the model)
+        
+    Returns:
+        Result URL, or None if no URL could be found
+    """
+    print(f"[Replicate] Raw output type: {type(output).__name__}", flush=True)
+    print(f"[Replicate] Raw output value: {output}", flush=True)
+    
+    if not output:
+        return None
+    
+    # yan-ops/face_swap returns a dictionary with 'cache_url' and 'msg'
+    # Other models might return a URL string or list of URLs
+    if isinstance(output, dict):
+        # Dictionary format: {'cache_url': 'https://...', 'msg': 'succeed'}
+        # Try multiple possible key names
+        result_url = (output.get('cache_url') or 
+                    output.get('url') or 
+                    output.get('output_url') or
+                    output.get('image') or
+                    output.get('result'))
+        if not result_url:
+            print(f"[Replicate] ERROR: No URL found in output dict. Keys: {list(output.keys())}", flush=True)
+            print(f"[Replicate] Full output: {output}", flush=True)
+            result_url = None
+        else:
+            print(f"[Replicate] Extracted URL from dict: {result_url}", flush=True)
+    elif isinstance(output, list):
+        # List format: ['https://...']
+        result_url = output[0] if output else None
+        print(f"[Replicate] Extracted URL from list: {result_url}", flush=True)
+    else:
+        # String format: 'https://...'
+        result_url = output
+        print(f"[Replicate] URL is string: {result_url}", flush=True)
+    
+    if result_url:
+        print(f"[Replicate] ✓ Result URL ready: {result_url[:50]}...", flush=True)
+    else:
+        print(f"[Replicate] ✗ ERROR: Could not extract URL from output", flush=True)
+    return result_url
+
+
+def build_status_info(
+    prediction_id: str,
+    status: str,
+    output: Any = None,
+    error: Any = None,
+    timings: Optional[Mapping[str, Any]] = None,
+    parse_output: Optional[Callable[[Any], Optional[str]]] = None
+) -> Dict[str, Any]:
+    """
+    Build the status dict returned by check_prediction_status from the raw
+    prediction fields (shared by polling and the webhook receiver).
+    
+    Args:
+        timings: Optional created_at / started_at / completed_at of the
+            prediction; recorded in the cold/warm latency stats on success
+        parse_output: Model-specific output parser (defaults to extract_result_url)
+    
+    Returns:
+        Dict with 'prediction_id', 'status', plus 'result_url' or 'error'
+        once finished, and 'run_seconds' (provider-reported started_at to
+        completed_at) when the timings carry both
+    """
+    if status == 'succeeded' and timings:
+        record_prediction_latency(timings, source='swap')
+    
+    result = {
+        'prediction_id': prediction_id,
+        'status': status,
+    }
+    
+    if status in ('succeeded', 'failed', 'canceled') and timings:
+        started = _parse_timestamp(timings.get('started_at'))
+        completed = _parse_timestamp(timings.get('completed_at'))
+        if started is not None and completed is not None:
+            result['run_seconds'] = round(completed - started, 2)
+    
+    if status == 'succeeded':
+        result_url = (parse_output or extract_result_url)(output)
+        if result_url:
+            result['result_url'] = result_url
+    elif status in ('failed', 'canceled'):
+        result['error'] = error
+        print(f"[Replicate] Prediction {status}: {error}", flush=True)
+    
+    return result
+
+
+def check_prediction_status(
+    prediction_id: str,
+    parse_output: Optional[Callable[[Any], Optional[str]]] = None
+) -> Optional[Dict[str, Any]]:
     """
     Check the status of a face generation prediction.
     
     Args:
         prediction_id: The prediction ID from start_face_generation
+        parse_output: Model-specific output parser (defaults to extract_result_url)
         
     Returns:
         Dict with status and result URL if complete, None if failed
     """
     try:
         # Check status via API
-        prediction = replicate.predictions.get(prediction_id)
-        
-        status = prediction.status
+        prediction = resilience.call('replicate', replicate_client.predictions.get, prediction_id,
+                                     deadline=REPLICATE_CALL_DEADLINE, retried_statuses=SDK_RETRIED_STATUSES)
         
-        result = {
-            'prediction_id': prediction_id,
-            'status': status,
-        }
-        
-        if status == 'succeeded':
-            output = prediction.output
-            print(f"[Replicate] Raw output type: {type(output).__name__}", flush=True)
-            print(f"[Replicate] Raw output value: {output}", flush=True)
-            
-            if output:
-                # yan-ops/face_swap returns a dictionary with 'cache_url' and 'msg'
-                # Other models might return a URL string or list of URLs
-                if isinstance(output, dict):
-                    # Dictionary format: {'cache_url': 'https://...', 'msg': 'succeed'}
-                    # Try multiple possible key names
-                    result_url = (output.get('cache_url') or 
-                                output.get('url') or 
-                                output.get('output_url') or
-                                output.get('image') or
-                                output.get('result'))
-                    if not result_url:
-                        print(f"[Replicate] ERROR: No URL found in output dict. Keys: {list(output.keys())}", flush=True)
-                        print(f"[Replicate] Full output: {output}", flush=True)
-                        result_url = None
-                    else:
-                        print(f"[Replicate] Extracted URL from dict: {result_url}", flush=True)
-                elif isinstance(output, list):
-                    # List format: ['https://...']
-                    result_url = output[0] if output else None
-                    print(f"[Replicate] Extracted URL from list: {result_url}", flush=True)
-                else:
-                    # String format: 'https://...'
-                    result_url = output
-                    print(f"[Replicate] URL is string: {result_url}", flush=True)
-                
-                if result_url:
-                    result['result_url'] = result_url
-                    print(f"[Replicate] ✓ Result URL ready: {result_url[:50]}...", flush=True)
-                else:
-                    print(f"[Replicate] ✗ ERROR: Could not extract URL from output", flush=True)
-                
-        elif status == 'failed':
-            result['error'] = prediction.error
-            print(f"[Replicate] Prediction failed: {prediction.error}", flush=True)
-            
-        return result
+        return build_status_info(
+            prediction_id,
+            prediction.status,
+            output=prediction.output,
+            error=prediction.error,
+            timings={
+                'created_at': prediction.created_at,
+                'started_at': prediction.started_at,
+                'completed_at': prediction.completed_at,
+            },
+            parse_output=parse_output
+        )
         
     except Exception as e:
         print(f"[Replicate] Failed to check status: {str(e)}", flush=True)
         return None
 
 
+def cancel_prediction(prediction_id: str) -> bool:
+    """
+    Cancel a running prediction.
+    
+    Args:
+        prediction_id: The prediction ID from start_face_generation
+        
+    Returns:
+        True if the cancel request was accepted, False otherwise
+    """
+    try:
+        resilience.call('replicate', replicate_client.predictions.cancel, prediction_id,
+                        deadline=REPLICATE_CALL_DEADLINE)
+        print(f"[Replicate] Prediction canceled: {prediction_id}", flush=True)
+        return True
+    except Exception as e:
+        print(f"[Replicate] Failed to cancel prediction {prediction_id}: {str(e)}", flush=True)
+        return False
+
+
+# Optional warm-up: during event hours, keep the model container warm with a
+# cheap keep-alive prediction (a template swapped onto itself) whenever no
+# prediction has run for WARMUP_INTERVAL seconds
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', '0') == '1'
+WARMUP_INTERVAL = float(os.getenv('WARMUP_INTERVAL', '240'))
+
+# Local time window like "09:00-22:00" (may wrap past midnight); empty = always
+WARMUP_HOURS = os.getenv('WARMUP_HOURS', '')
+
+# Character whose template is used for the keep-alive prediction
+WARMUP_CHARACTER = os.getenv('WARMUP_CHARACTER', 'superman')
+
+# Seconds a prediction waits for a container (created -> started) before it
+# counts as a cold start
+COLD_START_THRESHOLD = float(os.getenv('COLD_START_THRESHOLD', '10'))
+
+# Longest the warm-up job waits for its prediction (seconds)
+WARMUP_TIMEOUT = 180
+
+# Cold vs warm latency per source ('swap' or 'warmup'), this process only
+latency_stats = {}
+_latency_lock = threading.Lock()
+
+# Recent kiosk prediction durations (created -> completed), for percentiles
+_recent_swap_totals = deque(maxlen=200)
+
+
+def _parse_timestamp(value: Any) -> Optional[float]:
+    """Parse a Replicate ISO-8601 timestamp into epoch seconds."""
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        text = str(value).replace('Z', '+00:00')
+        # Python < 3.11 only accepts up to 6 fractional digits
+        if '.' in text:
+            head, tail = text.split('.', 1)
+            digits = ''.join(ch for ch in tail if ch.isdigit())
+            text = f"{head}.{digits[:6]}{tail[len(digits):]}"
+        parsed = datetime.fromisoformat(text)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+    except ValueError:
+        return None
+
+
+def record_prediction_latency(timings: Mapping[str, Any], source: str = 'swap') -> Optional[Dict[str, Any]]:
+    """
+    Record one finished prediction in the cold/warm latency stats.
+    
+    Args:
+        timings: Mapping with created_at, started_at and completed_at
+        source: 'swap' for kiosk predictions, 'warmup' for keep-alives
+        
+    Returns:
+        Dict with 'queue_seconds', 'total_seconds' and 'cold', or None if
+        the timestamps are missing
+    """
+    created = _parse_timestamp(timings.get('created_at'))
+    started = _parse_timestamp(timings.get('started_at'))
+    completed = _parse_timestamp(timings.get('completed_at'))
+    if created is None or started is None or completed is None:
+        return None
+    
+    sample = {
+        'queue_seconds': round(started - created, 2),
+        'total_seconds': round(completed - created, 2),
+        'cold': started - created > COLD_START_THRESHOLD,
+    }
+    
+    with _latency_lock:
+        by_temperature = latency_stats.setdefault(source, {})
+        entry = by_temperature.setdefault('cold' if sample['cold'] else 'warm', {
+            'count': 0,
+            'avg_queue_seconds': 0.0,
+            'avg_total_seconds': 0.0,
+        })
+        entry['count'] += 1
+        entry['avg_queue_seconds'] += (sample['queue_seconds'] - entry['avg_queue_seconds']) / entry['count']
+        entry['avg_total_seconds'] += (sample['total_seconds'] - entry['avg_total_seconds']) / entry['count']
+        entry['last_total_seconds'] = sample['total_seconds']
+        if source == 'swap':
+            _recent_swap_totals.append(sample['total_seconds'])
+    
+    return sample
+
+
+def latency_percentile(percentile: float, min_samples: int = 20) -> Optional[float]:
+    """
+    Percentile of recent kiosk prediction durations (seconds).
+    
+    Returns:
+        The percentile, or None until min_samples predictions were seen
+    """
+    with _latency_lock:
+        samples = sorted(_recent_swap_totals)
+    if len(samples) < max(1, min_samples):
+        return None
+    index = min(len(samples) - 1, int(round(percentile / 100.0 * (len(samples) - 1))))
+    return samples[index]
+
+
+def get_latency_stats() -> Dict[str, Any]:
+    """Return a copy of the cold/warm latency stats, rounded for /health."""
+    with _latency_lock:
+        return {
+            source: {
+                temperature: {key: round(value, 2) if isinstance(value, float) else value
+                              for key, value in entry.items()}
+                for temperature, entry in by_temperature.items()
+            }
+            for source, by_temperature in latency_stats.items()
+        }
+
+
+def in_warmup_hours(now: Optional[datetime] = None) -> bool:
+    """True if now (local time) falls inside WARMUP_HOURS."""
+    if not WARMUP_HOURS:
+        return True
+    try:
+        start_text, end_text = WARMUP_HOURS.split('-', 1)
+        start = datetime.strptime(start_text.strip(), '%H:%M').time()
+        end = datetime.strptime(end_text.strip(), '%H:%M').time()
+    except ValueError:
+        print(f"[Replicate] Invalid WARMUP_HOURS '{WARMUP_HOURS}', expected HH:MM-HH:MM", flush=True)
+        return False
+    
+    current = (now or datetime.now()).time()
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+
+def _seconds_since_last_prediction(version_id: str) -> Optional[float]:
+    """
+    Seconds since the newest prediction on this model version was created,
+    from the account's prediction list (sees every worker and kiosk).
+    """
+    page = resilience.call('replicate', replicate_client.predictions.list,
+                           deadline=REPLICATE_CALL_DEADLINE, retried_statuses=SDK_RETRIED_STATUSES)
+    for prediction in page.results:
+        if prediction.version == version_id:
+            created = _parse_timestamp(prediction.created_at)
+            if created is not None:
+                return time.time() - created
+    return None
+
+
+def warm_up_model(model_name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Send one keep-alive prediction unless it is outside event hours or real
+    traffic ran recently enough to keep the container warm. Waits for the
+    prediction to finish and records its latency (source 'warmup').
+    
+    The prediction holds an admission slot like a kiosk's; it is skipped
+    when none is spare, so a warm-up never pushes kiosks into the queue.
+    
+    Returns:
+        Dict describing what happened (recorded in the scheduler's job stats)
+    """
+    model_name = model_name or FACE_SWAP_MODEL
+    
+    if not in_warmup_hours():
+        return {'skipped': 'outside warm-up hours'}
+    
+    entry = character_registry.registry.get(WARMUP_CHARACTER)
+    version_id = resolve_model_version(model_name, character=entry)
+    if not version_id:
+        return {'skipped': 'model version unavailable'}
+    
+    idle = _seconds_since_last_prediction(version_id)
+    if idle is not None and idle < WARMUP_INTERVAL:
+        return {'skipped': 'model recently used', 'idle_seconds': round(idle)}
+    
+    style_config = entry.style_config()
+    template_url = entry.template_url
+    input_params = build_model_input(
+        get_model_capabilities(model_name),
+        child_image_url=template_url,
+        template_url=template_url,
+        style_config=style_config
+    )
+    
+    slot_id = admission_queue.take_slot()
+    if slot_id is None:
+        return {'skipped': 'no admission slot free'}
+    
+    try:
+        prediction = resilience.call(
+            'replicate', replicate_client.predictions.create,
+            version=version_id,
+            input=input_params,
+            deadline=REPLICATE_CALL_DEADLINE,
+            idempotent=False
+        )
+    except Exception:
+        admission_queue.release_slot(slot_id)
+        raise
+    admission_queue.bind_slot(slot_id, prediction.id)
+    print(f"[Replicate] Warm-up prediction started: {prediction.id}", flush=True)
+    
+    try:
+        deadline = time.time() + WARMUP_TIMEOUT
+        while prediction.status not in ('succeeded', 'failed', 'canceled') and time.time() < deadline:
+            time.sleep(2)
+            prediction = resilience.call('replicate', replicate_client.predictions.get, prediction.id,
+                                         deadline=REPLICATE_CALL_DEADLINE, retried_statuses=SDK_RETRIED_STATUSES)
+        
+        if prediction.status not in ('succeeded', 'failed', 'canceled'):
+            cancel_prediction(prediction.id)
+            return {'prediction_id': prediction.id, 'status': 'timed out'}
+    finally:
+        admission_queue.finish(prediction.id)
+    
+    sample = record_prediction_latency({
+        'created_at': prediction.created_at,
+        'started_at': prediction.started_at,
+        'completed_at': prediction.completed_at,
+    }, source='warmup')
+    
+    print(f"[Replicate] Warm-up {prediction.status}: {sample}", flush=True)
+    return {'prediction_id': prediction.id, 'status': prediction.status, **(sample or {})}
+
+
+def start_warmup_scheduler(model_name: Optional[str] = None) -> None:
+    """
+    Schedule warm_up_model every WARMUP_INTERVAL seconds (no-op unless
+    WARMUP_ENABLED=1). Runs in one worker at a time via job_scheduler.
+    """
+    if not WARMUP_ENABLED:
+        return
+    job_scheduler.schedule(
+        'model_warmup',
+        WARMUP_INTERVAL,
+        lambda: warm_up_model(model_name),
+        lease_seconds=WARMUP_TIMEOUT + 60
+    )
+
+
+def verify_webhook_signature(headers: Mapping[str, str], body: bytes) -> bool:
+    """
+    Verify a Replicate webhook (Standard Webhooks scheme).
+    
+    The signed content is "{webhook-id}.{webhook-timestamp}.{body}", signed
+    with HMAC-SHA256 using the base64 key after the "whsec_" prefix. The
+    webhook-signature header holds space-separated "v1,<base64>" entries.
+    
+    Args:
+        headers: Request headers
+        body: Raw request body
+        
+    Returns:
+        True if the signature matches and the timestamp is recent
+    """
+    if not REPLICATE_WEBHOOK_SECRET:
+        print("[Replicate] Webhook rejected: REPLICATE_WEBHOOK_SECRET not set", flush=True)
+        return False
+    
+    webhook_id = headers.get('webhook-id')
+    timestamp = headers.get('webhook-timestamp')
+    signatures = headers.get('webhook-signature')
+    if not webhook_id or not timestamp or not signatures:
+        return False
+    
+    try:
+        if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE_SECONDS:
+            print("[Replicate] Webhook rejected: timestamp outside tolerance", flush=True)
+            return False
+        secret = base64.b64decode(REPLICATE_WEBHOOK_SECRET.split('_', 1)[-1])
+    except (ValueError, binascii.Error):
+        return False
+    
+    signed_content = f"{webhook_id}.{timestamp}.".encode('utf-8') + body
+    expected = base64.b64encode(hmac.new(secret, signed_content, hashlib.sha256).digest()).decode('utf-8')
+    
+    for entry in signatures.split():
+        _, _, signature = entry.partition(',')
+        if hmac.compare_digest(signature.encode('utf-8'), expected.encode('utf-8')):
+            return True
+    return False
+
+
+def sign_webhook_payload(body: bytes, webhook_id: str, timestamp: int) -> str:
+    """
+    Produce a webhook-signature header value for a payload.
+    Used by the local stand-in sender (send_test_webhook.py).
+    """
+    secret = base64.b64decode(REPLICATE_WEBHOOK_SECRET.split('_', 1)[-1])
+    signed_content = f"{webhook_id}.{timestamp}.".encode('utf-8') + body
+    signature = base64.b64encode(hmac.new(secret, signed_content, hashlib.sha256).digest()).decode('utf-8')
+    return f"v1,{signature}"
+
+
 def test_connection() -> bool:
     """
     Test Replicate API connection.
@@ -330,7 +802,7 @@ def test_connection() -> bool:
     """
     try:
         # Try to list models (requires valid API token)
-        models = replicate.models.list()
+        models = replicate_client.models.list()
         print("[Replicate] Connection successful!", flush=True)
         return True
     except Exception as e:
@@ -0,0 +1,282 @@
+"""
+Resilience Module
+Shared retry and circuit-breaker layer for the Replicate and Cloudinary
+helpers.
+
+call() runs one API call with:
+- classified retries: only transient failures (429, 5xx, timeouts,
+  connection errors) are retried; 4xx errors surface at once. Calls that are
+  not safe to repeat (e.g. creating a prediction) are retried only when the
+  request certainly did not take effect (429, connection refused).
+- full-jitter exponential backoff, or the server's Retry-After when given
+- a per-call deadline covering every attempt; the shared HTTP pools
+  (http_pool.py) cap each request's timeout at the time left before it
+  via attempt_timeout()
+- no second layer of retries for statuses the SDK already retried
+  (retried_statuses); those only count toward the breaker
+- a circuit breaker per dependency: after CIRCUIT_FAILURE_THRESHOLD
+  consecutive transient failures calls fail fast for CIRCUIT_RESET_TIMEOUT
+  seconds, then a single trial call decides whether it closes again
+
+Breaker states are per process and reported by /health.
+"""
+
+import os
+import random
+import re
+import socket
+import threading
+import time
+from typing import Callable, Dict, Any, Optional, Tuple, TypeVar
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Attempts per call (first try included)
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '4'))
+
+# Backoff base and cap (seconds)
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '8'))
+
+# Consecutive transient failures that open a breaker, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+
+T = TypeVar('T')
+
+# Deadline of the call() running on this thread, read by attempt_timeout()
+_local = threading.local()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open trial -> closed."""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """True if a call may go out now (at most one trial while half-open)."""
+        with self._lock:
+            if self.state == 'open' and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._trial_running = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != 'closed':
+                print(f"[Resilience] Circuit '{self.name}' closed", flush=True)
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                self.state = 'open'
+                self.opened_at = time.time()
+                self.trips += 1
+                print(f"[Resilience] Circuit '{self.name}' opened after {self.failures} failures", flush=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            snapshot = {'state': self.state, 'failures': self.failures, 'trips': self.trips}
+            if self.state == 'open':
+                snapshot['retry_in'] = round(max(0.0, self.opened_at + self.reset_timeout - time.time()), 1)
+            return snapshot
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Return the breaker for a dependency, creating it on first use."""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        return _breakers[name]
+
+
+def get_breaker_states() -> Dict[str, Any]:
+    """Every breaker's state, reported by /health."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+
+def attempt_timeout(default: float) -> float:
+    """
+    Timeout for one HTTP request: the time left before the deadline of the
+    call() running on this thread, at most default.
+
+    Raises:
+        TimeoutError: If that deadline has already passed (e.g. while the
+            SDK was backing off between its own retries)
+    """
+    give_up_at = getattr(_local, 'give_up_at', None)
+    if give_up_at is None:
+        return default
+    remaining = give_up_at - time.time()
+    if remaining <= 0:
+        raise TimeoutError("Call deadline exceeded")
+    return min(default, remaining)
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """HTTP status carried by an SDK exception, if any."""
+    for attribute in ('status', 'status_code', 'http_code'):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, 'response', None)
+    value = getattr(response, 'status_code', None)
+    if isinstance(value, int):
+        return value
+
+    # Cloudinary puts the status in the message ("... status code - 502")
+    match = re.search(r'status code - (\d{3})', str(error))
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait (Retry-After header or message)."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After') if hasattr(headers, 'get') else None
+    if value and str(value).strip().isdigit():
+        return float(value)
+
+    # Replicate throttling: "Request was throttled. Expected available in 5 seconds."
+    match = re.search(r'available in (\d+(?:\.\d+)?) second', str(getattr(error, 'detail', '') or error))
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def classify(error: Exception) -> Tuple[bool, bool, Optional[float]]:
+    """
+    Decide whether a failed call was a transient dependency failure.
+
+    Returns:
+        (transient, not_processed, retry_after_seconds): not_processed means
+        the request certainly had no effect, so even non-idempotent calls
+        may be repeated
+    """
+    status = _status_code(error)
+    name = type(error).__name__
+
+    if status in (420, 429) or name == 'RateLimited':
+        # Throttled: the request was not processed
+        return True, True, _retry_after(error)
+
+    if isinstance(error, (ConnectionRefusedError, socket.gaierror)) or name in ('ConnectError', 'ConnectTimeout'):
+        return True, True, None
+
+    if status is not None:
+        return status >= 500, False, _retry_after(error)
+
+    transient = isinstance(error, (TimeoutError, ConnectionError, socket.timeout)) \
+        or name in ('ReadTimeout', 'WriteTimeout', 'PoolTimeout', 'RemoteProtocolError', 'ReadError',
+                    'GeneralError') \
+        or str(error).startswith(('Socket error', 'Unexpected error'))
+    return transient, False, None
+
+
+def call(
+    dependency: str,
+    fn: Callable[..., T],
+    *args,
+    deadline: float = 30.0,
+    idempotent: bool = True,
+    retried_statuses: Tuple[int, ...] = (),
+    **kwargs
+) -> T:
+    """
+    Run fn(*args, **kwargs) with retries, backoff and the dependency's breaker.
+
+    Args:
+        dependency: Breaker name ('replicate', 'cloudinary', ...)
+        fn: The API call
+        deadline: Seconds allowed for all attempts together
+        idempotent: False for calls that must not be repeated after they
+            may have reached the server
+        retried_statuses: HTTP statuses the SDK already retried for this
+            request; they count toward the breaker but are not retried again
+
+    Returns:
+        Whatever fn returns
+
+    Raises:
+        CircuitOpenError: If the breaker is open
+        Exception: The last error once retries or the deadline run out
+    """
+    breaker = get_breaker(dependency)
+    give_up_at = time.time() + deadline
+    attempt = 0
+    last_error = None
+
+    # Requests made by fn get at most the time left (see attempt_timeout)
+    outer_give_up_at = getattr(_local, 'give_up_at', None)
+    _local.give_up_at = give_up_at if outer_give_up_at is None else min(give_up_at, outer_give_up_at)
+    try:
+        while True:
+            if not breaker.allow():
+                if last_error is not None:
+                    # Our own retries tripped the breaker: report what actually failed
+                    raise last_error
+                raise CircuitOpenError(f"{dependency} unavailable (circuit open)")
+
+            attempt += 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                transient, not_processed, retry_after = classify(e)
+                if not transient:
+                    # The dependency answered; a bad request says nothing about its health
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                if not idempotent and not not_processed:
+                    raise
+                if _status_code(e) in retried_statuses:
+                    # The SDK already backed off and retried this one
+                    raise
+
+                delay = retry_after if retry_after is not None else \
+                    random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+                if attempt >= RETRY_MAX_ATTEMPTS or time.time() + delay >= give_up_at:
+                    raise
+                last_error = e
+                print(f"[Resilience] {dependency} call failed ({str(e)[:80]}), "
+                      f"retry {attempt}/{RETRY_MAX_ATTEMPTS - 1} in {delay:.1f}s", flush=True)
+                time.sleep(delay)
+                continue
+
+            breaker.record_success()
+            return result
+    finally:
+        _local.give_up_at = outer_give_up_at
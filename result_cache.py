@@ -0,0 +1,157 @@
+"""
+Result Cache Module
+Remembers finished face swaps keyed by a content hash of the swap source
+photo plus character (and its manifest content hash), and the model and
+model version that produced the result. A resubmitted capture (double tap, retry, "try again" on the same
+character) gets the stored result URL back instead of paying for another
+prediction.
+
+Uses the same backend choice as the prediction store
+(PREDICTION_STORE=memory|sqlite) so all workers share hits.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from dotenv import load_dotenv
+
+import sqlite_db
+
+# Load environment variables
+load_dotenv()
+
+# Seconds a result stays reusable. Replicate deletes API prediction outputs
+# after about an hour, so this stays well under that: a hit must still leave
+# the kiosk time to show and share the URL
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', '1800'))
+
+# Most entries kept; the least recently used are evicted first
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1000'))
+
+RESULT_CACHE_DB_PATH = os.getenv('RESULT_CACHE_DB_PATH', 'result_cache.db')
+
+
+def make_capture_key(image_bytes: bytes, character: str, character_hash: str = '') -> str:
+    """
+    Identify a (photo, character) submission, whichever backend serves it.
+
+    character_hash is the registry entry's content hash, so editing a
+    character's prompts or template in the manifest stops old results
+    from being reused.
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    return f"{digest}:{character.lower()}:{character_hash}"
+
+
+def make_cache_key(capture_key: str, model_name: str, version_id: str) -> str:
+    """Build the cache key for a capture's result from one model version."""
+    return f"{capture_key}:{model_name}:{version_id}"
+
+
+class InMemoryResultCache:
+    """LRU + TTL result cache held in this process."""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (result_url, stored_at)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached result URL, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, result_url: str) -> None:
+        """Store a result URL, evicting the least recently used entries."""
+        with self._lock:
+            self._entries[key] = (result_url, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteResultCache:
+    """LRU + TTL result cache in a SQLite file shared by all workers (WAL mode)."""
+
+    def __init__(self, db_path: str, ttl: float, max_entries: int):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " cache_key TEXT PRIMARY KEY,"
+            " result_url TEXT NOT NULL,"
+            " stored_at REAL NOT NULL,"
+            " used_at REAL NOT NULL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection to the cache database."""
+        return sqlite_db.connect(self.db_path)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached result URL, or None if missing or expired."""
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT result_url FROM results WHERE cache_key = ? AND stored_at > ?",
+            (key, now - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE results SET used_at = ? WHERE cache_key = ?", (now, key))
+        return row[0]
+
+    def put(self, key: str, result_url: str) -> None:
+        """Store a result URL, dropping expired and least recently used entries."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (cache_key, result_url, stored_at, used_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, result_url, now, now)
+            )
+            conn.execute("DELETE FROM results WHERE stored_at <= ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM results WHERE cache_key IN ("
+                " SELECT cache_key FROM results ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def __len__(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+def create_result_cache(backend: Optional[str] = None):
+    """
+    Create the result cache for the configured backend.
+
+    Args:
+        backend: 'memory' or 'sqlite' (defaults to PREDICTION_STORE)
+    """
+    backend = (backend or os.getenv('PREDICTION_STORE', 'memory')).lower()
+    if backend == 'sqlite':
+        return SQLiteResultCache(RESULT_CACHE_DB_PATH, RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES)
+    return InMemoryResultCache(RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES)
@@ -0,0 +1,61 @@
+"""
+Local stand-in for Replicate webhook delivery.
+Signs a prediction payload with REPLICATE_WEBHOOK_SECRET and posts it to the
+running app, so /replicate-webhook and /check-status can be tested offline.
+
+Usage:
+    python send_test_webhook.py <prediction_id> [succeeded|failed] [result_url]
+"""
+import json
+import os
+import sys
+import time
+import uuid
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import replicate_helper
+
+WEBHOOK_TARGET = os.getenv('WEBHOOK_TARGET', 'http://localhost:5000/replicate-webhook')
+
+if len(sys.argv) < 2:
+    print(__doc__)
+    sys.exit(1)
+
+if not replicate_helper.REPLICATE_WEBHOOK_SECRET:
+    print("REPLICATE_WEBHOOK_SECRET is not set (use e.g. whsec_<base64> in .env)")
+    sys.exit(1)
+
+prediction_id = sys.argv[1]
+status = sys.argv[2] if len(sys.argv) > 2 else 'succeeded'
+result_url = sys.argv[3] if len(sys.argv) > 3 else \
+    'https://res.cloudinary.com/dfcqp8igu/image/upload/v1768395277/templates/superman_template_vibrant_v4.png'
+
+payload = {
+    'id': prediction_id,
+    'status': status,
+    'output': {'cache_url': result_url, 'msg': 'succeed'} if status == 'succeeded' else None,
+    'error': 'Simulated failure' if status == 'failed' else None,
+}
+body = json.dumps(payload).encode('utf-8')
+
+webhook_id = f"msg_{uuid.uuid4().hex}"
+timestamp = int(time.time())
+
+headers = {
+    'Content-Type': 'application/json',
+    'webhook-id': webhook_id,
+    'webhook-timestamp': str(timestamp),
+    'webhook-signature': replicate_helper.sign_webhook_payload(body, webhook_id, timestamp),
+}
+
+print(f"Sending '{status}' webhook for {prediction_id} to {WEBHOOK_TARGET}...")
+
+try:
+    response = requests.post(WEBHOOK_TARGET, data=body, headers=headers, timeout=10)
+    print(f"Response: {response.status_code} {response.text}")
+except Exception as e:
+    print(f"WEBHOOK FAILED: {e}")
@@ -0,0 +1,39 @@
+"""
+SQLite DB Module
+Per-thread connections to the small SQLite files that hold state shared by
+all gunicorn workers on a box (prediction store, result cache, admission and
+cleanup queues, job leases, backend router outcomes).
+
+Every file is opened the same way: WAL mode so readers never block the
+writer, synchronous=NORMAL (safe with WAL, far fewer fsyncs) and a busy
+timeout so writers from other workers wait instead of failing.
+"""
+
+import sqlite3
+import threading
+
+# Seconds a connection waits for another worker's write lock
+SQLITE_BUSY_TIMEOUT = 10
+
+_local = threading.local()
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """
+    Return this thread's connection to a database file (sqlite3 connections
+    are per-thread), opening and configuring it on first use.
+
+    Connections are in autocommit mode; callers use BEGIN IMMEDIATE for
+    read-modify-write transactions.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}")
+        connections[db_path] = conn
+    return conn
@@ -1,8 +1,11 @@
 // State management
 let currentScreen = 'camera';
-let capturedPhoto = null;
+let capturedPhoto = null;      // Blob (PNG from camera or the uploaded file)
+let capturedPreviewUrl = null;  // Object URL used for the preview <img>
 let selectedCharacter = null;
 let videoStream = null;
+let swapRequestKey = null;      // Idempotency-Key for the current photo + character
+let swapRequestCharacter = null;
 
 // DOM elements
 const cameraScreen = document.getElementById('camera-screen');
@@ -111,20 +114,58 @@ function handleFileUpload(e) {
     const file = e.target.files[0];
     if (!file) return;
 
-    const reader = new FileReader();
-    reader.onload = function (event) {
-        capturedPhoto = event.target.result;
-        capturedPreview.src = capturedPhoto;
+    // A File is already a Blob, so it can be sent as-is without base64 encoding
+    setCapturedPhoto(file);
 
-        // Stop camera stream if active
-        if (videoStream) {
-            videoStream.getTracks().forEach(track => track.stop());
-        }
+    // Stop camera stream if active
+    if (videoStream) {
+        videoStream.getTracks().forEach(track => track.stop());
+    }
 
-        // Switch to character selection screen
-        switchScreen('character');
-    };
-    reader.readAsDataURL(file);
+    // Switch to character selection screen
+    switchScreen('character');
+}
+
+// Store the captured photo and refresh the preview
+function setCapturedPhoto(blob) {
+    if (capturedPreviewUrl) {
+        URL.revokeObjectURL(capturedPreviewUrl);
+    }
+    capturedPhoto = blob;
+    resetSwapRequestKey();
+    capturedPreviewUrl = blob ? URL.createObjectURL(blob) : null;
+    if (capturedPreviewUrl) {
+        capturedPreview.src = capturedPreviewUrl;
+    }
+}
+
+// A retried /swap-face for the same photo + character reuses the key so the
+// server attaches it to the original prediction instead of starting another
+function getSwapRequestKey() {
+    if (!swapRequestKey || swapRequestCharacter !== selectedCharacter) {
+        swapRequestKey = (window.crypto && crypto.randomUUID)
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+        swapRequestCharacter = selectedCharacter;
+    }
+    return swapRequestKey;
+}
+
+// Stable per-device ID so the server queues kiosks fairly
+function getKioskId() {
+    let kioskId = localStorage.getItem('kioskId');
+    if (!kioskId) {
+        kioskId = (window.crypto && crypto.randomUUID)
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+        localStorage.setItem('kioskId', kioskId);
+    }
+    return kioskId;
+}
+
+function resetSwapRequestKey() {
+    swapRequestKey = null;
+    swapRequestCharacter = null;
 }
 
 // Capture photo from video stream
@@ -140,19 +181,19 @@ function capturePhoto() {
     const ctx = canvas.getContext('2d');
     ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
 
-    // Convert canvas to base64 (use PNG for maximum quality)
-    capturedPhoto = canvas.toDataURL('image/png');
-
-    // Show preview
-    capturedPreview.src = capturedPhoto;
+    // Convert canvas to a binary PNG blob (use PNG for maximum quality)
+    canvas.toBlob(blob => {
+        // Show preview
+        setCapturedPhoto(blob);
 
-    // Stop camera stream
-    if (videoStream) {
-        videoStream.getTracks().forEach(track => track.stop());
-    }
+        // Stop camera stream
+        if (videoStream) {
+            videoStream.getTracks().forEach(track => track.stop());
+        }
 
-    // Switch to character selection screen
-    switchScreen('character');
+        // Switch to character selection screen
+        switchScreen('character');
+    }, 'image/png');
 }
 
 // Select character
@@ -188,31 +229,59 @@ async function performFaceSwap() {
     try {
         // Step 1: Start face swap (upload to Cloudinary + start Replicate)
         console.log('Sending request to /swap-face...');
+        // Send the photo as a binary multipart part (no base64 overhead)
+        const formData = new FormData();
+        formData.append('child_photo', capturedPhoto, 'photo.png');
+        formData.append('character', selectedCharacter);
+
         const response = await fetch('/swap-face', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Idempotency-Key': getSwapRequestKey(),
+                'X-Kiosk-Id': getKioskId()
             },
-            body: JSON.stringify({
-                child_photo: capturedPhoto,
-                character: selectedCharacter
-            })
+            body: formData
         });
 
         console.log('Response received:', response.status);
 
+        if (response.status === 422) {
+            // Photo failed the quality check: ask for a retake right away
+            const qualityData = await response.json();
+            alert(qualityData.error || 'Please retake your photo.');
+            retakePhoto();
+            return;
+        }
+
+        if (response.status === 503) {
+            // Booth is at capacity: wait as long as the server suggests, then retry
+            const busyData = await response.json();
+            const retryAfter = parseInt(response.headers.get('Retry-After'), 10) || busyData.retry_after || 10;
+            updateLoadingText(`Lots of people are here right now. Trying again in ${retryAfter} s...`);
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+            return performFaceSwap();
+        }
+
         if (!response.ok) {
             const errorData = await response.json();
             throw new Error(errorData.error || 'Face swap failed');
         }
 
         const data = await response.json();
-        const predictionId = data.prediction_id;
-        console.log('Prediction ID:', predictionId);
+        let resultUrl = null;
 
-        // Step 2: Poll for completion
-        updateLoadingText('Creating your traditional photo...');
-        const resultUrl = await pollForResult(predictionId);
+        if (data.status === 'succeeded' && data.result_url) {
+            // Same photo and character as an earlier swap: result comes back at once
+            console.log('Cached result returned');
+            resultUrl = data.result_url;
+        } else {
+            const predictionId = data.prediction_id;
+            console.log('Prediction ID:', predictionId);
+
+            // Step 2: Poll for completion (showing the queue position while waiting)
+            updateLoadingText('Creating your traditional photo...');
+            resultUrl = await pollForResult(predictionId, 120, data.status === 'queued' ? data : null);
+        }
 
         if (resultUrl) {
             // Display result
@@ -226,20 +295,72 @@ async function performFaceSwap() {
             throw new Error('Failed to generate result');
         }
 
+        resetSwapRequestKey();
+
     } catch (error) {
         console.error('Face swap error:', error);
+        // Keep the key only if the request never got an answer (network
+        // error), so "try again" reattaches to a swap that may be running
+        if (!(error instanceof TypeError)) {
+            resetSwapRequestKey();
+        }
         alert(`Sorry, something went wrong: ${error.message}\nPlease try again.`);
         switchScreen('character');
     }
 }
 
-// Poll for prediction result
-async function pollForResult(predictionId, maxAttempts = 60) {
+// Wait for prediction result using long-polling
+// Each /wait-status request is held by the server until the prediction
+// finishes (or ~25 s pass), so the result shows up as soon as it is ready.
+async function pollForResult(predictionId, maxWaitSeconds = 120, queueInfo = null) {
+    // The wait (and progress messages) start once the job leaves the queue
+    const progress = { startedAt: Date.now(), queue: queueInfo };
+
+    // Update loading text based on progress while the request is held open
+    const updateProgress = () => {
+        if (progress.queue) {
+            updateLoadingText(queueText(progress.queue));
+            return;
+        }
+        const elapsed = (Date.now() - progress.startedAt) / 1000;
+        if (elapsed < 10) {
+            updateLoadingText('Starting AI processing...');
+        } else if (elapsed < 20) {
+            updateLoadingText('Analyzing your face...');
+        } else {
+            updateLoadingText('Almost done, creating your traditional photo...');
+        }
+    };
+    updateProgress();
+    const progressTimer = setInterval(updateProgress, 2000);
+
+    try {
+        return await waitForStatus(predictionId, progress, maxWaitSeconds);
+    } finally {
+        clearInterval(progressTimer);
+    }
+}
+
+// "You're #3 in line (about 40 s)"
+function queueText(queue) {
+    const position = queue.queue_position || 1;
+    const eta = queue.eta_seconds ? ` (about ${Math.max(5, Math.round(queue.eta_seconds))} s)` : '';
+    return position <= 1
+        ? `You're next in line${eta}...`
+        : `You're #${position} in line${eta}...`;
+}
+
+// Long-poll /wait-status until the prediction finishes or the wait runs out
+async function waitForStatus(predictionId, progress, maxWaitSeconds) {
     let attempts = 0;
 
-    while (attempts < maxAttempts) {
+    while ((Date.now() - progress.startedAt) / 1000 < maxWaitSeconds) {
         try {
-            const response = await fetch(`/check-status/${predictionId}`);
+            const elapsed = (Date.now() - progress.startedAt) / 1000;
+            const remaining = Math.ceil(maxWaitSeconds - elapsed);
+            // While queued, come back often to refresh the position
+            const timeout = progress.queue ? 3 : Math.max(1, Math.min(25, remaining));
+            const response = await fetch(`/wait-status/${predictionId}?timeout=${timeout}`);
 
             if (!response.ok) {
                 throw new Error('Failed to check status');
@@ -255,20 +376,20 @@ async function pollForResult(predictionId, maxAttempts = 60) {
                 return data.result_url;
             } else if (status === 'failed') {
                 throw new Error(data.error || 'Generation failed');
+            } else if (status === 'queued') {
+                progress.queue = data;
+                progress.startedAt = Date.now();
+            } else if (progress.queue) {
+                // Left the queue: the processing wait starts now
+                progress.queue = null;
+                progress.startedAt = Date.now();
             }
 
-            // Update loading text based on progress
-            const elapsed = attempts * 2;
-            if (elapsed < 10) {
-                updateLoadingText('Starting AI processing...');
-            } else if (elapsed < 20) {
-                updateLoadingText('Analyzing your face...');
-            } else {
-                updateLoadingText('Almost done, creating your traditional photo...');
+            // Server had no long-poll slot free: it answered at once, so wait before asking again
+            if (data.poll_after) {
+                await new Promise(resolve => setTimeout(resolve, data.poll_after * 1000));
             }
 
-            // Wait 2 seconds before next poll
-            await new Promise(resolve => setTimeout(resolve, 2000));
             attempts++;
 
         } catch (error) {
@@ -325,7 +446,7 @@ async function generateQRCode(imageUrl) {
 // Retake photo
 function retakePhoto() {
     // Reset state
-    capturedPhoto = null;
+    setCapturedPhoto(null);
     selectedCharacter = null;
 
     // Remove character selections
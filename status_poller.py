@@ -0,0 +1,292 @@
+"""
+Status Poller Module
+One background poller refreshes the status of every active prediction, so
+/check-status and /wait-status answer from the prediction store instead of
+each kiosk poll calling the provider. Upstream calls then scale with the
+number of running predictions, not with kiosks x poll rate.
+
+Each prediction is polled on an adaptive schedule around the expected run
+time (median of recent predictions): sparse while it is early, every
+POLLER_MIN_INTERVAL seconds near the expected finish, backing off again
+while it runs late. Predictions that report via webhook are only polled
+once their delivery is overdue. Hedge checks (prediction_hedger.py) run on
+a schedule of their own, from the hedge delay on, webhook or not.
+
+With the SQLite prediction store one worker is elected through a
+job_scheduler lease and polls for all of them; if it dies another takes
+over when the lease expires. With the memory store every worker polls its
+own predictions.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, Any, Optional
+from dotenv import load_dotenv
+
+import admission_queue
+import face_backends
+import job_scheduler
+import prediction_hedger
+import replicate_helper
+from prediction_store import SQLitePredictionStore
+
+# Load environment variables
+load_dotenv()
+
+# Set POLLER_ENABLED=0 to go back to polling the provider on every status check
+POLLER_ENABLED = os.getenv('POLLER_ENABLED', '1') == '1'
+
+# Shortest and longest gap between two polls of one prediction (seconds)
+POLLER_MIN_INTERVAL = float(os.getenv('POLLER_MIN_INTERVAL', '1'))
+POLLER_MAX_INTERVAL = float(os.getenv('POLLER_MAX_INTERVAL', '5'))
+
+# Status checks in flight at once
+POLLER_CONCURRENCY = int(os.getenv('POLLER_CONCURRENCY', '4'))
+
+# A prediction the poller has not refreshed for this long is checked
+# directly by /check-status (poller stalled or lease being handed over)
+POLLER_STALE_AFTER = float(os.getenv('POLLER_STALE_AFTER', '20'))
+
+# How often the poller looks for due predictions (seconds)
+POLLER_TICK = 0.5
+
+# Lease held by the elected poller; renewed every tick, and every third of
+# its length while a tick waits on slow status checks
+POLLER_LEASE_NAME = 'status-poller'
+POLLER_LEASE_SECONDS = 10
+
+# Completed predictions needed before their median replaces average_duration
+POLLER_MIN_SAMPLES = 5
+
+TERMINAL_STATUSES = ('succeeded', 'failed', 'canceled')
+
+# Running totals for this process, reported by /health
+poller_stats = {
+    'leader': False,
+    'polls': 0,
+    'errors': 0,
+    'finished': 0,
+    'last_tick': None,
+}
+
+_stats_lock = threading.Lock()
+_poller_started = False
+_poller_lock = threading.Lock()
+
+
+def _count(key: str) -> None:
+    """Increment one poller_stats counter (status checks run on the pool's threads)."""
+    with _stats_lock:
+        poller_stats[key] += 1
+
+
+def expected_duration() -> float:
+    """Seconds a prediction usually takes, from recent completions."""
+    observed = replicate_helper.latency_percentile(50, POLLER_MIN_SAMPLES)
+    if observed is not None:
+        return observed
+    return admission_queue.average_duration()
+
+
+def next_poll_delay(age: float, expected: float) -> float:
+    """
+    Seconds until a prediction of this age should be polled again.
+
+    Early on the gap is half the time left until the expected finish, so
+    polls close in on it; after that they back off by a tenth of the
+    overrun. Always within POLLER_MIN_INTERVAL..POLLER_MAX_INTERVAL.
+    """
+    remaining = expected - age
+    if remaining > 0:
+        delay = remaining / 2
+    else:
+        delay = POLLER_MIN_INTERVAL - remaining * 0.1
+    return max(POLLER_MIN_INTERVAL, min(POLLER_MAX_INTERVAL, delay))
+
+
+def is_fresh(prediction_data: Dict[str, Any]) -> bool:
+    """
+    True if the poller keeps this entry's status current, so a status check
+    can answer from the store without calling the provider.
+    """
+    if not POLLER_ENABLED:
+        return False
+    last_seen = prediction_data.get('polled_at') or prediction_data.get('created_at') or 0
+    return time.time() - last_seen < POLLER_STALE_AFTER
+
+
+def _poll_due_at(prediction_data: Dict[str, Any], webhook_grace: float, expected: float) -> float:
+    """When an entry is next due for a poll."""
+    if prediction_data.get('next_poll_at'):
+        return prediction_data['next_poll_at']
+    created_at = prediction_data.get('created_at', time.time())
+    if prediction_data.get('webhook'):
+        # First poll only as a safety net for a lost delivery
+        return created_at + webhook_grace
+    return created_at + next_poll_delay(0.0, expected)
+
+
+def _hedge_due_at(prediction_data: Dict[str, Any], delay: float) -> Optional[float]:
+    """When an entry is next due for a hedge check, or None if it cannot get one."""
+    if not prediction_hedger.can_hedge(prediction_data):
+        return None
+    created_at = prediction_data.get('created_at', time.time())
+    return max(created_at + delay, prediction_data.get('hedge_check_at') or 0)
+
+
+def _check_hedge(store, prediction_id: str) -> None:
+    """Start a hedge for a slow prediction; checked again after POLLER_MAX_INTERVAL."""
+    prediction_data = store.update(prediction_id, hedge_check_at=time.time() + POLLER_MAX_INTERVAL)
+    if prediction_data is None:
+        return  # Claimed or reaped meanwhile
+    prediction_hedger.maybe_start_hedge(store, prediction_id, prediction_data)
+
+
+def _poll_one(store, prediction_id: str, prediction_data: Dict[str, Any], expected: float,
+              on_finished: Callable[[str, Dict[str, Any], Dict[str, Any]], None],
+              check_hedge: bool = False) -> None:
+    """Refresh one prediction and store the result (then check its hedge if due and still running)."""
+    backend = face_backends.get_backend(prediction_data.get('backend'))
+    status_info = backend.status(prediction_id)
+    now = time.time()
+    _count('polls')
+
+    age = now - prediction_data.get('created_at', now)
+    fields = {'polled_at': now, 'next_poll_at': now + next_poll_delay(age, expected)}
+
+    if not status_info:
+        _count('errors')
+        store.update(prediction_id, **fields)
+        return
+
+    fields['status'] = status_info['status']
+    if status_info['status'] in TERMINAL_STATUSES:
+        fields['status_info'] = status_info
+    if store.update(prediction_id, **fields) is None:
+        # Claimed or reaped while we were asking
+        return
+
+    if status_info['status'] in TERMINAL_STATUSES:
+        _count('finished')
+        on_finished(prediction_id, prediction_data, status_info)
+    elif check_hedge:
+        _check_hedge(store, prediction_id)
+
+
+def poll_due_predictions(store, pool: ThreadPoolExecutor, webhook_grace: float,
+                         on_finished: Callable[[str, Dict[str, Any], Dict[str, Any]], None],
+                         keep_lease: Optional[Callable[[], bool]] = None) -> int:
+    """
+    Poll every active prediction whose next check is due.
+
+    Args:
+        keep_lease: Renews the poller lease while the checks run; returns
+            False once it is lost (the remaining checks are then dropped)
+
+    Returns:
+        Number of predictions polled (hedge checks not counted)
+    """
+    now = time.time()
+    expected = None
+    hedge_after = None
+    due = []
+    hedge_due = []
+    for prediction_id, prediction_data in store.items():
+        if prediction_data.get('status_info'):
+            continue  # Final status known, waiting for a kiosk to claim it
+        if expected is None:
+            expected = expected_duration()
+            hedge_after = prediction_hedger.hedge_delay() if prediction_hedger.HEDGE_ENABLED else None
+        hedge_at = _hedge_due_at(prediction_data, hedge_after) if hedge_after is not None else None
+        check_hedge = hedge_at is not None and now >= hedge_at
+        if now >= _poll_due_at(prediction_data, webhook_grace, expected):
+            # The poll checks the hedge itself once it knows the prediction still runs
+            due.append((prediction_id, prediction_data, check_hedge))
+        elif check_hedge:
+            hedge_due.append(prediction_id)
+
+    pending = {
+        pool.submit(_poll_one, store, prediction_id, prediction_data, expected, on_finished, check_hedge)
+        for prediction_id, prediction_data, check_hedge in due
+    }
+    pending.update(pool.submit(_check_hedge, store, prediction_id) for prediction_id in hedge_due)
+    while pending:
+        done, pending = wait(pending, timeout=POLLER_LEASE_SECONDS / 3)
+        for future in done:
+            try:
+                future.result()
+            except Exception as e:
+                _count('errors')
+                print(f"[Poller] Status check failed: {str(e)}", flush=True)
+        if pending and keep_lease is not None and not keep_lease():
+            # Another worker takes over; leave the rest of this batch to it
+            dropped = sum(1 for future in pending if future.cancel())
+            print(f"[Poller] Lease lost during a tick, dropped {dropped} checks", flush=True)
+            break
+    return len(due)
+
+
+def start_poller(store, webhook_grace: float,
+                 on_finished: Callable[[str, Dict[str, Any], Dict[str, Any]], None]) -> None:
+    """
+    Start the background poller thread (once per process).
+
+    Args:
+        store: Prediction store (see prediction_store.py)
+        webhook_grace: Seconds to trust a webhook delivery before polling
+        on_finished: Called with (prediction_id, prediction_data, status_info)
+            when the poller sees a prediction finish
+    """
+    global _poller_started
+    if not POLLER_ENABLED:
+        return
+    with _poller_lock:
+        if _poller_started:
+            return
+        _poller_started = True
+
+    # Only a shared store needs one elected poller for all workers
+    elected = isinstance(store, SQLitePredictionStore)
+    pool = ThreadPoolExecutor(max_workers=POLLER_CONCURRENCY, thread_name_prefix='status-poll')
+
+    def _renew() -> bool:
+        return job_scheduler.renew(POLLER_LEASE_NAME, POLLER_LEASE_SECONDS)
+
+    def _is_leader() -> bool:
+        if not elected:
+            return True
+        if poller_stats['leader']:
+            return _renew()
+        return job_scheduler.try_acquire(POLLER_LEASE_NAME, POLLER_LEASE_SECONDS)
+
+    def _run():
+        while True:
+            try:
+                leader = _is_leader()
+                if leader != poller_stats['leader']:
+                    print(f"[Poller] {'Now' if leader else 'No longer'} polling for this box "
+                          f"({job_scheduler.WORKER_ID})", flush=True)
+                poller_stats['leader'] = leader
+                if leader:
+                    poll_due_predictions(store, pool, webhook_grace, on_finished,
+                                         keep_lease=_renew if elected else None)
+                    poller_stats['last_tick'] = time.time()
+            except Exception as e:
+                print(f"[Poller] Error during poll: {str(e)}", flush=True)
+            time.sleep(POLLER_TICK)
+
+    threading.Thread(target=_run, name='status-poller', daemon=True).start()
+    print(f"[Poller] Started ({'elected across workers' if elected else 'per worker'})", flush=True)
+
+
+def get_poller_stats() -> Dict[str, Any]:
+    """Return the poller counters and the current expected duration."""
+    with _stats_lock:
+        stats = dict(poller_stats)
+    return dict(
+        stats,
+        enabled=POLLER_ENABLED,
+        expected_seconds=round(expected_duration(), 1)
+    )
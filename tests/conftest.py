@@ -0,0 +1,79 @@
+"""
+Shared test setup: the app's modules live in the repo root, and every
+SQLite file they open is redirected to a temporary directory.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Module-level settings are read at import; keep imports away from the
+# repo's own database files and from any real provider
+_import_dir = tempfile.mkdtemp(prefix='swap-tests-')
+for _name in ('PREDICTION_DB_PATH', 'ADMISSION_DB_PATH', 'SCHEDULER_DB_PATH',
+              'RESULT_CACHE_DB_PATH', 'CLEANUP_QUEUE_PATH', 'ROUTER_DB_PATH'):
+    os.environ[_name] = os.path.join(_import_dir, _name.lower() + '.db')
+os.environ['PREDICTION_STORE'] = 'memory'
+os.environ['REPLICATE_API_TOKEN'] = ''
+
+
+@pytest.fixture
+def admission_db(tmp_path, monkeypatch):
+    """admission_queue on an empty database of its own."""
+    import admission_queue
+    monkeypatch.setattr(admission_queue, 'ADMISSION_DB_PATH', str(tmp_path / 'admission.db'))
+    monkeypatch.setattr(admission_queue, '_schema_ready', False)
+    return admission_queue
+
+
+@pytest.fixture
+def scheduler_db(tmp_path, monkeypatch):
+    """job_scheduler on an empty lease database of its own."""
+    import job_scheduler
+    monkeypatch.setattr(job_scheduler, 'SCHEDULER_DB_PATH', str(tmp_path / 'scheduler.db'))
+    monkeypatch.setattr(job_scheduler, '_schema_ready', False)
+    return job_scheduler
+
+
+class FakeBackend:
+    """Face-swap backend stand-in that records what was asked of it."""
+
+    uses_mask = False
+
+    def __init__(self, name='fake'):
+        self.name = name
+        self.started = []
+        self.canceled = []
+        self.statuses = {}
+        self.next_start = None
+
+    def start(self, child_image_url, mask_image_url, character):
+        self.started.append((child_image_url, mask_image_url, character))
+        return self.next_start
+
+    def current_version(self, character):
+        return 'v1'
+
+    def status(self, prediction_id):
+        return self.statuses.get(prediction_id)
+
+    def cancel(self, prediction_id):
+        self.canceled.append(prediction_id)
+        return True
+
+    def parse_output(self, output):
+        return output
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    """A FakeBackend registered in face_backends.BACKENDS as 'fake'."""
+    import face_backends
+    backend = FakeBackend()
+    monkeypatch.setitem(face_backends.BACKENDS, backend.name, backend)
+    return backend
@@ -0,0 +1,148 @@
+"""Admission queue: fair claiming, slot release on finish, ETA and extra slots."""
+
+import time
+
+
+def _launcher(results):
+    """Launch callback returning results[payload['n']] (a prediction ID or None)."""
+    launched = []
+
+    def launch(job_id, payload):
+        launched.append(payload['n'])
+        return results.get(payload['n'])
+    return launch, launched
+
+
+def test_claims_fewest_running_client_first(admission_db, monkeypatch):
+    monkeypatch.setattr(admission_db, 'ADMISSION_MAX_ACTIVE', 2)
+    a1 = admission_db.enqueue('kiosk-a', {'n': 1})
+    a2 = admission_db.enqueue('kiosk-a', {'n': 2})
+    b1 = admission_db.enqueue('kiosk-b', {'n': 3})
+
+    launch, launched = _launcher({1: 'pred-1', 2: 'pred-2', 3: 'pred-3'})
+    assert admission_db.dispatch_pending(launch, lambda *args: None) == 2
+
+    # kiosk-b's only job goes before kiosk-a's second one
+    assert launched == [1, 3]
+    assert admission_db.get_job(a1)['state'] == 'running'
+    assert admission_db.get_job(b1)['prediction_id'] == 'pred-3'
+    assert admission_db.get_job(a2)['state'] == 'queued'
+
+
+def test_finish_frees_the_slot_for_the_next_job(admission_db, monkeypatch):
+    monkeypatch.setattr(admission_db, 'ADMISSION_MAX_ACTIVE', 1)
+    first = admission_db.enqueue('kiosk-a', {'n': 1})
+    second = admission_db.enqueue('kiosk-a', {'n': 2})
+    launch, launched = _launcher({1: 'pred-1', 2: 'pred-2'})
+
+    admission_db.dispatch_pending(launch, lambda *args: None)
+    assert launched == [1]
+
+    admission_db.finish('pred-1')
+    admission_db.finish('pred-1')  # Repeated reports are harmless
+    admission_db.dispatch_pending(launch, lambda *args: None)
+
+    assert launched == [1, 2]
+    assert admission_db.get_job(first)['state'] == 'done'
+    assert admission_db.get_job(second)['state'] == 'running'
+
+
+def test_failed_launch_backs_off_without_blocking_the_next_job(admission_db):
+    failing = admission_db.enqueue('kiosk-a', {'n': 1})
+    healthy = admission_db.enqueue('kiosk-b', {'n': 2})
+    launch, launched = _launcher({2: 'pred-2'})
+
+    assert admission_db.dispatch_pending(launch, lambda *args: None) == 1
+
+    assert launched == [1, 2]
+    assert admission_db.get_job(healthy)['state'] == 'running'
+    conn = admission_db._connect()
+    state, attempts, not_before = conn.execute(
+        "SELECT state, attempts, not_before FROM swap_jobs WHERE job_id = ?", (failing,)
+    ).fetchone()
+    assert (state, attempts) == ('queued', 1)
+    assert not_before > time.time()
+
+
+def test_gives_up_after_max_attempts(admission_db, monkeypatch):
+    monkeypatch.setattr(admission_db, 'ADMISSION_MAX_ATTEMPTS', 2)
+    job_id = admission_db.enqueue('kiosk-a', {'n': 1})
+    launch, _ = _launcher({})
+    abandoned = []
+
+    admission_db.dispatch_pending(launch, lambda *args: abandoned.append(args))
+    admission_db._connect().execute("UPDATE swap_jobs SET not_before = 0")
+    admission_db.dispatch_pending(launch, lambda *args: abandoned.append(args))
+
+    assert admission_db.get_job(job_id)['state'] == 'failed'
+    assert [args[0] for args in abandoned] == [job_id]
+
+
+def test_finish_before_the_running_update_is_not_lost(admission_db):
+    job_id = admission_db.enqueue('kiosk-a', {'n': 1})
+
+    def launch(job_id, payload):
+        # The webhook for the new prediction beats dispatch_pending's update
+        admission_db.finish('pred-fast')
+        return 'pred-fast'
+
+    admission_db.dispatch_pending(launch, lambda *args: None)
+
+    assert admission_db.get_job(job_id)['state'] == 'done'
+    assert admission_db.get_queue_stats()['active'] == 0
+
+
+def test_unknown_finish_leaves_no_record(admission_db):
+    admission_db.finish('pred-unknown')
+    count = admission_db._connect().execute("SELECT COUNT(*) FROM early_finishes").fetchone()[0]
+    assert count == 0
+
+
+def test_queue_position_and_eta(admission_db, monkeypatch):
+    monkeypatch.setattr(admission_db, 'ADMISSION_MAX_ACTIVE', 2)
+    launch, _ = _launcher({1: 'pred-1', 2: 'pred-2'})
+    admission_db.enqueue('kiosk-a', {'n': 1})
+    admission_db.enqueue('kiosk-a', {'n': 2})
+    admission_db.dispatch_pending(launch, lambda *args: None)
+    admission_db.finish('pred-1')
+    admission_db.finish('pred-2')
+    admission_db._connect().execute("UPDATE swap_jobs SET started_at = finished_at - 12")
+
+    waiting = [admission_db.enqueue(client, {'n': n})
+               for n, client in ((3, 'kiosk-a'), (4, 'kiosk-a'), (5, 'kiosk-a'))]
+    jobs = [admission_db.get_job(job_id) for job_id in waiting]
+
+    assert admission_db.average_duration() == 12
+    assert [job['queue_position'] for job in jobs] == [1, 2, 3]
+    # Two run at once: positions 1-2 are one run away, position 3 two runs
+    assert [job['eta_seconds'] for job in jobs] == [12, 12, 24]
+
+
+def test_extra_slot_only_when_nobody_waits(admission_db, monkeypatch):
+    monkeypatch.setattr(admission_db, 'ADMISSION_MAX_ACTIVE', 1)
+    slot_id = admission_db.take_slot()
+    assert slot_id is not None
+    assert admission_db.take_slot() is None  # The only slot is taken
+
+    admission_db.bind_slot(slot_id, 'hedge-1')
+    admission_db.finish('hedge-1')
+    assert admission_db.get_queue_stats()['active'] == 0
+
+    admission_db.enqueue('kiosk-a', {'n': 1})
+    assert admission_db.take_slot() is None  # A kiosk is waiting
+
+
+def test_extra_slot_finished_before_bind(admission_db):
+    slot_id = admission_db.take_slot()
+    admission_db.finish('hedge-fast')
+    admission_db.bind_slot(slot_id, 'hedge-fast')
+
+    assert admission_db.get_queue_stats()['active'] == 0
+    # Extra slots stay out of the duration average
+    assert admission_db.average_duration() == admission_db.ADMISSION_DEFAULT_DURATION
+
+
+def test_released_slot_is_free_again(admission_db, monkeypatch):
+    monkeypatch.setattr(admission_db, 'ADMISSION_MAX_ACTIVE', 1)
+    admission_db.release_slot(admission_db.take_slot())
+    assert admission_db.take_slot() is not None
@@ -0,0 +1,63 @@
+"""Backend routing: shared outcomes, degradation and exploration probes."""
+
+import pytest
+
+import face_backends
+from conftest import FakeBackend
+
+
+@pytest.fixture
+def two_backends(monkeypatch):
+    """'fast' (preferred) and 'spare' registered as backends."""
+    backends = {name: FakeBackend(name) for name in ('fast', 'spare')}
+    for name, backend in backends.items():
+        monkeypatch.setitem(face_backends.BACKENDS, name, backend)
+    monkeypatch.setattr(face_backends, 'ROUTER_EXPLORE', 0.0)
+    return backends
+
+
+def _record(router, name, ok, seconds, count):
+    for _ in range(count):
+        router.record(name, ok, seconds)
+
+
+def test_sqlite_outcomes_are_shared_between_routers(two_backends, tmp_path):
+    db_path = str(tmp_path / 'router.db')
+    worker_a = face_backends.BackendRouter(['fast', 'spare'], face_backends.SQLiteOutcomeLog(db_path))
+    worker_b = face_backends.BackendRouter(['fast', 'spare'], face_backends.SQLiteOutcomeLog(db_path))
+
+    _record(worker_a, 'fast', True, 6.0, 3)
+    worker_a.record('fast', False)
+
+    assert worker_b.health('fast') == {'samples': 4, 'error_rate': 0.25, 'mean_seconds': 6.0}
+
+
+def test_failing_backend_loses_traffic(two_backends):
+    router = face_backends.BackendRouter(['fast', 'spare'])
+    assert router.pick().name == 'fast'
+
+    _record(router, 'fast', False, None, face_backends.ROUTER_MIN_SAMPLES)
+    assert router.pick().name == 'spare'
+
+
+def test_slow_backend_loses_traffic(two_backends):
+    router = face_backends.BackendRouter(['fast', 'spare'])
+    _record(router, 'fast', True, 30.0, face_backends.ROUTER_MIN_SAMPLES)
+    _record(router, 'spare', True, 10.0, face_backends.ROUTER_MIN_SAMPLES)
+    assert router.pick().name == 'spare'
+
+
+def test_exploration_probes_degraded_backends(two_backends, monkeypatch):
+    router = face_backends.BackendRouter(['fast', 'spare'])
+    _record(router, 'fast', False, None, face_backends.ROUTER_MIN_SAMPLES)
+    monkeypatch.setattr(face_backends, 'ROUTER_EXPLORE', 1.0)
+
+    picks = {router.pick().name for _ in range(50)}
+    assert 'fast' in picks
+
+
+def test_unknown_backend_outcomes_are_ignored(two_backends):
+    router = face_backends.BackendRouter(['fast'])
+    router.record('spare', False)
+    router.record(None, False)
+    assert router.get_stats() == {'fast': {'samples': 0, 'error_rate': 0.0, 'mean_seconds': None}}
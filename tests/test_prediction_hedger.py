@@ -0,0 +1,154 @@
+"""Hedging: merging the two statuses, settling the pair, and start bookkeeping."""
+
+import time
+from datetime import date
+
+import pytest
+
+import prediction_hedger
+from prediction_store import InMemoryPredictionStore
+
+
+def _info(prediction_id, status):
+    return {'prediction_id': prediction_id, 'status': status}
+
+
+@pytest.fixture
+def hedging(monkeypatch, admission_db, fake_backend):
+    """Hedging on, with a delay every test prediction is past."""
+    monkeypatch.setattr(prediction_hedger, 'HEDGE_ENABLED', True)
+    monkeypatch.setattr(prediction_hedger, 'hedge_stats', dict.fromkeys(prediction_hedger.hedge_stats, 0))
+    monkeypatch.setattr(prediction_hedger, 'hedge_delay', lambda: 10.0)
+    return fake_backend
+
+
+def _primary(store, **fields):
+    data = {
+        'backend': 'fake',
+        'character': 'superman',
+        'inputs': {'child_image_url': 'https://img/child.jpg', 'mask_image_url': ''},
+        'status': 'processing',
+        'created_at': time.time() - 60,
+        'expires_at': time.time() + 600,
+        'status_info': None,
+    }
+    data.update(fields)
+    store.create('primary', data)
+    return data
+
+
+def test_combine_without_hedge_is_the_primary():
+    primary = _info('primary', 'processing')
+    assert prediction_hedger.combine(primary, None) is primary
+
+
+@pytest.mark.parametrize('primary_status, hedge_status, expected', [
+    ('succeeded', 'processing', {'prediction_id': 'primary', 'status': 'succeeded', 'hedge_loser': 'hedge'}),
+    ('processing', 'succeeded', {'prediction_id': 'hedge', 'status': 'succeeded', 'hedge_loser': 'primary'}),
+    ('succeeded', 'canceled', {'prediction_id': 'primary', 'status': 'succeeded'}),
+    ('failed', 'processing', {'prediction_id': 'hedge', 'status': 'processing'}),
+    ('failed', 'failed', {'prediction_id': 'primary', 'status': 'failed'}),
+    ('processing', 'failed', {'prediction_id': 'primary', 'status': 'processing'}),
+])
+def test_combine(primary_status, hedge_status, expected):
+    combined = prediction_hedger.combine(_info('primary', primary_status), _info('hedge', hedge_status))
+    assert combined == expected
+
+
+def test_settle_cancels_the_loser_and_drops_the_hedge(hedging):
+    store = InMemoryPredictionStore()
+    store.create('hedge', {'hedge_of': 'primary', 'status': 'processing'})
+    primary = {'backend': 'fake', 'hedge_id': 'hedge', 'hedge_backend': 'fake'}
+
+    prediction_hedger.settle(store, primary, dict(_info('primary', 'succeeded'), hedge_loser='hedge'))
+
+    assert hedging.canceled == ['hedge']
+    assert store.get('hedge') is None
+    assert prediction_hedger.hedge_stats['primary_won'] == 1
+
+
+def test_settle_skips_a_loser_already_canceled(hedging):
+    store = InMemoryPredictionStore()
+    primary = {'backend': 'fake', 'hedge_id': 'hedge', 'hedge_backend': 'fake', 'loser_canceled': 'primary'}
+
+    prediction_hedger.settle(store, primary, dict(_info('hedge', 'succeeded'), hedge_loser='primary'))
+
+    assert hedging.canceled == []
+    assert prediction_hedger.hedge_stats['hedge_won'] == 1
+
+
+def test_cancel_loser_when_the_hedge_wins(hedging):
+    store = InMemoryPredictionStore()
+    _primary(store, hedge_id='hedge', hedge_backend='fake')
+    store.create('hedge', {'hedge_of': 'primary', 'backend': 'fake', 'status': 'succeeded'})
+
+    assert prediction_hedger.cancel_loser(store, 'hedge', _info('hedge', 'succeeded')) == 'primary'
+    assert hedging.canceled == ['primary']
+    assert store.get('primary')['loser_canceled'] == 'primary'
+
+
+def test_cancel_loser_leaves_finished_or_failed_pairs_alone(hedging):
+    store = InMemoryPredictionStore()
+    _primary(store, hedge_id='hedge', hedge_backend='fake')
+    store.create('hedge', {'hedge_of': 'primary', 'backend': 'fake', 'status': 'failed'})
+
+    assert prediction_hedger.cancel_loser(store, 'primary', _info('primary', 'succeeded')) is None
+    assert prediction_hedger.cancel_loser(store, 'hedge', _info('hedge', 'failed')) is None
+    assert hedging.canceled == []
+
+
+def test_maybe_start_hedge_records_the_pair(hedging):
+    store = InMemoryPredictionStore()
+    data = _primary(store)
+    hedging.next_start = {'prediction_id': 'hedge', 'created_at': time.time(), 'version': 'v1'}
+
+    assert prediction_hedger.maybe_start_hedge(store, 'primary', data) == 'hedge'
+    assert store.get('primary')['hedge_id'] == 'hedge'
+    assert store.get('hedge')['hedge_of'] == 'primary'
+    # A second poll does not start another one
+    assert prediction_hedger.maybe_start_hedge(store, 'primary', store.get('primary')) is None
+    assert len(hedging.started) == 1
+
+
+def test_maybe_start_hedge_not_before_the_delay(hedging):
+    store = InMemoryPredictionStore()
+    data = _primary(store, created_at=time.time())
+    assert prediction_hedger.maybe_start_hedge(store, 'primary', data) is None
+    assert hedging.started == []
+
+
+def test_failed_start_releases_claim_slot_and_budget(hedging, admission_db, monkeypatch):
+    monkeypatch.setattr(prediction_hedger, 'HEDGE_DAILY_BUDGET', 1)
+    store = InMemoryPredictionStore()
+    data = _primary(store)
+
+    assert prediction_hedger.maybe_start_hedge(store, 'primary', data) is None
+    assert store.get_alias('hedge:primary') is None
+    assert admission_db.get_queue_stats()['active'] == 0
+
+    # The refunded budget lets the next poll try again
+    hedging.next_start = {'prediction_id': 'hedge', 'created_at': time.time(), 'version': 'v1'}
+    assert prediction_hedger.maybe_start_hedge(store, 'primary', data) == 'hedge'
+
+
+def test_spent_budget_releases_claim_and_slot(hedging, admission_db):
+    store = InMemoryPredictionStore()
+    data = _primary(store)
+    budget_key = f"hedge-budget:{date.today().isoformat()}"
+    for _ in range(prediction_hedger.HEDGE_DAILY_BUDGET):
+        store.take_quota(budget_key, prediction_hedger.HEDGE_DAILY_BUDGET, time.time() + 60)
+
+    assert prediction_hedger.maybe_start_hedge(store, 'primary', data) is None
+    assert store.get_alias('hedge:primary') is None
+    assert admission_db.get_queue_stats()['active'] == 0
+    assert prediction_hedger.hedge_stats['budget_exhausted'] == 1
+    assert hedging.started == []
+
+
+def test_no_spare_slot_releases_claim(hedging, admission_db, monkeypatch):
+    monkeypatch.setattr(admission_db, 'ADMISSION_MAX_ACTIVE', 0)
+    store = InMemoryPredictionStore()
+
+    assert prediction_hedger.maybe_start_hedge(store, 'primary', _primary(store)) is None
+    assert store.get_alias('hedge:primary') is None
+    assert prediction_hedger.hedge_stats['no_slot'] == 1
@@ -0,0 +1,59 @@
+"""Prediction store aliases and quotas, on both backends."""
+
+import time
+
+import pytest
+
+import prediction_store
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return prediction_store.SQLitePredictionStore(str(tmp_path / 'predictions.db'))
+    return prediction_store.InMemoryPredictionStore()
+
+
+def test_claim_alias_first_caller_wins(store):
+    expires_at = time.time() + 60
+    assert store.claim_alias('flight:abc', {'pending': True}, expires_at) is None
+    assert store.claim_alias('flight:abc', {'pending': True}, expires_at) == {'pending': True}
+
+    store.set_alias('flight:abc', {'payload': {'id': 1}, 'code': 200}, expires_at)
+    assert store.claim_alias('flight:abc', {'pending': True}, expires_at) == {
+        'payload': {'id': 1}, 'code': 200
+    }
+
+
+def test_claim_alias_after_expiry_or_delete(store):
+    store.claim_alias('hedge:p1', {'pending': True}, time.time() - 1)
+    assert store.claim_alias('hedge:p1', {'pending': True}, time.time() + 60) is None
+
+    store.delete_alias('hedge:p1')
+    assert store.get_alias('hedge:p1') is None
+    assert store.claim_alias('hedge:p1', {'pending': True}, time.time() + 60) is None
+
+
+def test_take_quota_stops_at_the_limit(store):
+    expires_at = time.time() + 60
+    assert [store.take_quota('budget', 2, expires_at) for _ in range(3)] == [True, True, False]
+
+
+def test_release_quota_gives_a_use_back(store):
+    expires_at = time.time() + 60
+    store.take_quota('budget', 1, expires_at)
+    assert not store.take_quota('budget', 1, expires_at)
+
+    store.release_quota('budget')
+    assert store.take_quota('budget', 1, expires_at)
+
+
+def test_release_quota_never_goes_below_zero(store):
+    store.release_quota('budget')
+    expires_at = time.time() + 60
+    assert [store.take_quota('budget', 1, expires_at) for _ in range(2)] == [True, False]
+
+
+def test_expired_quota_starts_over(store):
+    store.take_quota('budget', 1, time.time() - 1)
+    assert store.take_quota('budget', 1, time.time() + 60)
@@ -0,0 +1,173 @@
+"""Retry classification, call() retries and the circuit breaker."""
+
+import socket
+import time
+import uuid
+
+import pytest
+
+import resilience
+
+
+class HTTPError(Exception):
+    """SDK-style error carrying an HTTP status (and optional headers)."""
+
+    def __init__(self, status, headers=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.response = type('Response', (), {'headers': headers or {}})()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(resilience, 'RETRY_BASE_DELAY', 0.0)
+
+
+@pytest.fixture
+def dependency():
+    """A breaker name no other test has touched."""
+    return f"test-{uuid.uuid4().hex}"
+
+
+def _failing(*errors, result='ok'):
+    """Callable raising each error in turn, then returning result."""
+    calls = []
+
+    def fn():
+        calls.append(time.time())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return fn, calls
+
+
+@pytest.mark.parametrize('error, expected', [
+    (HTTPError(429), (True, True, None)),
+    (HTTPError(503, {'Retry-After': '3'}), (True, False, 3.0)),
+    (HTTPError(404), (False, False, None)),
+    (ConnectionRefusedError(), (True, True, None)),
+    (socket.gaierror(), (True, True, None)),
+    (TimeoutError(), (True, False, None)),
+    (Exception("Server returned unexpected status code - 502"), (True, False, None)),
+    (ValueError("bad input"), (False, False, None)),
+])
+def test_classify(error, expected):
+    assert resilience.classify(error) == expected
+
+
+def test_throttle_message_gives_retry_after():
+    error = HTTPError(429)
+    error.detail = "Request was throttled. Expected available in 5 seconds."
+    assert resilience.classify(error) == (True, True, 5.0)
+
+
+def test_transient_errors_are_retried(dependency):
+    fn, calls = _failing(HTTPError(503), TimeoutError())
+    assert resilience.call(dependency, fn) == 'ok'
+    assert len(calls) == 3
+
+
+def test_client_errors_are_not_retried(dependency):
+    fn, calls = _failing(HTTPError(422))
+    with pytest.raises(HTTPError):
+        resilience.call(dependency, fn)
+    assert len(calls) == 1
+    assert resilience.get_breaker(dependency).failures == 0
+
+
+def test_non_idempotent_call_not_repeated_after_ambiguous_failure(dependency):
+    fn, calls = _failing(HTTPError(503))
+    with pytest.raises(HTTPError):
+        resilience.call(dependency, fn, idempotent=False)
+    assert len(calls) == 1
+
+
+def test_non_idempotent_call_repeated_when_not_processed(dependency):
+    fn, calls = _failing(HTTPError(429), ConnectionRefusedError())
+    assert resilience.call(dependency, fn, idempotent=False) == 'ok'
+    assert len(calls) == 3
+
+
+def test_statuses_retried_by_the_sdk_are_not_retried_again(dependency):
+    fn, calls = _failing(HTTPError(503))
+    with pytest.raises(HTTPError):
+        resilience.call(dependency, fn, retried_statuses=(429, 503, 504))
+    assert len(calls) == 1
+    # Still counts toward the breaker
+    assert resilience.get_breaker(dependency).failures == 1
+
+
+def test_gives_up_after_max_attempts(dependency, monkeypatch):
+    monkeypatch.setattr(resilience, 'RETRY_MAX_ATTEMPTS', 2)
+    fn, calls = _failing(*[HTTPError(503)] * 5)
+    with pytest.raises(HTTPError):
+        resilience.call(dependency, fn)
+    assert len(calls) == 2
+
+
+def test_attempt_timeout_follows_the_call_deadline(dependency):
+    seen = []
+    resilience.call(dependency, lambda: seen.append(resilience.attempt_timeout(30.0)), deadline=2.0)
+    assert 0 < seen[0] <= 2.0
+    # Outside call() the default applies again
+    assert resilience.attempt_timeout(30.0) == 30.0
+
+
+def test_nested_call_keeps_the_outer_deadline(dependency):
+    seen = []
+
+    def outer():
+        resilience.call(dependency, lambda: seen.append(resilience.attempt_timeout(30.0)), deadline=20.0)
+    resilience.call(dependency, outer, deadline=1.0)
+    assert seen[0] <= 1.0
+
+
+def test_attempt_timeout_after_the_deadline_raises(dependency):
+    def slow():
+        time.sleep(0.05)
+        return resilience.attempt_timeout(30.0)
+    with pytest.raises(TimeoutError):
+        resilience.call(dependency, slow, deadline=0.01)
+
+
+def test_open_breaker_fails_fast(dependency, monkeypatch):
+    monkeypatch.setattr(resilience, 'RETRY_MAX_ATTEMPTS', 1)
+    breaker = resilience.get_breaker(dependency)
+    for _ in range(breaker.failure_threshold):
+        fn, _ = _failing(HTTPError(503))
+        with pytest.raises(HTTPError):
+            resilience.call(dependency, fn)
+
+    fn, calls = _failing()
+    with pytest.raises(resilience.CircuitOpenError):
+        resilience.call(dependency, fn)
+    assert calls == []
+
+
+def test_half_open_allows_a_single_trial():
+    breaker = resilience.CircuitBreaker('trial', failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()  # Only one trial at a time
+
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_failed_trial_reopens():
+    breaker = resilience.CircuitBreaker('trial', failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.trips == 2
+    assert not breaker.allow()
@@ -0,0 +1,147 @@
+"""Poll scheduling, hedge checks, lease renewal and the poller counters."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import prediction_hedger
+import status_poller
+from prediction_store import InMemoryPredictionStore
+
+
+@pytest.fixture
+def pool():
+    executor = ThreadPoolExecutor(max_workers=1)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+@pytest.fixture(autouse=True)
+def known_duration(monkeypatch):
+    monkeypatch.setattr(status_poller, 'expected_duration', lambda: 20.0)
+
+
+def _entry(**fields):
+    data = {
+        'backend': 'fake',
+        'character': 'superman',
+        'status': 'processing',
+        'created_at': time.time() - 30,
+        'expires_at': time.time() + 600,
+        'webhook': False,
+        'status_info': None,
+    }
+    data.update(fields)
+    return data
+
+
+def test_next_poll_delay_closes_in_on_the_expected_finish():
+    assert status_poller.next_poll_delay(0, 8) == 4
+    assert status_poller.next_poll_delay(0, 60) == status_poller.POLLER_MAX_INTERVAL
+    assert status_poller.next_poll_delay(19.5, 20) == status_poller.POLLER_MIN_INTERVAL
+
+
+def test_next_poll_delay_backs_off_when_late():
+    on_time = status_poller.next_poll_delay(20, 20)
+    late = status_poller.next_poll_delay(30, 20)
+    very_late = status_poller.next_poll_delay(300, 20)
+    assert on_time < late < very_late
+    assert very_late == status_poller.POLLER_MAX_INTERVAL
+
+
+def test_webhook_predictions_wait_for_the_grace():
+    created_at = time.time()
+    due_at = status_poller._poll_due_at(_entry(created_at=created_at, webhook=True), 90, 20)
+    assert due_at == created_at + 90
+
+
+def test_finished_prediction_is_reported_once(fake_backend, pool):
+    store = InMemoryPredictionStore()
+    store.create('p1', _entry())
+    fake_backend.statuses['p1'] = {'prediction_id': 'p1', 'status': 'succeeded', 'result_url': 'https://res/1.jpg'}
+    finished = []
+
+    status_poller.poll_due_predictions(store, pool, 90, lambda *args: finished.append(args[0]))
+    status_poller.poll_due_predictions(store, pool, 90, lambda *args: finished.append(args[0]))
+
+    assert finished == ['p1']
+    assert store.get('p1')['status_info']['result_url'] == 'https://res/1.jpg'
+
+
+def test_webhook_prediction_gets_hedged_before_the_grace(fake_backend, admission_db, pool, monkeypatch):
+    monkeypatch.setattr(prediction_hedger, 'HEDGE_ENABLED', True)
+    monkeypatch.setattr(prediction_hedger, 'hedge_delay', lambda: 15.0)
+    store = InMemoryPredictionStore()
+    store.create('p1', _entry(webhook=True, inputs={'child_image_url': 'https://img/c.jpg', 'mask_image_url': ''}))
+    fake_backend.next_start = {'prediction_id': 'h1', 'created_at': time.time(), 'version': 'v1'}
+
+    polled = status_poller.poll_due_predictions(store, pool, 90, lambda *args: None)
+
+    assert polled == 0  # Not due for a status poll yet
+    assert store.get('p1')['hedge_id'] == 'h1'
+    assert store.get('h1')['hedge_of'] == 'p1'
+
+
+def test_slow_checks_renew_the_lease(fake_backend, pool, monkeypatch):
+    monkeypatch.setattr(status_poller, 'POLLER_LEASE_SECONDS', 0.15)
+    store = InMemoryPredictionStore()
+    store.create('p1', _entry())
+
+    def slow_status(prediction_id):
+        time.sleep(0.3)
+        return None
+    monkeypatch.setattr(fake_backend, 'status', slow_status)
+    renewals = []
+
+    status_poller.poll_due_predictions(store, pool, 90, lambda *args: None,
+                                       keep_lease=lambda: renewals.append(time.time()) or True)
+
+    assert len(renewals) >= 2
+
+
+def test_lost_lease_drops_the_rest_of_the_batch(fake_backend, pool, monkeypatch):
+    monkeypatch.setattr(status_poller, 'POLLER_LEASE_SECONDS', 0.15)
+    store = InMemoryPredictionStore()
+    for prediction_id in ('p1', 'p2', 'p3'):
+        store.create(prediction_id, _entry())
+    checked = []
+
+    def slow_status(prediction_id):
+        checked.append(prediction_id)
+        time.sleep(0.2)
+        return None
+    monkeypatch.setattr(fake_backend, 'status', slow_status)
+
+    status_poller.poll_due_predictions(store, pool, 90, lambda *args: None, keep_lease=lambda: False)
+    pool.shutdown(wait=True)
+
+    assert len(checked) == 1
+
+
+def test_lease_is_exclusive_until_it_expires(scheduler_db, monkeypatch):
+    assert scheduler_db.try_acquire('status-poller', 0.2)
+    assert scheduler_db.renew('status-poller', 0.2)
+
+    monkeypatch.setattr(scheduler_db, 'WORKER_ID', 'other-worker')
+    assert not scheduler_db.try_acquire('status-poller', 0.2)
+    assert not scheduler_db.renew('status-poller', 0.2)
+
+    time.sleep(0.25)
+    assert scheduler_db.try_acquire('status-poller', 0.2)
+
+
+def test_counters_are_not_lost_across_threads(monkeypatch):
+    monkeypatch.setattr(status_poller, 'poller_stats', dict(status_poller.poller_stats, polls=0))
+
+    def bump():
+        for _ in range(2000):
+            status_poller._count('polls')
+    threads = [threading.Thread(target=bump) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert status_poller.get_poller_stats()['polls'] == 16000
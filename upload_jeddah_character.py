@@ -31,8 +31,8 @@ try:
     
     print(f"\n✓ Upload successful!")
     print(f"URL: {result['secure_url']}")
-    print(f"\nAdd this URL to replicate_helper.py:")
-    print(f"'template_image': '{result['secure_url']}'")
+    print(f"\nAdd this URL to characters.json:")
+    print(f'"template_image": "{result["secure_url"]}"')
     
 except Exception as e:
     print(f"✗ Upload failed: {e}")
@@ -52,7 +52,7 @@ if __name__ == "__main__":
         print("\n" + "=" * 60)
         print("✅ SUCCESS!")
         print("=" * 60)
-        print(f"\nUpdate replicate_helper.py with this URL:")
+        print(f"\nUpdate characters.json with this URL:")
         print(f"'{url}'")
     else:
         print("\n❌ Upload failed. Please check your Cloudinary credentials.")
@@ -1,9 +1,8 @@
 """
 Upscale Character Image to 4K using Replicate Real-ESRGAN
 """
-import replicate
 import os
-import requests
+import http_pool
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -35,7 +34,7 @@ def upscale_image_to_4k(image_path, output_filename):
         print("\n[2/3] Upscaling with Real-ESRGAN (4x scale)...")
         print("This may take 30-60 seconds...")
         
-        output = replicate.run(
+        output = http_pool.get_replicate_client().run(
             "nightmareai/real-esrgan:42fed1c4974146d4d2414e2be2c5277c7fcf05fcc3a73abf41610695738c1d7b",
             input={
                 "image": open(image_path, 'rb'),
@@ -61,7 +60,7 @@ def upscale_image_to_4k(image_path, output_filename):
         print(f"Result URL: {result_url[:50]}...")
         
         # Download the upscaled image
-        response = requests.get(result_url)
+        response = http_pool.get_session().get(result_url)
         
         if response.status_code == 200:
             output_path = f"static/characters/{output_filename}.png"